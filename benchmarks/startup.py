@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Cold start benchmark for the editor: runs `kfm_editor.py --profile-startup`
+# several times and checks the median of each phase against the budget.
+#
+# Budget (milliseconds, median of the runs):
+#
+#   first event loop turn   400   window created and the event loop running,
+#                                 i.e. the window can paint
+#   total                   700   the KFM format classes created in the
+#                                 background and the file given (if any)
+#                                 opened
+#
+# The format classes are not part of the first budget: they are created on
+# a background thread once the window is up, from the prebuilt schema
+# (KfmFormat.write_schema) when there is one.
+#
+#   python benchmarks/startup.py [-n RUNS] [KFM FILE]
+#
+# Exits with 1 if a phase is over budget.
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BUDGET_MS = {
+    "first event loop turn": 400,
+    "total": 700,
+}
+
+def run_once(filename=None):
+    env = dict(os.environ)
+    if not env.get("DISPLAY") and sys.platform.startswith("linux"):
+        env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    command = [sys.executable, os.path.join(ROOT, "kfm_editor.py"), "--profile-startup"]
+    if filename:
+        command.append(filename)
+    output = subprocess.run(command, env=env, cwd=ROOT, capture_output=True, text=True, check=True).stdout
+
+    # phase -> ms, and ms since start at the end of each phase
+    phases = {}
+    elapsed = {}
+    total = 0.0
+    for line in output.splitlines():
+        phase, _, ms = line.rpartition(" ms")[0].rpartition(" ")
+        phase = phase.strip()
+        if not phase:
+            continue
+        phases[phase] = float(ms)
+        if phase != "total":
+            total += float(ms)
+            elapsed[phase] = total
+    elapsed["total"] = phases["total"]
+    return phases, elapsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure editor startup and check it against the budget.")
+    parser.add_argument("file", nargs="?", help="KFM file to open on startup")
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    runs = [run_once(args.file) for _ in range(args.runs)]
+
+    print(f"{'phase':<28}{'median':>10}{'since start':>14}{'budget':>10}")
+    over = []
+    for phase in runs[0][0]:
+        median = statistics.median(phases[phase] for phases, _ in runs)
+        since_start = statistics.median(elapsed[phase] for _, elapsed in runs)
+        budget = BUDGET_MS.get(phase)
+        print(f"{phase:<28}{median:8.1f} ms{since_start:11.1f} ms" + (f"{budget:7d} ms" if budget else ""))
+        if budget and since_start > budget:
+            over.append(phase)
+
+    for phase in over:
+        print(f"over budget: {phase}")
+    return 1 if over else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
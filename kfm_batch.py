@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+# Headless batch mode: applies a script of commands to many KFM files
+# without a QApplication, spreading the files over a process pool.
+#
+# The script is either JSON (a list of objects) or CSV (one command per row)
+# with the fields of Command:
+#
+#   type, new_value, animation_index, transition_index
+#
+# and two optional selectors which are resolved per file, so the same script
+# works on files where the animations are in a different order:
+#
+#   event_code     selects the animation with this event code
+#   transition_to  selects that animation's transition to this event code
+
+import sys
+import os
+import io
+import csv
+import json
+import argparse
+import traceback
+import contextlib
+
+from kfm_commands import CommandType, Command, CommandManager
+from kfm_io import kfm_format, read_kfm, write_kfm
+
+SCRIPT_FIELDS = ["type", "new_value", "animation_index", "transition_index", "event_code", "transition_to"]
+
+class KfmDocument:
+    # stands in for the editor window when there is no GUI
+    def __init__(self, data=None, filename=None):
+        self.data = data
+        self.opened_filename = filename
+        self.unsaved_changes = False
+
+    def refresh_ui(self):
+        pass
+
+def load_script(filename):
+    with open(filename, newline='') as file:
+        if os.path.splitext(filename)[1].lower() == '.csv':
+            steps = [{key: (value if value != '' else None) for key, value in row.items()} for row in csv.DictReader(file)]
+        else:
+            steps = json.load(file)
+
+    for step in steps:
+        unknown = set(step) - set(SCRIPT_FIELDS)
+        if unknown:
+            raise ValueError(f"unknown script fields {sorted(unknown)}")
+        CommandType(step["type"])
+        for key in ("animation_index", "transition_index", "event_code", "transition_to"):
+            if step.get(key) is not None:
+                step[key] = int(step[key])
+    return steps
+
+def resolve_command(step, manager):
+    animation_index = step.get("animation_index")
+    transition_index = step.get("transition_index")
+
+    if step.get("event_code") is not None:
+        anim = manager.index.animation(step["event_code"])
+        if anim is None:
+            raise ValueError(f"no animation with event code {step['event_code']}")
+        animation_index = manager.index.animation_row(anim)
+
+    if step.get("transition_to") is not None:
+        if animation_index is None:
+            raise ValueError("transition_to needs an animation")
+        anim = manager.uber.data.animations[animation_index]
+        for a, t in manager.index.refs(step["transition_to"]):
+            if a is anim:
+                transition_index = manager.index.row(a.transitions, t)
+                break
+        else:
+            raise ValueError(f"Animation {animation_index + 1} has no transition to {step['transition_to']}")
+
+    return Command(
+        type=CommandType(step["type"]),
+        new_value=step.get("new_value"),
+        animation_index=animation_index,
+        transition_index=transition_index
+    )
+
+def apply_script(filename, steps, output=None, dry_run=False):
+    result = {"file": filename, "output": None, "status": "unchanged", "commands": [], "log": ""}
+    log = io.StringIO()
+
+    with contextlib.redirect_stdout(log):
+        try:
+            doc = KfmDocument(read_kfm(filename), filename)
+            manager = CommandManager(doc)
+            manager.clear()
+
+            for step in steps:
+                try:
+                    command = resolve_command(step, manager)
+                except Exception as e:
+                    result["commands"].append({"command": step["type"], "status": "failed", "error": str(e)})
+                    result["status"] = "failed"
+                    break
+
+                applied = len(manager.history)
+                if not manager.execute(command):
+                    result["commands"].append({"command": str(command), "status": "failed"})
+                    result["status"] = "failed"
+                    break
+                result["commands"].append({"command": str(command), "status": "applied" if len(manager.history) > applied else "unchanged"})
+
+            if result["status"] != "failed" and doc.unsaved_changes:
+                result["status"] = "changed"
+                if not dry_run:
+                    result["output"] = output or filename
+                    write_kfm(doc.data, result["output"])
+        except Exception:
+            print(traceback.format_exc())
+            result["status"] = "error"
+
+    result["log"] = log.getvalue()
+    return result
+
+def _apply_script_job(job):
+    return apply_script(*job)
+
+def find_kfm_files(paths, output_dir=None):
+    # (input, output) pairs, directories are searched recursively and
+    # mirrored below output_dir
+    jobs = []
+    re_filename = kfm_format().RE_FILENAME
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if re_filename.match(name):
+                        filename = os.path.join(dirpath, name)
+                        output = os.path.join(output_dir, os.path.relpath(filename, path)) if output_dir else None
+                        jobs.append((filename, output))
+        else:
+            jobs.append((path, os.path.join(output_dir, os.path.basename(path)) if output_dir else None))
+    return jobs
+
+def run_batch(steps, files, jobs=None, dry_run=False):
+    work = [(filename, steps, output, dry_run) for filename, output in files]
+    if jobs == 1 or len(work) <= 1:
+        return [_apply_script_job(job) for job in work]
+    # imported here, the editor imports this module but never runs a pool
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_apply_script_job, work, chunksize=max(1, len(work) // (4 * (jobs or os.cpu_count() or 1)))))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kfm_editor.py --batch", description="Apply a command script to KFM files without the GUI.")
+    parser.add_argument("script", help="JSON or CSV command script")
+    parser.add_argument("paths", nargs="+", help="KFM files or directories to search for KFM files")
+    parser.add_argument("-o", "--output-dir", help="write results below this directory instead of overwriting the input files")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument("-r", "--report", help="write the per-file JSON report to this file")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="apply the script but do not write any file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the command log of every file")
+    args = parser.parse_args(argv)
+
+    steps = load_script(args.script)
+    files = find_kfm_files(args.paths, args.output_dir)
+
+    results = run_batch(steps, files, jobs=args.jobs, dry_run=args.dry_run)
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        print(f"{result['status']:>9} {result['file']}")
+        if args.verbose or result["status"] == "error":
+            print(result["log"])
+
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "no KFM files found")
+
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    return 1 if counts.get("failed") or counts.get("error") else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,893 @@
+import json
+import traceback
+
+from dataclasses import dataclass
+from typing import Any, Optional
+from enum import Enum
+
+class CommandType(Enum):
+    EDIT_NIF_FILENAME = "edit_nif_filename"
+    EDIT_NUM_ANIMATIONS = "edit_num_animations" 
+    
+    EDIT_ANIMATION_KF_FILENAME = "edit_animation_kf_filename"
+    EDIT_ANIMATION_EVENT_CODE = "edit_animation_event_code"
+    EDIT_ANIMATION_INDEX = "edit_animation_index"
+
+    REMOVE_ANIMATION = "remove_animation"
+    REMOVE_TRANSITION = "remove_transition"
+    
+    EDIT_NUM_TRANSITIONS = "edit_num_transitions"
+    
+    EDIT_TRANSITION_ANIMATION = "edit_transition_animation"
+    EDIT_TRANSITION_TYPE = "edit_transition_type"
+
+    DUPLICATE_ANIMATIONS = "duplicate_animations"
+    PASTE_ANIMATIONS = "paste_animations"
+    PASTE_TRANSITIONS = "paste_transitions"
+
+    REPLACE_KFM = "replace_kfm"
+
+@dataclass
+class Command:
+    type: CommandType
+    new_value: Any = None
+    animation_index: Optional[int] = None
+    transition_index: Optional[int] = None
+
+    def __str__(self):
+        if isinstance(self.new_value, list) and self.new_value and isinstance(self.new_value[0], dict):
+            return f"{self.type.value} : {len(self.new_value)} items"
+        if isinstance(self.new_value, dict) and "animations" in self.new_value:
+            return f"{self.type.value} : {len(self.new_value['animations'])} animations"
+        return f"{self.type.value} : {self.new_value}"
+
+class CommandError(Exception):
+    # a command that was rejected (e.g. duplicate event code); reported
+    # without a traceback
+    pass
+
+def describe(command):
+    # history entries hold a Command, or a list of them for transactions
+    if isinstance(command, list):
+        return f"{len(command)} commands ({', '.join(str(c) for c in command[:3])}{', ...' if len(command) > 3 else ''})"
+    return str(command)
+    
+def to_plain(struct):
+    # JSON friendly copy of a struct: attribute name -> value, with arrays
+    # as lists and strings as latin-1 text so any byte survives
+    plain = {}
+    for attr in struct._get_filtered_attribute_list():
+        plain[attr.name] = _plain_value(getattr(struct, attr.name))
+    return plain
+
+def _plain_value(value):
+    if hasattr(value, "_get_filtered_attribute_list"):
+        return to_plain(value)
+    if hasattr(value, "update_size"):
+        return [_plain_value(elem) for elem in value]
+    if isinstance(value, bytes):
+        return value.decode("latin-1")
+    return value
+
+def from_plain(struct, plain):
+    # fills struct from to_plain output; attributes are set in file order
+    # so counts and conditions see the values they depend on
+    for attr in struct._get_filtered_attribute_list():
+        if attr.name not in plain:
+            continue
+        value = getattr(struct, attr.name)
+        if hasattr(value, "_get_filtered_attribute_list"):
+            from_plain(value, plain[attr.name])
+        elif hasattr(value, "update_size"):
+            value.update_size()
+            for i, item in enumerate(plain[attr.name][:len(value)]):
+                if isinstance(item, dict):
+                    from_plain(value[i], item)
+                else:
+                    value[i] = item
+        elif isinstance(value, bytes):
+            setattr(struct, attr.name, plain[attr.name].encode("latin-1"))
+        else:
+            setattr(struct, attr.name, plain[attr.name])
+    return struct
+
+def replace_commands(data, index, field, find, replace):
+    # commands replacing find by replace in one field of data: the file
+    # names get substrings substituted, an event code renumbers its
+    # animation (and with it the transitions to it)
+    if field == "nif_file_name":
+        name = data.nif_file_name.decode("ascii")
+        return [Command(type=CommandType.EDIT_NIF_FILENAME, new_value=name.replace(find, replace))] if find in name else []
+
+    if field == "kf_file_name":
+        commands = []
+        lowered = find.lower()
+        for anim, name in index.kf_names.values():
+            if lowered in name:
+                value = anim.kf_file_name.decode("ascii")
+                if find in value:
+                    commands.append(Command(type=CommandType.EDIT_ANIMATION_KF_FILENAME, new_value=value.replace(find, replace),
+                                            animation_index=index.animation_row(anim)))
+        return sorted(commands, key=lambda command: command.animation_index)
+
+    if field == "event_code":
+        anim = index.animation(int(find))
+        if anim is None:
+            return []
+        return [Command(type=CommandType.EDIT_ANIMATION_EVENT_CODE, new_value=int(replace), animation_index=index.animation_row(anim))]
+
+    raise ValueError(f"Can't replace in {field}")
+
+class ChangeListener:
+    # receives notifications for every primitive edit done through a
+    # ChangeSet, including undo/redo, so views and indices can update
+    # incrementally
+    def begin_insert(self, array, index, count):
+        pass
+
+    def end_insert(self, array, index, count):
+        pass
+
+    def begin_remove(self, array, index, count):
+        pass
+
+    def end_remove(self, array, index, count):
+        pass
+
+    def changed(self, obj, name, old_value, new_value):
+        pass
+
+class ChangeSet:
+    # journal of the primitive edits done by one command, so that undo/redo
+    # only replays what actually changed instead of re-reading the whole file
+    SET = 0
+    INSERT = 1
+    REMOVE = 2
+
+    def __init__(self, listeners=()):
+        self.listeners = list(listeners)
+        self.changes = []
+        self.cost = 0
+
+    def __len__(self):
+        return len(self.changes)
+
+    def set(self, obj, name, value):
+        old_value = getattr(obj, name)
+        setattr(obj, name, value)
+        new_value = getattr(obj, name)
+        if old_value != new_value:
+            self.changes.append((ChangeSet.SET, obj, name, old_value, new_value))
+            self.cost += 64 + (len(old_value) + len(new_value) if isinstance(new_value, bytes) else 0)
+            for listener in self.listeners:
+                listener.changed(obj, name, old_value, new_value)
+
+    def insert(self, array, index, elements):
+        self._insert(array, index, elements)
+        self.changes.append((ChangeSet.INSERT, array, index, elements, None))
+        self.cost += 64 + sum(e.get_size() for e in elements)
+
+    def remove(self, array, index, count=1):
+        elements = list.__getitem__(array, slice(index, index + count))
+        self._remove(array, index, count)
+        self.changes.append((ChangeSet.REMOVE, array, index, elements, None))
+        self.cost += 64 + sum(e.get_size() for e in elements)
+        return elements
+
+    @staticmethod
+    def new_element(array):
+        return array._elementType(
+            template=array._elementTypeTemplate,
+            argument=array._elementTypeArgument,
+            parent=array)
+
+    def _set(self, obj, name, old_value, new_value):
+        setattr(obj, name, new_value)
+        for listener in self.listeners:
+            listener.changed(obj, name, old_value, new_value)
+
+    def _insert(self, array, index, elements):
+        for listener in self.listeners:
+            listener.begin_insert(array, index, len(elements))
+        list.__setitem__(array, slice(index, index), elements)
+        for listener in self.listeners:
+            listener.end_insert(array, index, len(elements))
+
+    def _remove(self, array, index, count):
+        for listener in self.listeners:
+            listener.begin_remove(array, index, count)
+        list.__delitem__(array, slice(index, index + count))
+        for listener in self.listeners:
+            listener.end_remove(array, index, count)
+
+    def undo(self):
+        for kind, target, key, a, b in reversed(self.changes):
+            if kind == ChangeSet.SET:
+                self._set(target, key, b, a)
+            elif kind == ChangeSet.INSERT:
+                self._remove(target, key, len(a))
+            else:
+                self._insert(target, key, a)
+
+    def redo(self):
+        for kind, target, key, a, b in self.changes:
+            if kind == ChangeSet.SET:
+                self._set(target, key, a, b)
+            elif kind == ChangeSet.INSERT:
+                self._insert(target, key, a)
+            else:
+                self._remove(target, key, len(a))
+
+SEARCH_FIELDS = {
+    "kf": "kf",
+    "code": "event_code",
+    "index": "index",
+    "to": "to",
+    "type": "type",
+}
+
+def parse_search(text):
+    # "kf:_Run code:42 index:3 to:42 type:5" -> KfmIndex.search keywords; a
+    # bare number is an event code, any other bare word part of a KF name
+    criteria = {}
+    for token in text.split():
+        key, sep, value = token.partition(":")
+        if not sep:
+            key, value = ("code" if token.lstrip("-").isdigit() else "kf"), token
+        if key not in SEARCH_FIELDS or not value:
+            raise ValueError(f"Unknown search term {token!r}, use {', '.join(f'{k}:' for k in SEARCH_FIELDS)}")
+        field = SEARCH_FIELDS[key]
+        if field == "kf":
+            criteria.setdefault("kf", []).append(value)
+        else:
+            try:
+                criteria[field] = int(value)
+            except ValueError:
+                raise ValueError(f"{key}: needs a number, not {value!r}")
+    return criteria
+
+class KfmIndex(ChangeListener):
+    # event code -> animations and event code -> (animation, transition)
+    # references, plus what the search filters on, kept up to date from the
+    # ChangeSet notifications so lookups don't have to scan every transition
+    # of every animation
+    def __init__(self, data=None):
+        self.rebuild(data)
+
+    def rebuild(self, data):
+        self.data = data
+        # event code -> list of animations (files may contain duplicates)
+        self.animations = {}
+        # event code -> {id(transition): (animation, transition)}
+        self.references = {}
+        # transition type -> {id(transition): (animation, transition)}
+        self.transition_types = {}
+        # index -> {id(animation): animation}
+        self.indices = {}
+        # id(animation) -> (animation, lower case KF file name)
+        self.kf_names = {}
+        # array id -> {element id: row}, dropped whenever the array changes
+        self.rows = {}
+        if data is not None:
+            for anim in data.animations:
+                self.add_animation(anim)
+
+    def animation(self, event_code):
+        anims = self.animations.get(event_code)
+        return anims[0] if anims else None
+
+    def refs(self, event_code):
+        return list(self.references.get(event_code, {}).values())
+
+    def next_event_code(self):
+        return max(self.animations, default=-1) + 1
+
+    def row(self, array, obj):
+        rows = self.rows.get(id(array))
+        if rows is None:
+            rows = self.rows[id(array)] = {id(e): i for i, e in enumerate(list.__iter__(array))}
+        return rows[id(obj)]
+
+    def animation_row(self, anim):
+        return self.row(self.data.animations, anim)
+
+    def search(self, kf=None, event_code=None, index=None, to=None, type=None):
+        # animations matching all given criteria, in file order; kf is one
+        # or more parts of the KF name, to and type have to match on the
+        # same transition
+        found = None
+
+        def narrow(anims):
+            nonlocal found
+            anims = {id(a): a for a in anims}
+            found = anims if found is None else {key: a for key, a in found.items() if key in anims}
+
+        if event_code is not None:
+            narrow(self.animations.get(event_code, ()))
+        if index is not None:
+            narrow(self.indices.get(index, {}).values())
+        if to is not None or type is not None:
+            refs = self.references.get(to, {}) if to is not None else self.transition_types.get(type, {})
+            if to is not None and type is not None:
+                refs = {key: ref for key, ref in refs.items() if ref[1].type == type}
+            narrow(a for a, _ in refs.values())
+        if kf is not None:
+            words = [w.lower() for w in ([kf] if isinstance(kf, str) else kf)]
+            names = self.kf_names.values() if found is None else (self.kf_names[key] for key in found)
+            narrow(a for a, name in names if all(w in name for w in words))
+
+        if found is None:
+            found = {id(a): a for a in self.data.animations} if self.data is not None else {}
+        return sorted(found.values(), key=self.animation_row)
+
+    def add_animation(self, anim):
+        self.animations.setdefault(anim.event_code, []).append(anim)
+        self.indices.setdefault(anim.index, {})[id(anim)] = anim
+        self.kf_names[id(anim)] = (anim, anim.kf_file_name.decode("ascii", "replace").lower())
+        for t in anim.transitions:
+            self.add_reference(anim, t)
+
+    def remove_animation(self, anim):
+        anims = self.animations.get(anim.event_code)
+        if anims is not None:
+            anims.remove(anim)
+            if not anims:
+                del self.animations[anim.event_code]
+        self._discard(self.indices, anim.index, anim)
+        self.kf_names.pop(id(anim), None)
+        for t in anim.transitions:
+            self.remove_transition(t)
+
+    def add_reference(self, anim, t):
+        self.references.setdefault(t.animation, {})[id(t)] = (anim, t)
+        self.transition_types.setdefault(t.type, {})[id(t)] = (anim, t)
+
+    def remove_transition(self, t):
+        self.remove_reference(t.animation, t)
+        self._discard(self.transition_types, t.type, t)
+
+    @staticmethod
+    def _discard(table, key, obj):
+        # removes obj from the {id(obj): ...} bucket table[key]
+        bucket = table.get(key)
+        if bucket is not None:
+            bucket.pop(id(obj), None)
+            if not bucket:
+                del table[key]
+
+    def remove_reference(self, event_code, t):
+        refs = self.references.get(event_code)
+        if refs is None:
+            return None
+        ref = refs.pop(id(t), None)
+        if not refs:
+            del self.references[event_code]
+        return ref
+
+    # ChangeListener
+
+    def begin_remove(self, array, index, count):
+        for obj in list.__getitem__(array, slice(index, index + count)):
+            if array is self.data.animations:
+                self.remove_animation(obj)
+            else:
+                self.remove_transition(obj)
+
+    def end_remove(self, array, index, count):
+        self.rows.pop(id(array), None)
+
+    def end_insert(self, array, index, count):
+        self.rows.pop(id(array), None)
+        for obj in list.__getitem__(array, slice(index, index + count)):
+            if array is self.data.animations:
+                self.add_animation(obj)
+            else:
+                self.add_reference(array._parent(), obj)
+
+    def changed(self, obj, name, old_value, new_value):
+        if name == 'event_code':
+            anims = self.animations.get(old_value)
+            if anims is not None and obj in anims:
+                anims.remove(obj)
+                if not anims:
+                    del self.animations[old_value]
+                self.animations.setdefault(new_value, []).append(obj)
+        elif name == 'animation':
+            ref = self.remove_reference(old_value, obj)
+            if ref is not None:
+                self.references.setdefault(new_value, {})[id(obj)] = ref
+        elif name == 'type':
+            ref = self.transition_types.get(old_value, {}).get(id(obj))
+            if ref is not None:
+                self._discard(self.transition_types, old_value, obj)
+                self.transition_types.setdefault(new_value, {})[id(obj)] = ref
+        elif name == 'index':
+            if id(obj) in self.indices.get(old_value, {}):
+                self._discard(self.indices, old_value, obj)
+                self.indices.setdefault(new_value, {})[id(obj)] = obj
+        elif name == 'kf_file_name':
+            if id(obj) in self.kf_names:
+                self.kf_names[id(obj)] = (obj, new_value.decode("ascii", "replace").lower())
+
+class CommandManager:
+    def __init__(self, uber, history_budget=32 * 1024 * 1024):
+        self.uber = uber
+
+        # list of (command, changes) that have been applied, history_pointer
+        # is the number of entries currently applied
+        self.history = []
+        self.history_pointer = 0
+
+        # approximate memory (bytes) the undo history may hold on to
+        self.history_budget = history_budget
+        self.history_cost = 0
+        self.command_handlers = {}
+
+        # bumped on every change to the data, lets callers tell whether the
+        # data is still the same as at some earlier point (e.g. a save)
+        self.generation = 0
+
+        # notified of every edit, see ChangeListener
+        self.listeners = []
+        self.index = KfmIndex()
+
+        # records every history step for crash recovery, see kfm_journal
+        self.journal = None
+
+        # ChangeSet the running handler records into
+        self.active_changes = None
+
+        # open transaction: (changes, commands, failed), see begin_transaction
+        self.transaction = None
+        self.transaction_depth = 0
+
+        def create_handler(func):
+            def wrapper(*args):
+                func(self.active_changes, *args)
+            return wrapper
+
+        def resize_transitions(changes, anim, new_count):
+            old_count = len(anim.transitions)
+            changes.set(anim, 'num_transitions', new_count)
+            if new_count < old_count:
+                changes.remove(anim.transitions, new_count, old_count - new_count)
+            elif new_count > old_count:
+                changes.insert(anim.transitions, old_count, [ChangeSet.new_element(anim.transitions) for _ in range(new_count - old_count)])
+
+        @create_handler
+        def handle_nif_filename(changes, new_value, *args):
+            changes.set(self.uber.data, 'nif_file_name', new_value)
+
+        @create_handler
+        def handle_num_animations(changes, new_value, *args):
+            animations = self.uber.data.animations
+            old_value = self.uber.data.num_animations
+            new_value = int(new_value)
+
+            if new_value < old_value:
+                changes.set(self.uber.data, 'num_animations', new_value)
+                changes.remove(animations, new_value, old_value - new_value)
+                return
+
+            next_anim = self.index.next_event_code()
+
+            added = []
+            for i in range(old_value, new_value):
+                anim = ChangeSet.new_element(animations)
+                anim.event_code = next_anim
+
+                anim.num_transitions = old_value
+                anim.transitions.update_size()
+                for j in range(old_value):
+                    anim.transitions[j].animation = animations[j].event_code
+                    anim.transitions[j].type = 5
+
+                added.append(anim)
+                print(f"\n Next animation event code {next_anim}")
+                print("... adding transition to every other animation.\n")
+
+                next_anim += 1
+
+            added_codes = [a.event_code for a in added]
+
+            # new animations still need transitions to each other, they are
+            # not part of the journal yet so they can be filled in directly
+            for at, a in enumerate(added):
+                local = [code for code in added_codes if code != a.event_code]
+                old_count = a.num_transitions
+                a.num_transitions += len(local)
+                a.transitions.update_size()
+                for ii, code in enumerate(local):
+                    a.transitions[old_count + ii].animation = code
+                    a.transitions[old_count + ii].type = 5
+                    print(f"... adding transition to {code} for Animation {old_value + at + 1}")
+
+            for at in range(old_value):
+                a = animations[at]
+                transitions = []
+                for code in added_codes:
+                    t = ChangeSet.new_element(a.transitions)
+                    t.animation = code
+                    t.type = 5
+                    transitions.append(t)
+                    print(f"... adding transition to {code} for Animation {at + 1}")
+
+                if transitions:
+                    changes.set(a, 'num_transitions', a.num_transitions + len(transitions))
+                    changes.insert(a.transitions, len(a.transitions), transitions)
+
+            if added:
+                changes.set(self.uber.data, 'num_animations', new_value)
+                changes.insert(animations, old_value, added)
+
+        @create_handler
+        def handle_animation(changes, prop, new_value, anim_idx, *args):
+            changes.set(self.uber.data.animations[anim_idx], prop, new_value)
+
+        @create_handler
+        def handle_event_code(changes, new_value, anim_idx, *args):
+            anim = self.uber.data.animations[anim_idx]
+
+            new_value = int(new_value)
+            
+            used_by = self.index.animation(new_value)
+            if used_by is not None:
+                raise CommandError(f"Event code already used by Animation {self.index.animation_row(used_by) + 1}")
+
+            old_value = anim.event_code
+            changes.set(anim, 'event_code', new_value)
+
+            refs = sorted(self.index.refs(old_value), key=lambda ref: self.index.animation_row(ref[0]))
+            for a, t in refs:
+                changes.set(t, 'animation', new_value)
+                print(f"... updating transition for Animation {self.index.animation_row(a) + 1}, event code {old_value} -> {new_value}")
+            
+        @create_handler
+        def handle_num_transitions(changes, new_value, anim_idx, *args):
+            resize_transitions(changes, self.uber.data.animations[anim_idx], int(new_value))
+
+        @create_handler
+        def handle_transition_property(changes, prop, new_value, anim_idx, transition_index):
+            if prop == 'animation':
+                if self.index.animation(new_value) is None:
+                    raise CommandError(f"Can't find animation with event code {new_value}")
+            
+            changes.set(self.uber.data.animations[anim_idx].transitions[transition_index], prop, new_value)
+
+        @create_handler
+        def handle_remove_animation(changes, _, anim_idx, *args):
+            event_code = self.uber.data.animations[anim_idx].event_code
+
+            changes.remove(self.uber.data.animations, anim_idx)
+            changes.set(self.uber.data, 'num_animations', self.uber.data.num_animations - 1)
+
+            # only the first transition of each animation to the removed one
+            first = {}
+            for a, t in self.index.refs(event_code):
+                it = self.index.row(a.transitions, t)
+                if id(a) not in first or it < first[id(a)][1]:
+                    first[id(a)] = (a, it)
+
+            for a, it in sorted(first.values(), key=lambda ref: self.index.animation_row(ref[0])):
+                changes.remove(a.transitions, it)
+                changes.set(a, 'num_transitions', a.num_transitions - 1)
+
+                print(f"... removing transition for Animation {self.index.animation_row(a) + 1}")
+
+        @create_handler
+        def handle_remove_transition(changes, _, anim_idx, transition_index):
+            anim = self.uber.data.animations[anim_idx]
+
+            changes.remove(anim.transitions, transition_index)
+            changes.set(anim, 'num_transitions', anim.num_transitions - 1)
+
+        def copy_transition(array, t, target):
+            new = ChangeSet.new_element(array)
+            new.deepcopy(t)
+            new.animation = target
+            return new
+
+        def append_transitions(changes, anim, transitions):
+            if transitions:
+                count = len(anim.transitions)
+                changes.set(anim, 'num_transitions', count + len(transitions))
+                changes.insert(anim.transitions, count, transitions)
+
+        def append_animations(changes, copies):
+            count = len(self.uber.data.animations)
+            changes.set(self.uber.data, 'num_animations', count + len(copies))
+            changes.insert(self.uber.data.animations, count, copies)
+
+        @create_handler
+        def handle_duplicate_animations(changes, new_value, anim_idx, *args):
+            # new_value lists the animations to copy (default: anim_idx). The
+            # copies get fresh event codes, transitions within the set point
+            # at the copies, and every other animation that can go to an
+            # original gets the same transition to its copy
+            animations = self.uber.data.animations
+            rows = [anim_idx] if new_value is None else [int(row) for row in (json.loads(new_value) if isinstance(new_value, str) else new_value)]
+            rows = list(dict.fromkeys(rows))
+            sources = [animations[row] for row in rows]
+            codes = range(self.index.next_event_code(), self.index.next_event_code() + len(sources))
+            remap = {}
+            for src, code in zip(sources, codes):
+                remap.setdefault(src.event_code, code)
+
+            copies = []
+            for src, code in zip(sources, codes):
+                anim = ChangeSet.new_element(animations)
+                anim.deepcopy(src)
+                anim.event_code = code
+                for t in anim.transitions:
+                    t.animation = remap.get(t.animation, t.animation)
+                copies.append(anim)
+
+            in_set = {id(src) for src in sources}
+            added = {}
+            for old_code, new_code in remap.items():
+                for a, t in self.index.refs(old_code):
+                    if id(a) not in in_set:
+                        added.setdefault(id(a), (a, []))[1].append(copy_transition(a.transitions, t, new_code))
+            for a, transitions in sorted(added.values(), key=lambda ref: self.index.animation_row(ref[0])):
+                append_transitions(changes, a, transitions)
+                print(f"... adding {len(transitions)} transitions for Animation {self.index.animation_row(a) + 1}")
+
+            append_animations(changes, copies)
+            for src, anim in zip(sources, copies):
+                print(f"... Animation {self.index.animation_row(anim) + 1} (event code {anim.event_code}) copies Animation {self.index.animation_row(src) + 1}")
+
+        @create_handler
+        def handle_paste_animations(changes, new_value, *args):
+            # new_value is a list of to_plain animations, e.g. copied from
+            # another file; transitions to event codes this file doesn't
+            # have are dropped. As for duplicates, every animation that can
+            # go to the event code a pasted one had gets the same transition
+            # to it
+            animations = self.uber.data.animations
+            plains = json.loads(new_value) if isinstance(new_value, str) else new_value
+            if not plains:
+                return
+            codes = range(self.index.next_event_code(), self.index.next_event_code() + len(plains))
+            remap = {}
+            for plain, code in zip(plains, codes):
+                remap.setdefault(plain["event_code"], code)
+
+            copies = []
+            for plain, code in zip(plains, codes):
+                anim = from_plain(ChangeSet.new_element(animations), plain)
+                anim.event_code = code
+                kept = []
+                for t in anim.transitions:
+                    if t.animation in remap:
+                        t.animation = remap[t.animation]
+                        kept.append(t)
+                    elif self.index.animation(t.animation) is not None:
+                        kept.append(t)
+                    else:
+                        print(f"... dropping transition to missing event code {t.animation}")
+                anim.num_transitions = len(kept)
+                list.__setitem__(anim.transitions, slice(None), kept)
+                copies.append(anim)
+
+            added = {}
+            for old_code, new_code in remap.items():
+                for a, t in self.index.refs(old_code):
+                    added.setdefault(id(a), (a, []))[1].append(copy_transition(a.transitions, t, new_code))
+            for a, transitions in sorted(added.values(), key=lambda ref: self.index.animation_row(ref[0])):
+                append_transitions(changes, a, transitions)
+                print(f"... adding {len(transitions)} transitions for Animation {self.index.animation_row(a) + 1}")
+
+            append_animations(changes, copies)
+            print(f"... pasted {len(copies)} animations, event codes {codes[0]}-{codes[-1]}")
+
+        @create_handler
+        def handle_paste_transitions(changes, new_value, anim_idx, *args):
+            # new_value is a list of to_plain transitions; ones this animation
+            # already has a transition for, or whose target doesn't exist,
+            # are skipped
+            anim = self.uber.data.animations[anim_idx]
+            plains = json.loads(new_value) if isinstance(new_value, str) else new_value
+            present = {t.animation for t in anim.transitions}
+
+            transitions = []
+            for plain in plains:
+                target = plain["animation"]
+                if target == anim.event_code or target in present or self.index.animation(target) is None:
+                    print(f"... skipping transition to {target}")
+                    continue
+                present.add(target)
+                transitions.append(from_plain(ChangeSet.new_element(anim.transitions), plain))
+            append_transitions(changes, anim, transitions)
+
+        @create_handler
+        def handle_replace_kfm(changes, new_value, *args):
+            # new_value is to_plain of a whole Kfm, e.g. the result of a
+            # merge: the file fields are set and the animations replaced
+            data = self.uber.data
+            plain = json.loads(new_value) if isinstance(new_value, str) else new_value
+            for name, value in plain.items():
+                if name in ('num_animations', 'animations'):
+                    continue
+                # fields the Data has a property for are set through it, so
+                # listeners see the same object as for the other commands
+                target = data if isinstance(getattr(type(data), name, None), property) else data.kfm
+                if isinstance(getattr(target, name), bytes):
+                    value = value.encode("latin-1")
+                # the header string follows the version and can't be set
+                if getattr(target, name) != value:
+                    changes.set(target, name, value)
+
+            animations = data.animations
+            replacement = [from_plain(ChangeSet.new_element(animations), anim) for anim in plain["animations"]]
+            if len(animations):
+                changes.remove(animations, 0, len(animations))
+            changes.set(data, 'num_animations', len(replacement))
+            if replacement:
+                changes.insert(animations, 0, replacement)
+
+        self.command_handlers.update({
+            CommandType.EDIT_NIF_FILENAME: handle_nif_filename,
+            CommandType.EDIT_NUM_ANIMATIONS: handle_num_animations,
+            CommandType.EDIT_ANIMATION_KF_FILENAME: lambda *args: handle_animation('kf_file_name', *args),
+            CommandType.EDIT_ANIMATION_EVENT_CODE: handle_event_code,
+            CommandType.EDIT_ANIMATION_INDEX: lambda new_value, *args: handle_animation('index', int(new_value), *args),
+            CommandType.EDIT_NUM_TRANSITIONS: handle_num_transitions,
+            CommandType.EDIT_TRANSITION_ANIMATION: lambda new_value, *args: handle_transition_property('animation', int(new_value), *args),
+            CommandType.EDIT_TRANSITION_TYPE: lambda new_value, *args: handle_transition_property('type', int(new_value), *args),
+            CommandType.REMOVE_ANIMATION: handle_remove_animation,
+            CommandType.REMOVE_TRANSITION: handle_remove_transition,
+            CommandType.DUPLICATE_ANIMATIONS: handle_duplicate_animations,
+            CommandType.PASTE_ANIMATIONS: handle_paste_animations,
+            CommandType.PASTE_TRANSITIONS: handle_paste_transitions,
+            CommandType.REPLACE_KFM: handle_replace_kfm,
+        })
+
+    def clear(self):
+        self.index.rebuild(getattr(self.uber, 'data', None))
+        self.history = []
+        self.history_pointer = 0
+        self.history_cost = 0
+
+    def push(self, command, changes):
+        for _, dropped in self.history[self.history_pointer:]:
+            self.history_cost -= dropped.cost
+        self.history = self.history[:self.history_pointer]
+
+        self.history.append((command, changes))
+        self.history_pointer += 1
+        self.history_cost += changes.cost
+        self.generation += 1
+
+        if self.journal is not None:
+            self.journal.record(command, self.generation)
+
+        # always keep the latest entry, even if it alone exceeds the budget
+        while self.history_cost > self.history_budget and len(self.history) > 1:
+            _, dropped = self.history.pop(0)
+            self.history_cost -= dropped.cost
+            self.history_pointer -= 1
+
+    def snapshot(self):
+        # a command that recreates the current data
+        return Command(type=CommandType.REPLACE_KFM, new_value=to_plain(self.uber.data.kfm))
+
+    def new_changes(self):
+        return ChangeSet([self.index] + self.listeners)
+
+    def apply(self, command, changes):
+        # run the handler of command, recording into changes; the caller
+        # rolls back changes on failure
+        handler = self.command_handlers.get(command.type)
+        if handler is None:
+            print(f"Unknown command {command.type}")
+            return False
+
+        self.active_changes = changes
+        try:
+            handler(command.new_value, command.animation_index, command.transition_index)
+            return True
+        except CommandError as e:
+            print(e)
+            return False
+        except Exception:
+            print(traceback.format_exc())
+            return False
+        finally:
+            self.active_changes = None
+
+    def execute(self, command: Command) -> bool:
+        if self.transaction is not None:
+            changes, commands, failed = self.transaction
+            if failed:
+                return False
+            if not self.apply(command, changes):
+                changes.undo()
+                self.transaction = (changes, commands, True)
+                return False
+            commands.append(command)
+            return True
+
+        changes = self.new_changes()
+        success = self.apply(command, changes)
+        if not success:
+            changes.undo()
+        elif len(changes):
+            self.push(command, changes)
+            self.uber.unsaved_changes = True
+
+        self.uber.refresh_ui()
+
+        print()
+
+        return success
+
+    def begin_transaction(self):
+        # commands executed until the matching commit() are applied as one
+        # undo step with a single UI update; the first failing command rolls
+        # back all of them. Transactions nest, only the outermost commits.
+        self.transaction_depth += 1
+        if self.transaction is None:
+            self.transaction = (self.new_changes(), [], False)
+
+    def commit(self) -> bool:
+        self.transaction_depth -= 1
+        changes, commands, failed = self.transaction
+        if self.transaction_depth > 0:
+            return not failed
+
+        self.transaction = None
+        if not failed and len(changes):
+            self.push(commands, changes)
+            self.uber.unsaved_changes = True
+
+        self.uber.refresh_ui()
+
+        print()
+
+        return not failed
+
+    def rollback(self):
+        changes, commands, failed = self.transaction
+        if not failed:
+            changes.undo()
+            self.transaction = (changes, commands, True)
+        return self.commit()
+
+    def execute_many(self, commands) -> bool:
+        self.begin_transaction()
+        for command in commands:
+            if not self.execute(command):
+                break
+        return self.commit()
+
+    def undo(self):
+        if self.history_pointer > 0:
+            self.history_pointer -= 1
+            command, changes = self.history[self.history_pointer]
+            try:
+                changes.undo()
+                print(f"Undo {describe(command)}\n")
+            except Exception:
+                print(traceback.format_exc())
+
+            self.generation += 1
+            if self.journal is not None:
+                self.journal.record_undo(self.generation, self.snapshot)
+            self.uber.unsaved_changes = True
+            self.uber.refresh_ui()
+        
+    def redo(self):
+        if self.history_pointer < len(self.history):
+            command, changes = self.history[self.history_pointer]
+            self.history_pointer += 1
+            try:
+                changes.redo()
+                print(f"Redo {describe(command)}\n")
+            except Exception:
+                print(traceback.format_exc())
+
+            self.generation += 1
+            if self.journal is not None:
+                self.journal.record_redo(self.generation, self.snapshot)
+            self.uber.unsaved_changes = True
+            self.uber.refresh_ui()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+# Structural diff and three-way merge of KFM files.
+#
+# Animations are matched by event code and transitions by (source event
+# code, target event code); a code that occurs more than once gets the
+# occurrence number appended to its key. Each file is reduced to dicts of
+# plain records (see kfm_commands.to_plain) keyed that way, so matching is
+# one dict lookup per key however many transitions there are.
+
+import sys
+import argparse
+
+from dataclasses import dataclass, field
+from typing import Any, List
+
+from kfm_commands import to_plain, from_plain
+from kfm_io import kfm_format, read_kfm, write_kfm
+
+FILE = "file"
+ANIMATION = "animation"
+TRANSITION = "transition"
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+
+def describe_key(kind, key):
+    def code(key):
+        return f"{key[0]} #{key[1] + 1}" if isinstance(key, tuple) else str(key)
+    if kind == ANIMATION:
+        return f"Animation {code(key)}"
+    if kind == TRANSITION:
+        source, target = key[:2]
+        return f"Transition {code(source)} -> {target}" + (f" #{key[2] + 1}" if len(key) > 2 else "")
+    return key
+
+@dataclass
+class Change:
+    op: str
+    kind: str
+    key: Any
+    old: Any = None
+    new: Any = None
+
+    def fields(self):
+        # names of the fields that differ, for changed records
+        if isinstance(self.old, dict) and isinstance(self.new, dict):
+            return [name for name in self.new if self.old.get(name) != self.new[name]]
+        return []
+
+    def __str__(self):
+        text = f"{self.op:>7} {describe_key(self.kind, self.key)}"
+        if self.op == CHANGED:
+            if self.kind == FILE:
+                return f"{text}: {self.old!r} -> {self.new!r}"
+            return text + ": " + ", ".join(f"{name} {self.old.get(name)!r} -> {self.new[name]!r}" for name in self.fields())
+        return text
+
+@dataclass
+class Conflict:
+    kind: str
+    key: Any
+    base: Any
+    ours: Any
+    theirs: Any
+    # conflicting field names when both sides changed the same record
+    fields: List[str] = field(default_factory=list)
+
+    def __str__(self):
+        if self.ours is None or self.theirs is None:
+            side = "ours" if self.ours is None else "theirs"
+            return f"{describe_key(self.kind, self.key)}: removed in {side}, changed in the other"
+        if self.kind == FILE:
+            return f"{self.key}: ours {self.ours!r}, theirs {self.theirs!r}"
+        return f"{describe_key(self.kind, self.key)}: " + ", ".join(
+            f"{name} ours {self.ours.get(name)!r}, theirs {self.theirs.get(name)!r}" for name in self.fields)
+
+class Snapshot:
+    # the records of one file, keyed for matching; dicts keep file order
+    def __init__(self, data):
+        self.version = data.version
+        plain = to_plain(data.kfm)
+        animations = plain.pop("animations")
+        plain.pop("num_animations")
+
+        # file field name -> value
+        self.file = plain
+        # animation key -> fields without the transitions
+        self.animations = {}
+        # transition key -> fields
+        self.transitions = {}
+
+        for anim in animations:
+            key = self._key(self.animations, anim["event_code"])
+            transitions = anim.pop("transitions")
+            anim.pop("num_transitions")
+            self.animations[key] = anim
+            for t in transitions:
+                self.transitions[self._key(self.transitions, (key, t["animation"]))] = t
+
+    @staticmethod
+    def _key(table, key):
+        # the first occurrence is the plain key, later ones count up
+        if key not in table:
+            return key
+        n = 1
+        while (key + (n,) if isinstance(key, tuple) else (key, n)) in table:
+            n += 1
+        return key + (n,) if isinstance(key, tuple) else (key, n)
+
+    def tables(self):
+        return ((FILE, self.file), (ANIMATION, self.animations), (TRANSITION, self.transitions))
+
+    def to_data(self):
+        animations = []
+        by_source = {}
+        for key, t in self.transitions.items():
+            by_source.setdefault(key[0], []).append(t)
+        for key, anim in self.animations.items():
+            transitions = by_source.get(key, [])
+            animations.append(dict(anim, num_transitions=len(transitions), transitions=transitions))
+
+        data = kfm_format().Data(version=self.version)
+        from_plain(data.kfm, dict(self.file, num_animations=len(animations), animations=animations))
+        return data
+
+def snapshot(data):
+    return data if isinstance(data, Snapshot) else Snapshot(data)
+
+def diff(old, new):
+    # list of Change turning old into new (Data or Snapshot)
+    old, new = snapshot(old), snapshot(new)
+    changes = []
+    for (kind, old_table), (_, new_table) in zip(old.tables(), new.tables()):
+        for key, value in old_table.items():
+            if key not in new_table:
+                changes.append(Change(REMOVED, kind, key, old=value))
+            elif new_table[key] != value:
+                changes.append(Change(CHANGED, kind, key, old=value, new=new_table[key]))
+        for key, value in new_table.items():
+            if key not in old_table:
+                changes.append(Change(ADDED, kind, key, new=value))
+    return changes
+
+def _merge_record(base, ours, theirs):
+    # (merged, conflicting field names)
+    if ours == theirs:
+        return ours, []
+    if ours == base:
+        return theirs, []
+    if theirs == base:
+        return ours, []
+    if not isinstance(ours, dict) or not isinstance(theirs, dict):
+        return ours, [None]
+
+    base = base or {}
+    merged = {}
+    conflicts = []
+    for name in ours:
+        value, fields = _merge_record(base.get(name), ours[name], theirs.get(name))
+        merged[name] = value
+        if fields:
+            conflicts.append(name)
+    return merged, conflicts
+
+def merge(base, ours, theirs):
+    # three-way merge: (merged Snapshot, list of Conflict). Changes made on
+    # one side only are taken, conflicting records keep ours.
+    base, ours, theirs = snapshot(base), snapshot(ours), snapshot(theirs)
+    merged = Snapshot.__new__(Snapshot)
+    merged.version = ours.version
+    conflicts = []
+
+    results = []
+    for (kind, base_table), (_, ours_table), (_, theirs_table) in zip(base.tables(), ours.tables(), theirs.tables()):
+        result = {}
+        # ours order first, then what only theirs has
+        for key in list(ours_table) + [key for key in theirs_table if key not in ours_table]:
+            b, o, t = base_table.get(key), ours_table.get(key), theirs_table.get(key)
+            value, fields = _merge_record(b, o, t)
+            if fields:
+                conflicts.append(Conflict(kind, key, b, o, t, fields=[name for name in fields if name is not None]))
+            if value is not None:
+                result[key] = value
+        results.append(result)
+
+    merged.file, merged.animations, merged.transitions = results
+    # transitions of removed animations go with them
+    merged.transitions = {key: t for key, t in merged.transitions.items() if key[0] in merged.animations}
+    return merged, conflicts
+
+def locate(data, kind, key):
+    # (found, (animation index, transition index)) of a keyed record in
+    # data; the indices are None where they don't apply, and both are when
+    # data doesn't have the record
+    missing = False, (None, None)
+    if kind == FILE:
+        return True, (None, None)
+    source = key if kind == ANIMATION else key[0]
+    code, n = source if isinstance(source, tuple) else (source, 0)
+    rows = [row for row, anim in enumerate(data.animations) if anim.event_code == code]
+    if n >= len(rows):
+        return missing
+    if kind == ANIMATION:
+        return True, (rows[n], None)
+    target, m = key[1], key[2] if len(key) > 2 else 0
+    found = [i for i, t in enumerate(data.animations[rows[n]].transitions) if t.animation == target]
+    return (True, (rows[n], found[m])) if m < len(found) else missing
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kfm_editor.py --diff", description="Compare two KFM files, or merge three (base, ours, theirs).")
+    parser.add_argument("files", nargs="+", help="OLD NEW to diff, or BASE OURS THEIRS to merge")
+    parser.add_argument("-o", "--output", help="merge result (default: overwrite OURS, as a git merge driver expects)")
+    args = parser.parse_args(argv)
+
+    if len(args.files) == 2:
+        changes = diff(read_kfm(args.files[0]), read_kfm(args.files[1]))
+        for change in changes:
+            print(change)
+        return 1 if changes else 0
+
+    if len(args.files) != 3:
+        parser.error("expected two files to diff or three to merge")
+
+    base, ours, theirs = (read_kfm(filename) for filename in args.files)
+    merged, conflicts = merge(base, ours, theirs)
+    write_kfm(merged.to_data(), args.output or args.files[1])
+    for conflict in conflicts:
+        print("conflict:", conflict)
+    return 1 if conflicts else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,357 +1,846 @@
 #!/usr/bin/env python
 
+import time
+
+# (phase, end time) for --profile-startup
+startup_marks = [("start", time.perf_counter())]
+
+def startup_mark(phase):
+    startup_marks.append((phase, time.perf_counter()))
+
+def startup_report():
+    lines = [f"{phase:<28}{(end - start) * 1000:8.1f} ms" for (_, start), (phase, end) in zip(startup_marks, startup_marks[1:])]
+    lines.append(f"{'total':<28}{(startup_marks[-1][1] - startup_marks[0][1]) * 1000:8.1f} ms")
+    return "\n".join(lines)
+
 import sys
 import os
-import io
+import logging
+import threading
+import collections
+import json
+import array
 
 import traceback
 
-from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QFileDialog, QTabWidget, QMenuBar, QMenu, QAction, QTreeWidget, QTreeWidgetItem,
-                             QVBoxLayout, QHBoxLayout, QWidget, QPlainTextEdit, QLineEdit, QLabel, QMessageBox, QToolBar, QFormLayout, QSizePolicy, QOpenGLWidget, QHeaderView, QShortcut, QTreeWidgetItemIterator)
-from PyQt5.QtGui import (QFont, QKeySequence)
+# command line modes -> module whose main() runs them; they don't need Qt
+CLI_MODES = {
+    '--batch': 'kfm_batch',
+    '--index': 'kfm_index',
+    '--resolve': 'kfm_resolve',
+    '--text': 'kfm_text',
+    '--diff': 'kfm_diff',
+}
 
-from PyQt5.QtCore import Qt
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+
+    # dispatched before PyQt5 is imported; the module runs as __main__, so
+    # pool workers started with spawn re-import it rather than this file
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_MODES:
+        import runpy
+        mode = sys.argv.pop(1)
+        runpy.run_module(CLI_MODES[mode], run_name='__main__', alter_sys=True)
+        sys.exit()
+
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QFileDialog, QTabWidget, QMenuBar, QMenu, QAction, QTreeView,
+                             QVBoxLayout, QHBoxLayout, QWidget, QPlainTextEdit, QLineEdit, QLabel, QMessageBox, QToolBar, QFormLayout, QSizePolicy, QOpenGLWidget, QHeaderView, QShortcut, QProgressBar, QAbstractItemView, QInputDialog, QTableView, QListWidget)
+from PyQt5.QtGui import (QFont, QKeySequence, QTextCursor, QColor, QBrush)
+
+from PyQt5.QtCore import Qt, QAbstractItemModel, QAbstractTableModel, QModelIndex, QObject, QTimer, QThread, pyqtSignal
 from PyQt5 import QtCore
 
+startup_mark("import PyQt5")
 
-from dataclasses import dataclass
-from typing import Any, Optional
-from enum import Enum
+from kfm_commands import CommandType, Command, CommandManager, ChangeListener, parse_search, to_plain, replace_commands
+from kfm_batch import KfmDocument, find_kfm_files
+import kfm_io
+import kfm_journal
+import kfm_diff
+import kfm_resolve
+import kfm_preview
 
-from our_pyffi.pyffi.formats.kfm import KfmFormat
+startup_mark("import editor modules")
 
-vertical_scroll_before_clear = None
+class ConsoleSink(QObject):
+    # stdout replacement for the console text box: writes are buffered and
+    # flushed to the widget by a coalescing timer, and both the buffer and the
+    # widget keep only the last max_lines lines
+    wake = pyqtSignal()
 
-class TextBoxWriter:
-    def __init__(self, text_box):
+    def __init__(self, text_box, max_lines=5000, interval=50, level=logging.INFO, echo=False):
+        super().__init__()
         self.text_box = text_box
+        self.text_box.setMaximumBlockCount(max_lines)
+        self.max_lines = max_lines
+        self.level = level
+        self.echo = echo
+
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.pending_lines = 0
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush_to_widget)
+        self.wake.connect(self.timer.start)
+
+        self.handler = ConsoleLogHandler(self)
+
+    def write(self, text, level=logging.INFO):
+        if level < self.level or not text:
+            return
+        if self.echo:
+            sys.stderr.write(text)
+        with self.lock:
+            schedule = not self.pending
+            self.pending.append(text)
+            self.pending_lines += text.count("\n")
+            while self.pending_lines > self.max_lines and len(self.pending) > 1:
+                self.pending_lines -= self.pending.popleft().count("\n")
+        if schedule:
+            self.wake.emit()
+
+    def log(self, level, text):
+        self.write(f"{logging.getLevelName(level)}: {text}\n" if level > logging.INFO else f"{text}\n", level)
 
-    def write(self, text):
-        self.text_box.insertPlainText(text)
-        if vertical_scroll_before_clear is not None:
-            self.text_box.verticalScrollBar().setValue(vertical_scroll_before_clear) 
-        sys.stderr.write(text)
     def flush(self):
         pass
 
-class CommandType(Enum):
-    EDIT_NIF_FILENAME = "edit_nif_filename"
-    EDIT_NUM_ANIMATIONS = "edit_num_animations" 
-    
-    EDIT_ANIMATION_KF_FILENAME = "edit_animation_kf_filename"
-    EDIT_ANIMATION_EVENT_CODE = "edit_animation_event_code"
-    EDIT_ANIMATION_INDEX = "edit_animation_index"
-
-    REMOVE_ANIMATION = "remove_animation"
-    REMOVE_TRANSITION = "remove_transition"
-    
-    EDIT_NUM_TRANSITIONS = "edit_num_transitions"
-    
-    EDIT_TRANSITION_ANIMATION = "edit_transition_animation"
-    EDIT_TRANSITION_TYPE = "edit_transition_type"
-
-@dataclass
-class Command:
-    type: CommandType
-    new_value: Any = None
-    animation_index: Optional[int] = None
-    transition_index: Optional[int] = None
-
-    def __str__(self):
-        return f"{self.type.value} : {self.new_value}"
-    
-class CommandManager:
-    def __init__(self, uber, max_history=100):
-        self.uber = uber
-
-        self.history = []
-        self.history_pointer = 0
-
-        self.max_history = max_history
-        self.command_handlers = {}
-
-        def create_handler(func):
-            def wrapper(*args):
-                try:
-                    func(*args)
-                    return True
-                except Exception:
-                    print(traceback.format_exc())
-                    return False
-            return wrapper
-
-        @create_handler
-        def handle_nif_filename(new_value, *args):
-            self.uber.data.nif_file_name = new_value
-
-        @create_handler
-        def handle_num_animations(new_value, *args):
-            old_value = self.uber.data.num_animations
-            new_value = int(new_value)
-
-            self.uber.data.num_animations = new_value
-            self.uber.data.animations.update_size()
-
-            event_codes = set()
-            for a in self.uber.data.animations:
-                event_codes.add(a.event_code)
-
-            next_anim = max(event_codes) + 1
-
-            added_codes = set()
-
-            if old_value < new_value:
-                for i in range(old_value, new_value):
-                    self.uber.data.animations[i].event_code = next_anim
-                    
-                    self.uber.data.animations[i].num_transitions = old_value
-                    self.uber.data.animations[i].transitions.update_size()
+    def flush_to_widget(self):
+        with self.lock:
+            text = "".join(self.pending)
+            self.pending.clear()
+            self.pending_lines = 0
+        if not text:
+            return
 
-                    it = 0
-                    for j in range(old_value):
-                        if i != j:
-                            self.uber.data.animations[i].transitions[it].animation = self.uber.data.animations[j].event_code
-                            self.uber.data.animations[i].transitions[it].type = 5
-                        it += 1
-
-                    added_codes.add(next_anim)
-                    print(f"\n Next animation event code {next_anim}")
-                    print("... adding transition to every other animation.\n")
-
-                    next_anim += 1
+        scrollbar = self.text_box.verticalScrollBar()
+        at_bottom = scrollbar.value() == scrollbar.maximum()
+        scroll_pos = scrollbar.value()
 
-            for at, a in enumerate(self.uber.data.animations):
-                local = list(added_codes - set([a.event_code]))
+        cursor = self.text_box.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
 
-                old_count = a.num_transitions
-                a.num_transitions += len(local)
-                a.transitions.update_size()
+        scrollbar.setValue(scrollbar.maximum() if at_bottom else scroll_pos)
 
-                for ii, i in enumerate(range(old_count, old_count + len(local))):
-                    a.transitions[i].animation = local[ii]
-                    a.transitions[i].type = 5
-                    print(f"... adding transition to {local[ii]} for Animation {at + 1}")
+class ConsoleLogHandler(logging.Handler):
+    # routes logging records (e.g. pyffi warnings) into the console
+    def __init__(self, sink):
+        super().__init__()
+        self.sink = sink
 
+    def emit(self, record):
+        try:
+            self.sink.log(record.levelno, self.format(record))
+        except Exception:
+            self.handleError(record)
 
-        @create_handler
-        def handle_animation(prop, new_value, anim_idx, *args):
-            setattr(self.uber.data.animations[anim_idx], prop, new_value)
+class IoTask(QThread):
+    # runs a kfm_io function off the GUI thread; func gets a progress
+    # callback which raises kfm_io.Cancelled once cancel() was called
+    progress = pyqtSignal(int, int)
 
-        @create_handler
-        def handle_event_code(new_value, anim_idx, *args):
-            anim = self.uber.data.animations[anim_idx]
+    def __init__(self, description, func, *args):
+        super().__init__()
+        self.description = description
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, progress=self.report)
+        except kfm_io.Cancelled:
+            self.error = "cancelled"
+        except Exception:
+            self.error = traceback.format_exc()
+
+    def report(self, done, total):
+        if self.cancelled:
+            raise kfm_io.Cancelled()
+        self.progress.emit(done, total)
+
+    def cancel(self):
+        self.cancelled = True
+
+class TreeNode:
+    # a row of the tree that has children; the internal pointer of every
+    # model index is the node of its parent row
+    ROOT = 0
+    ANIMATIONS = 1
+    ANIMATION = 2
+    TRANSITIONS = 3
+    TRANSITION = 4
+
+    __slots__ = ('kind', 'obj', 'parent', 'fetched')
+
+    def __init__(self, kind, obj=None, parent=None):
+        self.kind = kind
+        self.obj = obj
+        self.parent = parent
+        self.fetched = kind not in (TreeNode.ANIMATIONS, TreeNode.TRANSITIONS)
+
+class KfmTreeModel(QAbstractItemModel):
+    # (name, type, attribute) rows of each node kind
+    ROOT_FIELDS = [
+        ("Header String", "HeaderString", None),
+        ("NIF File Name", "SizedString", "nif_file_name"),
+        ("Num Animations", "int", "num_animations"),
+        ("Animations", "Animation[]", None),
+    ]
+    ANIMATION_FIELDS = [
+        ("KF File Name", "SizedString", "kf_file_name"),
+        ("Event Code", "int", "event_code"),
+        ("Index", "int", "index"),
+        ("Num Transitions", "int", "num_transitions"),
+        ("Transitions", "Transitions[]", None),
+    ]
+    TRANSITION_FIELDS = [
+        ("Animation", "int", "animation"),
+        ("Type", "int", "type"),
+    ]
+    ANIMATIONS_ROW = 3
+    TRANSITIONS_ROW = 4
+
+    REFERENCE_COLORS = {
+        kfm_resolve.MISSING: QColor(200, 0, 0),
+        kfm_resolve.AMBIGUOUS: QColor(200, 120, 0),
+    }
+
+    FIELD_COMMANDS = {
+        "nif_file_name": CommandType.EDIT_NIF_FILENAME,
+        "num_animations": CommandType.EDIT_NUM_ANIMATIONS,
+        "kf_file_name": CommandType.EDIT_ANIMATION_KF_FILENAME,
+        "event_code": CommandType.EDIT_ANIMATION_EVENT_CODE,
+        "index": CommandType.EDIT_ANIMATION_INDEX,
+        "num_transitions": CommandType.EDIT_NUM_TRANSITIONS,
+        "animation": CommandType.EDIT_TRANSITION_ANIMATION,
+        "type": CommandType.EDIT_TRANSITION_TYPE,
+    }
 
-            new_value = int(new_value)
-            
-            for ia, a in enumerate(self.uber.data.animations):
-                if new_value == a.event_code:
-                    print(f"Event code already used by Animation {ia + 1}")
-                    return
-
-            old_value = anim.event_code
-            anim.event_code = int(new_value)
-
-            for ia, a in enumerate(self.uber.data.animations):
-                for it, t in enumerate(a.transitions):
-                    if t.animation == old_value:
-                        t.animation = new_value
-                        print(f"... updating transition for Animation {ia + 1}, event code {old_value} -> {new_value}")
-            
-        @create_handler
-        def handle_num_transitions(new_value, anim_idx, *args):
-            self.uber.data.animations[anim_idx].num_transitions = int(new_value)
-            self.uber.data.animations[anim_idx].transitions.update_size()
-
-        @create_handler
-        def handle_transition_property(prop, new_value, anim_idx, transition_index):
-            if prop == 'animation':
-                found = False
-                for ia, a in enumerate(self.uber.data.animations):
-                    if new_value == a.event_code:
-                        found = True
-                if not found:
-                    print(f"Can't find animation with event code {new_value}")
-                    return
-            
-            setattr(self.uber.data.animations[anim_idx].transitions[transition_index], prop, new_value)
-
-        @create_handler
-        def handle_remove_animation(_, anim_idx, *args):
-            anim = self.uber.data.animations[anim_idx]
-            event_code = anim.event_code
-
-            for i in range(anim_idx, self.uber.data.num_animations-1):
-                a1, a2 = self.uber.data.animations[i], self.uber.data.animations[i+1]
-                a1.kf_file_name = a2.kf_file_name
-                a1.event_code = a2.event_code
-                a1.index = a2.index
-                a1.num_transitions = a2.num_transitions
-                a1.transitions.update_size()
-                for j in range(a1.num_transitions):
-                    a1.transitions[j].animation = a2.transitions[j].animation
-                    a1.transitions[j].type = a2.transitions[j].type
-
-
-            self.uber.data.num_animations -= 1
-            self.uber.data.animations.update_size()
-
-            for ia, a in enumerate(self.uber.data.animations):
-                for it, t in enumerate(a.transitions):
-                    if t.animation == event_code:
-                        for i in range(it, len(a.transitions)-1):
-                            t1, t2 = a.transitions[i], a.transitions[i+1]
-                            t1.animation = t2.animation
-                            t1.type = t2.type
-
-                        a.num_transitions -= 1
-                        a.transitions.update_size()
-
-                        print(f"... removing transition for Animation {ia + 1}")
-
-                        break
-
-        @create_handler
-        def handle_remove_transition(_, anim_idx, transition_index):
-            anim = self.uber.data.animations[anim_idx]
-
-            for i in range(transition_index, anim.num_transitions-1):
-                t1, t2 = anim.transitions[i], anim.transitions[i+1]
-                t1.animation = t2.animation
-                t1.type = t2.type
-
-            anim.num_transitions -= 1
-            anim.transitions.update_size()
-
-        self.command_handlers.update({
-            CommandType.EDIT_NIF_FILENAME: handle_nif_filename,
-            CommandType.EDIT_NUM_ANIMATIONS: handle_num_animations,
-            CommandType.EDIT_ANIMATION_KF_FILENAME: lambda *args: handle_animation('kf_file_name', *args),
-            CommandType.EDIT_ANIMATION_EVENT_CODE: handle_event_code,
-            CommandType.EDIT_ANIMATION_INDEX: lambda new_value, *args: handle_animation('index', int(new_value), *args),
-            CommandType.EDIT_NUM_TRANSITIONS: handle_num_transitions,
-            CommandType.EDIT_TRANSITION_ANIMATION: lambda new_value, *args: handle_transition_property('animation', int(new_value), *args),
-            CommandType.EDIT_TRANSITION_TYPE: lambda new_value, *args: handle_transition_property('type', int(new_value), *args),
-            CommandType.REMOVE_ANIMATION: handle_remove_animation,
-            CommandType.REMOVE_TRANSITION: handle_remove_transition,
-        })
-
-    def execute(self, command: Command) -> bool:
-        if command.type not in self.command_handlers:
+    def __init__(self, uber):
+        super().__init__()
+        self.uber = uber
+        self.data_ = None
+        self.reset_data(None)
+
+    def reset_data(self, data):
+        self.beginResetModel()
+        self.data_ = data
+        self.root = TreeNode(TreeNode.ROOT, data)
+        self.animations_node = TreeNode(TreeNode.ANIMATIONS, data, self.root)
+        # struct id -> node, and array id -> {element id: row}; entries of
+        # removed structs are dropped with them, see forget()
+        self.nodes = {}
+        self.rows = {}
+        self.pending = None
+        self.removed = []
+        self.endResetModel()
+
+    # node helpers
+
+    def fields(self, node):
+        if node.kind == TreeNode.ROOT:
+            return self.ROOT_FIELDS
+        elif node.kind == TreeNode.ANIMATION:
+            return self.ANIMATION_FIELDS
+        elif node.kind == TreeNode.TRANSITION:
+            return self.TRANSITION_FIELDS
+        return None
+
+    def array(self, node):
+        if node.kind == TreeNode.ANIMATIONS:
+            return self.data_.animations
+        elif node.kind == TreeNode.TRANSITIONS:
+            return node.obj.transitions
+        return None
+
+    def node_for_key(self, kind, obj, parent):
+        key = (kind, id(obj))
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = TreeNode(kind, obj, parent)
+        return node
+
+    def child_node(self, node, row):
+        if node.kind == TreeNode.ROOT:
+            return self.animations_node if row == self.ANIMATIONS_ROW else None
+        elif node.kind == TreeNode.ANIMATIONS:
+            return self.node_for_key(TreeNode.ANIMATION, self.data_.animations[row], node)
+        elif node.kind == TreeNode.ANIMATION:
+            return self.node_for_key(TreeNode.TRANSITIONS, node.obj, node) if row == self.TRANSITIONS_ROW else None
+        elif node.kind == TreeNode.TRANSITIONS:
+            return self.node_for_key(TreeNode.TRANSITION, node.obj.transitions[row], node)
+        return None
+
+    def row_in(self, array, obj):
+        rows = self.rows.get(id(array))
+        if rows is None:
+            rows = self.rows[id(array)] = {id(e): i for i, e in enumerate(list.__iter__(array))}
+        return rows[id(obj)]
+
+    def node_row(self, node):
+        if node.kind == TreeNode.ANIMATIONS:
+            return self.ANIMATIONS_ROW
+        elif node.kind == TreeNode.TRANSITIONS:
+            return self.TRANSITIONS_ROW
+        return self.row_in(self.array(node.parent), node.obj)
+
+    def node_index(self, node):
+        if node.kind == TreeNode.ROOT:
+            return QModelIndex()
+        return self.createIndex(self.node_row(node), 0, node.parent)
+
+    def node_of(self, index):
+        # the node of the row at index (None for leaves)
+        if not index.isValid():
+            return self.root
+        return self.child_node(index.internalPointer(), index.row())
+
+    def field(self, index):
+        fields = self.fields(index.internalPointer())
+        return fields[index.row()] if fields else None
+
+    def animation_index_of(self, node):
+        while node.kind != TreeNode.ANIMATION:
+            node = node.parent
+        return self.node_row(node)
+
+    # QAbstractItemModel
+
+    def index(self, row, column, parent=QModelIndex()):
+        if self.data_ is None or not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        node = self.node_of(parent)
+        return self.createIndex(row, column, node)
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self.node_index(index.internalPointer())
+
+    def rowCount(self, parent=QModelIndex()):
+        if self.data_ is None or parent.column() > 0:
+            return 0
+        node = self.node_of(parent)
+        if node is None or not node.fetched:
+            return 0
+        array = self.array(node)
+        return len(array) if array is not None else len(self.fields(node))
+
+    def columnCount(self, parent=QModelIndex()):
+        return 3
+
+    def hasChildren(self, parent=QModelIndex()):
+        if self.data_ is None or parent.column() > 0:
             return False
-        
-        handler = self.command_handlers[command.type]
-        success = handler(command.new_value, command.animation_index, command.transition_index)
-
-        if success:
-            data = io.BytesIO()
-            console_text = self.uber.console_text_box.toPlainText()
-            self.uber.data.write(data)
-
-            self.history = self.history[:self.history_pointer+1]
-            self.history.append((command, data, console_text))
-
-            self.history_pointer += 1
-
-            if len(self.history) > self.max_history:
-                self.history.pop(0)
-                self.history_pointer -= 1
+        node = self.node_of(parent)
+        if node is None:
+            return False
+        array = self.array(node)
+        return len(array) > 0 if array is not None else True
+
+    def canFetchMore(self, parent):
+        node = self.node_of(parent) if self.data_ is not None else None
+        return node is not None and not node.fetched and len(self.array(node)) > 0
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        node = self.node_of(parent)
+        count = len(self.array(node))
+        self.beginInsertRows(parent, 0, count - 1)
+        node.fetched = True
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return ["Name", "Type", "Value"][section]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        field = self.field(index)
+        if index.column() == 2 and field and field[2]:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        parent = index.internalPointer()
+        if parent.kind == TreeNode.ANIMATIONS and index.column() == 2 and role in (Qt.DisplayRole, Qt.ToolTipRole):
+            return self.sequence_preview(index, role)
+        if role in (Qt.ForegroundRole, Qt.ToolTipRole):
+            return self.reference_status(index, role)
+        if role not in (Qt.DisplayRole, Qt.EditRole):
+            return None
+        column = index.column()
+        field = self.field(index)
+        if field is None:
+            # element of an array
+            if parent.kind == TreeNode.ANIMATIONS:
+                return [f"Animation {index.row() + 1}", "Animation", ""][column]
+            return [f"Transition {index.row() + 1}", "Transition", ""][column]
+        if column < 2:
+            return field[column]
+        if parent.kind == TreeNode.ROOT and index.row() == 0:
+            return kfm_io.kfm_format().HeaderString.version_string(self.data_.version)
+        if field[2] is None:
+            return ""
+        value = getattr(parent.obj, field[2])
+        return value.decode("ascii") if isinstance(value, bytes) else str(value)
+
+    def reference_status(self, index, role):
+        # colour and tooltip of NIF/KF names that don't resolve against the
+        # asset roots; resolving is a dict lookup, so it is done per paint
+        field = self.field(index)
+        if index.column() != 2 or field is None or field[2] not in kfm_resolve.FIELD_NAMES:
+            return None
+        resolution = self.uber.resolve(getattr(index.internalPointer().obj, field[2]))
+        if resolution is None:
+            return None
+        if role == Qt.ToolTipRole:
+            return str(resolution)
+        if resolution.status != kfm_resolve.RESOLVED:
+            return QBrush(self.REFERENCE_COLORS[resolution.status])
+        return None
+
+    def sequence_preview(self, index, role):
+        # NiControllerSequence of the animation's KF, read in the background
+        # the first time the row is painted
+        info = self.uber.preview(self.data_.animations[index.row()].kf_file_name)
+        if info is None:
+            return "..." if role == Qt.DisplayRole else None
+        return str(info) if role == Qt.DisplayRole else info.details()
+
+    def previews_loaded(self):
+        # the previews show in the value column of the animation rows
+        if self.data_ is not None and self.animations_node.fetched and len(self.data_.animations):
+            parent = self.node_index(self.animations_node)
+            self.dataChanged.emit(self.index(0, 2, parent), self.index(len(self.data_.animations) - 1, 2, parent), [Qt.DisplayRole])
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or index.column() != 2:
+            return False
+        field = self.field(index)
+        if field is None or field[2] is None:
+            return False
+        return self.uber.command_manager.execute(self.edit_command(index, field[2], value))
+
+    def target(self, index):
+        # (animation index, transition index) of the animation/transition
+        # the row at index is or belongs to
+        parent = index.internalPointer()
+        if parent.kind == TreeNode.ANIMATIONS:
+            return index.row(), None
+        elif parent.kind == TreeNode.ANIMATION:
+            return self.node_row(parent), None
+        elif parent.kind == TreeNode.TRANSITIONS:
+            return self.animation_index_of(parent), index.row()
+        elif parent.kind == TreeNode.TRANSITION:
+            return self.animation_index_of(parent), self.node_row(parent)
+        return None, None
+
+    def edit_command(self, index, attr, value):
+        animation_index, transition_index = self.target(index)
+        return Command(
+            type=self.FIELD_COMMANDS[attr],
+            new_value=value,
+            animation_index=animation_index,
+            transition_index=transition_index
+        )
+
+    def selection_field(self, indexes):
+        # the field shared by the selected rows: (attr, element kind) when
+        # all are leaves of the same field, (None, kind) when all are
+        # animation or transition rows of the same kind, else None
+        fields = set()
+        for index in indexes:
+            parent = index.internalPointer()
+            if parent.kind in (TreeNode.ANIMATIONS, TreeNode.TRANSITIONS):
+                fields.add((None, parent.kind))
+            else:
+                field = self.field(index)
+                if field is None or field[2] is None:
+                    return None
+                fields.add((field[2], parent.kind))
+        return fields.pop() if len(fields) == 1 else None
+
+    # ChangeListener
+
+    def array_node(self, array):
+        if array is self.data_.animations:
+            return self.animations_node
+        anim_node = self.nodes.get((TreeNode.ANIMATION, id(array._parent())))
+        if anim_node is None:
+            return None
+        return self.nodes.get((TreeNode.TRANSITIONS, id(anim_node.obj)))
+
+    def begin_insert(self, array, index, count):
+        node = self.array_node(array)
+        self.pending = None
+        if node is not None and node.fetched:
+            self.pending = node
+            self.beginInsertRows(self.node_index(node), index, index + count - 1)
+
+    def end_insert(self, array, index, count):
+        self.rows.pop(id(array), None)
+        if self.pending is not None:
+            node, self.pending = self.pending, None
+            self.endInsertRows()
+            self.relabel(node, array)
+
+    def begin_remove(self, array, index, count):
+        node = self.array_node(array)
+        self.removed = list.__getitem__(array, slice(index, index + count))
+        self.pending = None
+        if node is not None and node.fetched:
+            self.pending = node
+            self.beginRemoveRows(self.node_index(node), index, index + count - 1)
+
+    def end_remove(self, array, index, count):
+        self.rows.pop(id(array), None)
+        if self.pending is not None:
+            node, self.pending = self.pending, None
+            self.endRemoveRows()
+            self.relabel(node, array)
+        removed, self.removed = self.removed, []
+        self.forget(removed)
+
+    def forget(self, elements):
+        # drops the nodes of removed animations or transitions, which would
+        # otherwise keep them alive; an undo that puts them back gets new
+        # nodes
+        for obj in elements:
+            for kind in (TreeNode.ANIMATION, TreeNode.TRANSITIONS, TreeNode.TRANSITION):
+                self.nodes.pop((kind, id(obj)), None)
+            transitions = getattr(obj, "transitions", None)
+            if transitions is not None:
+                self.rows.pop(id(transitions), None)
+                self.forget(transitions)
+
+    def relabel(self, node, array):
+        # rows are titled by position, so the ones after an insert/remove move
+        if len(array):
+            parent = self.node_index(node)
+            self.dataChanged.emit(self.index(0, 0, parent), self.index(len(array) - 1, 0, parent), [Qt.DisplayRole])
+
+    def changed(self, obj, name, old_value, new_value):
+        if obj is self.data_:
+            node = self.root
         else:
-            data.seek(0)
-            self.uber.data.read(data)
+            node = self.nodes.get((TreeNode.ANIMATION, id(obj))) or self.nodes.get((TreeNode.TRANSITION, id(obj)))
+            if node is None:
+                return
+        for row, field in enumerate(self.fields(node)):
+            if field[2] == name:
+                index = self.createIndex(row, 2, node)
+                self.dataChanged.emit(index, index, [Qt.DisplayRole])
+        if name == "kf_file_name" and node.parent.fetched:
+            index = self.createIndex(self.node_row(node), 2, node.parent)
+            self.dataChanged.emit(index, index, [Qt.DisplayRole])
+
+class TransitionMatrixModel(QAbstractTableModel, ChangeListener):
+    # source animation x target event code grid of transition types. The
+    # types live in a flat row-major array (NONE where there is no
+    # transition) so the view only reads the cells it paints. Edits mark the
+    # rows of the animations they touch dirty, refresh() recomputes just
+    # those, and changes to the animations or event codes rebuild the grid.
+    NONE = -1
 
+    def __init__(self, uber):
+        super().__init__()
+        self.uber = uber
+        self.reset_data(None)
+
+    def reset_data(self, data):
+        # the grid itself is built by the first refresh()
+        self.rebuild(None)
+        self.data_ = data
+        self.stale = data is not None
+
+    def rebuild(self, data):
+        self.beginResetModel()
+        self.data_ = data
+        self.animations = list(data.animations) if data is not None else []
+        # targets that no animation has are still columns, so dangling
+        # transitions show up
+        codes = {anim.event_code for anim in self.animations}
+        for anim in self.animations:
+            codes.update(t.animation for t in anim.transitions)
+        self.codes = sorted(codes)
+        self.columns = {code: column for column, code in enumerate(self.codes)}
+        self.existing = {anim.event_code: anim for anim in reversed(self.animations)}
+
+        self.cells = array.array('i', [self.NONE]) * (len(self.animations) * len(self.codes))
+        for row, anim in enumerate(self.animations):
+            self.fill_row(row, anim)
+        self.dirty = {}
+        self.stale = False
+        self.endResetModel()
+
+    def fill_row(self, row, anim):
+        # False if a transition targets a code that has no column yet
+        width = len(self.codes)
+        start = row * width
+        self.cells[start:start + width] = array.array('i', [self.NONE]) * width
+        for t in anim.transitions:
+            column = self.columns.get(t.animation)
+            if column is None:
+                return False
+            if self.cells[start + column] == self.NONE:
+                self.cells[start + column] = t.type
+        return True
+
+    def refresh(self, data):
+        if not self.stale and len(self.dirty) * 4 < len(self.animations):
+            index = self.uber.command_manager.index
+            dirty, self.dirty = self.dirty, {}
+            for anim in dirty.values():
+                row = index.animation_row(anim)
+                if not self.fill_row(row, anim):
+                    break
+                self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.codes) - 1), [Qt.DisplayRole])
+            else:
+                return
+        self.rebuild(data)
+
+    def transition(self, row, column):
+        # (transition index, transition) shown in a cell, (None, None) if empty
+        code = self.codes[column]
+        for i, t in enumerate(self.animations[row].transitions):
+            if t.animation == code:
+                return i, t
+        return None, None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.animations)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.codes)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole:
+            if orientation == Qt.Horizontal:
+                code = self.codes[section]
+                return str(code) if code in self.existing else f"{code}?"
+            anim = self.animations[section]
+            return f"{section + 1}: {anim.event_code}"
+        if role == Qt.ToolTipRole:
+            if orientation == Qt.Horizontal:
+                anim = self.existing.get(self.codes[section])
+                return anim.kf_file_name.decode("ascii") if anim is not None else "No animation has this event code"
+            return self.animations[section].kf_file_name.decode("ascii")
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        value = self.cells[index.row() * len(self.codes) + index.column()]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return "" if value == self.NONE else str(value)
+        if role == Qt.ToolTipRole and value != self.NONE:
+            return f"Animation {index.row() + 1} -> {self.codes[index.column()]}: type {value}"
+        if role == Qt.BackgroundRole and value != self.NONE:
+            return QBrush(QColor(200, 225, 255))
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignCenter
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        # a type edits the cell's transition or adds one, an empty cell
+        # removes it
+        if role != Qt.EditRole or not index.isValid():
+            return False
+        value = str(value).strip()
+        row = index.row()
+        transition_index, t = self.transition(row, index.column())
+        manager = self.uber.command_manager
+
+        if t is not None:
+            if not value:
+                return manager.execute(Command(type=CommandType.REMOVE_TRANSITION, animation_index=row, transition_index=transition_index))
+            return manager.execute(Command(type=CommandType.EDIT_TRANSITION_TYPE, new_value=value, animation_index=row, transition_index=transition_index))
+        if not value:
+            return False
 
-        self.uber.unsaved_changes = True
-
-        self.uber.refresh_ui(command.animation_index if command.type == CommandType.REMOVE_ANIMATION else None, command.transition_index if command.type == CommandType.REMOVE_TRANSITION else None)
+        count = len(self.animations[row].transitions)
+        return manager.execute_many([
+            Command(type=CommandType.EDIT_NUM_TRANSITIONS, new_value=count + 1, animation_index=row),
+            Command(type=CommandType.EDIT_TRANSITION_ANIMATION, new_value=self.codes[index.column()], animation_index=row, transition_index=count),
+            Command(type=CommandType.EDIT_TRANSITION_TYPE, new_value=value, animation_index=row, transition_index=count),
+        ])
 
-        print()
+    # ChangeListener
 
-        return success
-        
-    def reread(self):
-        try:
-            self.uber.data = KfmFormat.Data()
-            buf = self.history[self.history_pointer][1]
-            buf.seek(0)
-            self.uber.data.read(buf)
+    def touch(self, anim):
+        self.dirty[id(anim)] = anim
 
-            txt = self.history[self.history_pointer][2]
-            self.uber.console_text_box.setPlainText(txt)
+    def end_insert(self, array, index, count):
+        self.array_changed(array)
 
-            cursor = self.uber.console_text_box.textCursor()
-            cursor.setPosition(len(txt))
-            
-            self.uber.console_text_box.setTextCursor(cursor)
-        
-            self.uber.unsaved_changes = True
-        except Exception as e:
-            print(traceback.format_exc())
+    def end_remove(self, array, index, count):
+        self.array_changed(array)
 
-        self.uber.refresh_ui()
-        
-    def undo(self):
-        if self.history_pointer > 0:
-            self.history_pointer -= 1
-            self.reread()
-        
-    def redo(self):
-        if self.history_pointer < len(self.history) - 1:
-            self.history_pointer += 1
-            self.reread()
-        
-class MyTreeWidget(QTreeWidget):
+    def array_changed(self, array):
+        if array is self.data_.animations:
+            self.stale = True
+        else:
+            self.touch(array._parent())
+
+    def changed(self, obj, name, old_value, new_value):
+        if name == 'event_code':
+            self.stale = True
+        elif name in ('animation', 'type'):
+            # the index has already moved the transition to its new bucket
+            index = self.uber.command_manager.index
+            table = index.references if name == 'animation' else index.transition_types
+            ref = table.get(new_value, {}).get(id(obj))
+            if ref is not None:
+                self.touch(ref[0])
+
+class MyTreeView(QTreeView):
     def __init__(self, uber):
         super().__init__()
         self.uber = uber
 
     def keyPressEvent(self, event):
-        selected_item = self.currentItem()
+        index = self.currentIndex()
         
-        if selected_item:
+        if index.isValid():
             if event.key() == Qt.Key_Enter or event.key() == Qt.Key_Return:
-                if selected_item.childCount() == 0:
-                    self.editItem(selected_item, 2)
+                if not self.model().hasChildren(index.siblingAtColumn(0)):
+                    self.edit(index.siblingAtColumn(2))
                 else:
-                    if selected_item.isExpanded():
-                        selected_item.setExpanded(False)
-                    else:
-                        selected_item.setExpanded(True)
+                    self.setExpanded(index.siblingAtColumn(0), not self.isExpanded(index.siblingAtColumn(0)))
             elif event.key() == Qt.Key_Delete or event.key() == Qt.Key_Backspace:
-                self.delete_item(selected_item)
+                if len(self.selected_rows()) > 1:
+                    self.uber.remove_selected()
+                else:
+                    self.delete_item(index)
             else:
                 super().keyPressEvent(event)
         else:
             super().keyPressEvent(event)
     
     def mouseDoubleClickEvent(self, event):
-        item = self.itemAt(event.pos())
-        if item:
-            column = self.columnAt(event.pos().x())
-            if item.childCount() == 0:
+        index = self.indexAt(event.pos())
+        if index.isValid():
+            if not self.model().hasChildren(index.siblingAtColumn(0)):
                 # Only allow editing on double-click if it's the third column
-                if column == 2:
-                    self.editItem(item, column)
+                if index.column() == 2:
+                    self.edit(index)
             else:
-                if item.isExpanded():
-                    item.setExpanded(False)
-                else:
-                    item.setExpanded(True)
+                self.setExpanded(index.siblingAtColumn(0), not self.isExpanded(index.siblingAtColumn(0)))
         else:
             # Call the base class method if no item is under the mouse
             super().mouseDoubleClickEvent(event)
 
-    def delete_item(self, item):
-        if item and item.parent() and item.text(0).startswith("Animation "): 
-            self.uber.remove_animation(item)
-        elif item and item.parent() and item.text(0).startswith("Transition "): 
-            self.uber.remove_transition(item)
+    def selected_rows(self):
+        return self.selectionModel().selectedRows(0)
+
+    def delete_item(self, index):
+        parent = index.internalPointer() if index.isValid() else None
+        if parent is not None and parent.kind == TreeNode.ANIMATIONS:
+            self.uber.remove_animation(index.row())
+        elif parent is not None and parent.kind == TreeNode.TRANSITIONS:
+            self.uber.remove_transition(self.model().animation_index_of(parent), index.row())
+
+class EditorDocument(KfmDocument):
+    # one file of the workspace: its data, history, journal and the views
+    # on its tab, which stay alive while other tabs are shown
+    def __init__(self, window, data=None, filename=None):
+        super().__init__(data, filename)
+        self.window = window
+        self.filename_dir = os.path.dirname(filename) if filename else ""
+        self.command_manager = CommandManager(self)
+        self.journal = None
+        # command_manager.generation when data last matched the file
+        self.disk_generation = 0
+        self.page = None
+
+    def refresh_ui(self):
+        self.window.refresh_document(self)
+
+    def resolve(self, name):
+        # kfm_resolve.Resolution of a NIF/KF name of this file, None while
+        # no asset roots are set
+        if self.window.assets is None:
+            return None
+        return self.window.assets.resolve(name.decode("latin-1"), self.filename_dir)
+
+    def preview(self, name):
+        # kfm_preview.SequenceInfo of a KF name of this file, None while it
+        # is read. The asset roots find it when they can, else it is taken
+        # relative to the KFM
+        if not name:
+            return kfm_preview.SequenceInfo(error="no KF file")
+        resolution = self.resolve(name)
+        if resolution is not None and resolution.status == kfm_resolve.RESOLVED:
+            path = resolution.paths[0]
+        else:
+            path = os.path.join(self.filename_dir, *name.decode("latin-1").replace("\\", "/").split("/"))
+        return self.window.previews.get(path)
+
+def _document_attribute(name):
+    # UberKFM attribute that belongs to the document of the current tab
+    return property(lambda self: getattr(self.document, name, None),
+                    lambda self, value: setattr(self.document, name, value))
 
 class UberKFM(QMainWindow):
+    # emitted from the preview thread, so the models refresh on this one
+    preview_loaded = pyqtSignal(str)
+
+    data = _document_attribute("data")
+    opened_filename = _document_attribute("opened_filename")
+    filename_dir = _document_attribute("filename_dir")
+    unsaved_changes = _document_attribute("unsaved_changes")
+    command_manager = _document_attribute("command_manager")
+    journal = _document_attribute("journal")
+    model = _document_attribute("model")
+    matrix_model = _document_attribute("matrix_model")
+    tree = _document_attribute("tree")
+    matrix_view = _document_attribute("matrix_view")
+    search_box = _document_attribute("search_box")
+    search_status = _document_attribute("search_status")
+    search_timer = _document_attribute("search_timer")
+    tabs = _document_attribute("tabs")
+    conflicts = _document_attribute("conflicts")
+    conflict_list = _document_attribute("conflict_list")
+
     def __init__(self):
         super().__init__()
 
+        # open files, self.document is the one in the current tab (or an
+        # empty stand-in when none is open)
+        self.documents = []
+        self.document = EditorDocument(self)
+        self.parse_cache = kfm_io.ParseCache()
+        # kfm_resolve.AssetIndex of the asset roots, None while none are set
+        self.assets = None
+        # KF sequence previews; a burst of them refreshes the trees once
+        self.previews = kfm_preview.PreviewCache(self.preview_loaded.emit)
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(50)
+        self.preview_timer.timeout.connect(self.refresh_previews)
+        self.preview_loaded.connect(lambda path: self.preview_timer.start() if not self.preview_timer.isActive() else None)
+
         self.unsaved_changes = False
-        self.handle_item_connection = None
 
         self.setMinimumSize(1500, 700) 
 
@@ -374,6 +863,11 @@ class UberKFM(QMainWindow):
         action.triggered.connect(self.load_mission)
         missionMenu.addAction(action)
 
+        action = QAction(self)
+        action.setText("Load &Folder ...")
+        action.triggered.connect(lambda: self.load_folder())
+        missionMenu.addAction(action)
+
         action = QAction(self)
         action.setText("&Save (Ctrl + S)")
         action.triggered.connect(lambda: self.save_mission(ask=False))
@@ -384,6 +878,25 @@ class UberKFM(QMainWindow):
         action.triggered.connect(lambda: self.save_mission())
         missionMenu.addAction(action)
 
+        missionMenu.addSeparator()
+
+        action = QAction(self)
+        action.setText("&Compare With ...")
+        action.triggered.connect(lambda: self.compare_with())
+        missionMenu.addAction(action)
+
+        action = QAction(self)
+        action.setText("&Merge ...")
+        action.triggered.connect(lambda: self.merge_with())
+        missionMenu.addAction(action)
+
+        missionMenu.addSeparator()
+
+        action = QAction(self)
+        action.setText("&Close (Ctrl + W)")
+        action.triggered.connect(lambda: self.close_document(self.document))
+        missionMenu.addAction(action)
+
         editMenu = QMenu("&Edit", self)
         menuBar.addMenu(editMenu)
 
@@ -397,12 +910,78 @@ class UberKFM(QMainWindow):
         action.triggered.connect(lambda: self.command_manager.redo())
         editMenu.addAction(action)
 
+        editMenu.addSeparator()
+
+        action = QAction(self)
+        action.setText("&Copy (Ctrl + C)")
+        action.triggered.connect(lambda: self.copy_selected())
+        editMenu.addAction(action)
+
+        action = QAction(self)
+        action.setText("&Paste (Ctrl + V)")
+        action.triggered.connect(lambda: self.paste())
+        editMenu.addAction(action)
+
+        action = QAction(self)
+        action.setText("&Duplicate (Ctrl + D)")
+        action.triggered.connect(lambda: self.duplicate_selected())
+        editMenu.addAction(action)
+
+        editMenu.addSeparator()
+
+        action = QAction(self)
+        action.setText("&Replace in All Files ... (Ctrl + Shift + H)")
+        action.triggered.connect(lambda: self.replace_in_all_files())
+        editMenu.addAction(action)
+
+        assetsMenu = QMenu("&Assets", self)
+        menuBar.addMenu(assetsMenu)
+
+        action = QAction(self)
+        action.setText("&Add Asset Root ...")
+        action.triggered.connect(lambda: self.add_asset_root())
+        assetsMenu.addAction(action)
+
+        action = QAction(self)
+        action.setText("&Rescan Asset Roots")
+        action.triggered.connect(lambda: self.index_assets(self.assets.roots if self.assets else []))
+        assetsMenu.addAction(action)
+
+        action = QAction(self)
+        action.setText("C&lear Asset Roots")
+        action.triggered.connect(lambda: self.set_assets(None))
+        assetsMenu.addAction(action)
+
+        assetsMenu.addSeparator()
+
+        action = QAction(self)
+        action.setText("&Check References in Folder ...")
+        action.triggered.connect(lambda: self.check_references())
+        assetsMenu.addAction(action)
+
         self.console_text_box = QPlainTextEdit(self)
         self.console_text_box.setFont(QFont("Courier", 10))  
         self.console_text_box.setReadOnly(True)
         self.console_text_box.setLineWrapMode(QPlainTextEdit.WidgetWidth) 
         self.console_text_box.setFixedWidth(400)
-        sys.stdout = TextBoxWriter(self.console_text_box)
+        self.console = ConsoleSink(self.console_text_box)
+        sys.stdout = self.console
+        logging.getLogger().addHandler(self.console.handler)
+
+        consoleMenu = QMenu("&Console", self)
+        menuBar.addMenu(consoleMenu)
+
+        action = QAction(self)
+        action.setText("Show &Info Messages")
+        action.setCheckable(True)
+        action.setChecked(True)
+        action.toggled.connect(lambda checked: setattr(self.console, "level", logging.INFO if checked else logging.WARNING))
+        consoleMenu.addAction(action)
+
+        action = QAction(self)
+        action.setText("&Clear")
+        action.triggered.connect(lambda: self.console_text_box.clear())
+        consoleMenu.addAction(action)
                 
         undo_shortcut = QShortcut(QKeySequence("Ctrl+Z"), self)
         undo_shortcut.activated.connect(lambda: self.command_manager.undo())
@@ -419,219 +998,462 @@ class UberKFM(QMainWindow):
         save_shortcut = QShortcut(QKeySequence("Ctrl+Shift+S"), self)
         save_shortcut.activated.connect(lambda: self.save_mission())
 
-        self.command_manager = CommandManager(self)
-
-
-    def handle_item_changed(self, item, column):
-        try:
-            new_value = item.text(2)
-            command_type = None
-            animation_index = None
-            transition_index = None
-            
-            if item.text(0) == "NIF File Name":
-                command_type = CommandType.EDIT_NIF_FILENAME
-            elif item.text(0) == "Num Transitions":
-                animation_index = int(item.parent().text(0).split()[1])-1
-                command_type = CommandType.EDIT_NUM_TRANSITIONS
-            elif item.text(0) == "Num Animations":
-                command_type = CommandType.EDIT_NUM_ANIMATIONS
-            elif item.text(0) == "KF File Name":
-                animation_index = int(item.parent().text(0).split()[1])-1
-                command_type = CommandType.EDIT_ANIMATION_KF_FILENAME
-            elif item.text(0) == "Event Code":
-                animation_index = int(item.parent().text(0).split()[1])-1
-                command_type = CommandType.EDIT_ANIMATION_EVENT_CODE
-            elif item.text(0) == "Index":
-                animation_index = int(item.parent().text(0).split()[1])-1
-                command_type = CommandType.EDIT_ANIMATION_INDEX
-            elif item.text(0) == "Animation":
-                animation_index = int(item.parent().parent().parent().text(0).split()[1])-1
-                transition_index = int(item.parent().text(0).split()[1])-1
-                command_type = CommandType.EDIT_TRANSITION_ANIMATION
-            elif item.text(0) == "Type":
-                animation_index = int(item.parent().parent().parent().text(0).split()[1])-1
-                transition_index = int(item.parent().text(0).split()[1])-1
-                command_type = CommandType.EDIT_TRANSITION_TYPE
-            
-            if command_type:
-                self.command_manager.execute(Command(
-                    type=command_type,
-                    new_value=new_value,
-                    animation_index=animation_index,
-                    transition_index=transition_index
-                ))
-        except Exception as e:
-            print(traceback.format_exc())
-
-    def rebuild_tree(self):
-        try:
-            tree = self.tree
-            data = self.data
-
-            if self.handle_item_connection:
-                tree.itemChanged.disconnect(self.handle_item_connection)
-
-            tree.clear()
-
-            def make_item_editable(item):
-                item.setFlags(item.flags() | QtCore.Qt.ItemIsEditable)
+        close_shortcut = QShortcut(QKeySequence("Ctrl+W"), self)
+        close_shortcut.activated.connect(lambda: self.close_document(self.document))
 
-            QTreeWidgetItem(self.tree, ["Header String", "HeaderString", KfmFormat.HeaderString.version_string(self.data.version)])
-            make_item_editable(QTreeWidgetItem(self.tree, ["NIF File Name", "SizedString", data.nif_file_name.decode("ascii")]))
-            make_item_editable(QTreeWidgetItem(self.tree, ["Num Animations", "int", str(len(data.animations))]))
+        replace_shortcut = QShortcut(QKeySequence("Ctrl+Shift+H"), self)
+        replace_shortcut.activated.connect(lambda: self.replace_in_all_files())
 
-            animations_item = QTreeWidgetItem(self.tree, ["Animations", "Animation[]", ""])
-            for index in range(self.data.num_animations):
-                anim = self.data.animations[index]
-                anim_item = QTreeWidgetItem(animations_item, [f"Animation {index + 1}", "Animation", ""])
-                make_item_editable(QTreeWidgetItem(anim_item, ["KF File Name", "SizedString", anim.kf_file_name.decode("ascii")]))
-                make_item_editable(QTreeWidgetItem(anim_item, ["Event Code", "int", str(anim.event_code)]))
-                make_item_editable(QTreeWidgetItem(anim_item, ["Index", "int", str(anim.index)]))
-                make_item_editable(QTreeWidgetItem(anim_item, ["Num Transitions", "int", str(anim.num_transitions)]))
-                transitions_item = QTreeWidgetItem(anim_item, ["Transitions", "Transitions[]", ""])
+        # one tab per open file, the console stays beside them
+        self.workspace = QTabWidget(self)
+        self.workspace.setTabsClosable(True)
+        self.workspace.setMovable(True)
+        self.workspace.currentChanged.connect(self.workspace_tab_changed)
+        self.workspace.tabCloseRequested.connect(lambda i: self.close_document(self.document_at(i)))
 
-                for i in range(anim.num_transitions):
-                    transition_i = QTreeWidgetItem(transitions_item, [f"Transition {i + 1}", "Transition", ""])
-                    make_item_editable(QTreeWidgetItem(transition_i, ["Animation", "int", str(anim.transitions[i].animation)]))
-                    make_item_editable(QTreeWidgetItem(transition_i, ["Type", "int", str(anim.transitions[i].type)]))
-
-            self.handle_item_connection = tree.itemChanged.connect(self.handle_item_changed)
-        except:
-            print(traceback.format_exc())
-
-    def refresh_ui(self, deleted_animation_index = None, deleted_transition_index = None):
-        # Store the current scroll position
-        scrollbar = self.tree.verticalScrollBar()
-        scroll_pos = scrollbar.value()
-        
-        # Remember expanded items
-        expanded_items = []
-        current_item_path = None
-        iterator = QTreeWidgetItemIterator(self.tree)
-
-        while iterator.value():
-            item = iterator.value()
-            itemTemp = item
-
-            path = []
-            while itemTemp:
-                path.insert(0, itemTemp.text(0))
-                itemTemp = itemTemp.parent()
-
-            if item.isExpanded():
-                if deleted_animation_index is None or f"Animation {deleted_animation_index+1}" not in path:
-                    if deleted_transition_index is None or f"Transition {deleted_transition_index+1}" not in path:
-                        expanded_items.append(path)
-            if item == self.tree.currentItem():
-                current_item_path = path
-            iterator += 1
-
-        self.rebuild_tree()
-        
-        # Restore expanded state
-        iterator = QTreeWidgetItemIterator(self.tree)
-        while iterator.value():
-            item = iterator.value()
-            current_path = []
-            temp_item = item
-            while temp_item:
-                current_path.insert(0, temp_item.text(0))
-                temp_item = temp_item.parent()
-            if current_path in expanded_items:
-                item.setExpanded(True)
-            if current_item_path and current_path == current_item_path:
-                self.tree.setCurrentItem(item)
-            iterator += 1
-            
-        # Restore scroll position
-        scrollbar.setValue(scroll_pos)
-
-        self.tree.setFocus()
+        main_layout = QHBoxLayout()
+        main_layout.addWidget(self.workspace)
+        main_layout.addWidget(self.console_text_box)
+        container = QWidget()
+        container.setLayout(main_layout)
+        self.setCentralWidget(container)
 
+        self.io_task = None
+        self.progress_label = QLabel(self)
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setMaximumWidth(200)
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.clicked.connect(lambda: self.io_task and self.io_task.cancel())
+        for widget in (self.progress_label, self.progress_bar, self.cancel_button):
+            self.statusBar().addPermanentWidget(widget)
+            widget.hide()
+        # resolution of the current file's references
+        self.reference_status = QLabel(self)
+        self.statusBar().addWidget(self.reference_status)
+
+
+    def refresh_ui(self):
         star = " *" if self.unsaved_changes else ""
         self.setWindowTitle(f'KFM Editor {self.opened_filename} {star}')
+        self.refresh_tab(self.document)
+        if getattr(self, "search_box", None) is not None and self.search_box.text().strip():
+            self.apply_filter()
+        self.refresh_matrix()
+        self.refresh_reference_status()
+
+    def refresh_reference_status(self):
+        if self.assets is None or getattr(self, "data", None) is None:
+            self.reference_status.setText("")
+            return
+        references = self.assets.references(kfm_resolve.data_names(self.data), self.filename_dir)
+        missing = sum(1 for ref in references if ref.resolution.status == kfm_resolve.MISSING)
+        ambiguous = sum(1 for ref in references if ref.resolution.status == kfm_resolve.AMBIGUOUS)
+        self.reference_status.setText(f"References: {missing} missing, {ambiguous} ambiguous" if missing or ambiguous else "References: all found")
+
+    def refresh_previews(self):
+        for document in self.documents:
+            if getattr(document, "model", None) is not None:
+                document.model.previews_loaded()
+
+    def set_assets(self, assets):
+        self.assets = assets
+        if assets is not None:
+            print(f"Indexed {len(assets)} files in {len(assets.roots)} asset roots\n")
+        # the name colours of every open file change with the roots
+        for document in self.documents:
+            if getattr(document, "tree", None) is not None:
+                document.tree.viewport().update()
+        self.refresh_reference_status()
+
+    def index_assets(self, roots):
+        if roots:
+            self.start_task(IoTask("Indexing assets", kfm_resolve.AssetIndex, roots), self.set_assets)
+
+    def add_asset_root(self):
+        directory = QFileDialog.getExistingDirectory(self, "Add Asset Root", self.filename_dir or "")
+        if directory:
+            self.index_assets((self.assets.roots if self.assets else []) + [directory])
+
+    def check_references(self):
+        # missing/ambiguous references of every KFM in a folder, resolved
+        # against the asset roots (or the folder itself when none are set)
+        directory = QFileDialog.getExistingDirectory(self, "Check References of KFM Files in Folder", self.filename_dir or "")
+        if not directory:
+            return
+        assets = self.assets
+
+        def check(progress):
+            filenames = kfm_resolve.find_files([directory])
+            return kfm_resolve.check_files(filenames, assets or kfm_resolve.AssetIndex([directory]), progress=progress)
+
+        def on_done(report):
+            lines, summary = kfm_resolve.format_report(report)
+            for line in lines:
+                print(line)
+            print(summary, "\n")
+        self.start_task(IoTask(f"Checking references in {os.path.basename(directory)}", check), on_done)
+
+    def refresh_document(self, document):
+        if document is self.document:
+            self.refresh_ui()
+        else:
+            self.refresh_tab(document)
+
+    def refresh_tab(self, document):
+        index = self.workspace.indexOf(document.page) if document.page is not None else -1
+        if index >= 0:
+            star = " *" if document.unsaved_changes else ""
+            self.workspace.setTabText(index, os.path.basename(document.opened_filename) + star)
+            self.workspace.setTabToolTip(index, document.opened_filename)
+
+    def document_at(self, index):
+        page = self.workspace.widget(index)
+        return next((document for document in self.documents if document.page is page), None)
+
+    def document_of(self, filename):
+        path = os.path.abspath(filename)
+        return next((document for document in self.documents if os.path.abspath(document.opened_filename) == path), None)
+
+    def workspace_tab_changed(self, index):
+        document = self.document_at(index)
+        if document is not None:
+            self.document = document
+            self.refresh_ui()
+
+    def close_document(self, document):
+        # False if the user chose to keep it open
+        if document not in self.documents:
+            return True
+        self.workspace.setCurrentWidget(document.page)
+        self.document = document
+        if not self.prompt_unsaved_should_continue():
+            return False
+
+        self.close_journal(discard=True)
+        if document.command_manager.generation == document.disk_generation:
+            # still what is on disk, reopening it needs no parse
+            self.parse_cache.put(document.opened_filename, document.data)
+
+        self.documents.remove(document)
+        self.document = self.documents[-1] if self.documents else EditorDocument(self)
+        self.workspace.removeTab(self.workspace.indexOf(document.page))
+        document.page.deleteLater()
+        if self.document.page is not None:
+            self.workspace.setCurrentWidget(self.document.page)
+        else:
+            self.setWindowTitle('KFM Editor')
+        return True
+
+    def refresh_matrix(self):
+        # the grid only catches up with edits while it is shown
+        if getattr(self, "tabs", None) is not None and self.tabs.currentWidget() is self.matrix_view and (self.matrix_model.stale or self.matrix_model.dirty):
+            self.matrix_model.refresh(self.data)
+
+    def apply_filter(self):
+        # hides the animation rows that don't match the search box, the
+        # matches come from the command manager's index
+        text = self.search_box.text()
+        try:
+            criteria = parse_search(text)
+        except ValueError as e:
+            self.search_status.setText(str(e))
+            return
+
+        animations = self.model.node_index(self.model.animations_node)
+        if self.model.canFetchMore(animations):
+            self.model.fetchMore(animations)
+
+        total = self.model.rowCount(animations)
+        if criteria:
+            index = self.command_manager.index
+            matches = {index.animation_row(anim) for anim in index.search(**criteria)}
+            self.tree.expand(animations)
+            self.search_status.setText(f"{len(matches)} of {total} animations")
+        else:
+            matches = range(total)
+            self.search_status.setText("")
 
-    def remove_animation(self, item):
-        parent_item = item.parent()
-        index_to_remove = parent_item.indexOfChild(item)
+        for row in range(total):
+            hidden = row not in matches
+            if self.tree.isRowHidden(row, animations) != hidden:
+                self.tree.setRowHidden(row, animations, hidden)
+
+    def remove_animation(self, index_to_remove):
         self.command_manager.execute(Command(
             type=CommandType.REMOVE_ANIMATION,
             animation_index=index_to_remove,
         ))
     
-    def remove_transition(self, item):
-        anim_id = item.parent().parent().parent().indexOfChild(item.parent().parent())
-
-        parent_item = item.parent()
-        index_to_remove = parent_item.indexOfChild(item)
-
+    def remove_transition(self, anim_id, index_to_remove):
         self.command_manager.execute(Command(
             type=CommandType.REMOVE_TRANSITION,
             animation_index=anim_id,
             transition_index=index_to_remove,
         ))
 
-    def init_ui(self):
-        self.setCentralWidget(None)
-
-        main_layout = QHBoxLayout()
+    def selected_field(self):
+        rows = self.tree.selected_rows()
+        selection = self.model.selection_field(rows)
+        if not rows or selection is None:
+            print("Select fields of the same name, or animations/transitions only\n")
+            return rows, None
+
+        attr, kind = selection
+        if attr is None:
+            fields = KfmTreeModel.ANIMATION_FIELDS if kind == TreeNode.ANIMATIONS else KfmTreeModel.TRANSITION_FIELDS
+            names = [name for name, _, field_attr in fields if field_attr]
+            name, ok = QInputDialog.getItem(self, "Set Value", f"Field to set on {len(rows)} rows:", names, 0, False)
+            if not ok:
+                return rows, None
+            attr = next(field_attr for field_name, _, field_attr in fields if field_name == name)
+        return rows, attr
+
+    def bulk_set_value(self):
+        rows, attr = self.selected_field()
+        if attr is None:
+            return
+        value, ok = QInputDialog.getText(self, "Set Value", f"New value for {len(rows)} rows:")
+        if ok:
+            self.command_manager.execute_many([self.model.edit_command(index, attr, value) for index in rows])
+
+    def field_value(self, index, attr):
+        animation_index, transition_index = self.model.target(index)
+        if animation_index is None:
+            obj = self.data
+        elif transition_index is None:
+            obj = self.data.animations[animation_index]
+        else:
+            obj = self.data.animations[animation_index].transitions[transition_index]
+        value = getattr(obj, attr)
+        return value.decode("ascii") if isinstance(value, bytes) else str(value)
+
+    def bulk_replace_prefix(self):
+        rows = self.tree.selected_rows()
+        selection = self.model.selection_field(rows)
+        attr = "kf_file_name" if selection and selection[0] is None else selection and selection[0]
+        if attr not in ("kf_file_name", "nif_file_name"):
+            return
+
+        values = [self.field_value(index, attr) for index in rows]
+        old_prefix, ok = QInputDialog.getText(self, "Replace Prefix", "Replace prefix:", text=os.path.commonprefix(values))
+        if not ok:
+            return
+        new_prefix, ok = QInputDialog.getText(self, "Replace Prefix", f"Replace '{old_prefix}' with:", text=old_prefix)
+        if not ok:
+            return
+
+        self.command_manager.execute_many([
+            self.model.edit_command(index, attr, new_prefix + value[len(old_prefix):])
+            for index, value in zip(rows, values) if value.startswith(old_prefix)
+        ])
+
+    def remove_selected(self):
+        rows = self.tree.selected_rows()
+        selection = self.model.selection_field(rows)
+        if selection is None or selection[0] is not None:
+            return
+
+        # remove from the back so the remaining indices stay valid
+        targets = sorted((self.model.target(index) for index in rows), reverse=True)
+        if selection[1] == TreeNode.ANIMATIONS:
+            commands = [Command(type=CommandType.REMOVE_ANIMATION, animation_index=a) for a, _ in targets]
+        else:
+            commands = [Command(type=CommandType.REMOVE_TRANSITION, animation_index=a, transition_index=t) for a, t in targets]
+        self.tree.clearSelection()
+        self.command_manager.execute_many(commands)
+
+    def selected_elements(self):
+        # (kind, rows) when the selection is only animations or only
+        # transitions, else (None, rows)
+        if getattr(self, "tree", None) is None:
+            return None, []
+        rows = self.tree.selected_rows()
+        selection = self.model.selection_field(rows) if rows else None
+        if selection is None or selection[0] is not None:
+            return None, rows
+        return selection[1], rows
+
+    def copy_selected(self):
+        kind, rows = self.selected_elements()
+        if kind is None:
+            print("Select animations or transitions to copy\n")
+            return
+        if kind == TreeNode.ANIMATIONS:
+            items = [to_plain(self.data.animations[self.model.target(index)[0]]) for index in rows]
+        else:
+            items = [to_plain(self.data.animations[a].transitions[t]) for a, t in (self.model.target(index) for index in rows)]
+        key = "animations" if kind == TreeNode.ANIMATIONS else "transitions"
+        # plain JSON on the system clipboard, so it pastes into another
+        # file or another editor window as well
+        QApplication.clipboard().setText(json.dumps({"kfm_clipboard": 1, key: items}))
+        print(f"Copied {len(items)} {key}\n")
+
+    def clipboard_items(self):
+        # (key, items) of a copy made by copy_selected, None otherwise
+        try:
+            payload = json.loads(QApplication.clipboard().text())
+        except ValueError:
+            return None
+        if not isinstance(payload, dict) or payload.get("kfm_clipboard") != 1:
+            return None
+        for key in ("animations", "transitions"):
+            if key in payload:
+                return key, payload[key]
+        return None
+
+    def paste(self):
+        clipboard = self.clipboard_items()
+        if clipboard is None or getattr(self, "data", None) is None:
+            return
+        key, items = clipboard
+        if key == "animations":
+            self.command_manager.execute(Command(type=CommandType.PASTE_ANIMATIONS, new_value=items))
+            return
+
+        # transitions go to every animation the selection is in
+        targets = sorted({self.model.target(index)[0] for index in self.tree.selected_rows()} - {None})
+        if not targets:
+            print("Select the animations to paste the transitions into\n")
+            return
+        self.command_manager.execute_many([Command(type=CommandType.PASTE_TRANSITIONS, new_value=items, animation_index=a) for a in targets])
+
+    def duplicate_selected(self):
+        kind, rows = self.selected_elements()
+        if kind != TreeNode.ANIMATIONS:
+            print("Select animations to duplicate\n")
+            return
+        self.command_manager.execute(Command(type=CommandType.DUPLICATE_ANIMATIONS, new_value=[self.model.target(index)[0] for index in rows]))
 
-        self.tree = MyTreeWidget(self)
-        self.tree.setColumnCount(3)
-        self.tree.setHeaderLabels(["Name", "Type", "Value"])
+    def init_ui(self):
+        # builds the views of the current document on its workspace tab
+        # the models edit through their own document's command manager,
+        # whichever tab is current
+        self.model = KfmTreeModel(self.document)
+        self.matrix_model = TransitionMatrixModel(self.document)
+        self.command_manager.listeners = [self.model, self.matrix_model]
+
+        self.tree = MyTreeView(self)
+        self.tree.setModel(self.model)
         self.tree.setAlternatingRowColors(True)
+        self.tree.setUniformRowHeights(True)
+        self.tree.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.tree.setSelectionBehavior(QAbstractItemView.SelectRows)
 
         def show_context_menu(position):
-            item = self.tree.itemAt(position)
-            if item and item.parent() and item.text(0).startswith("Animation "): 
-                menu = QMenu(self.tree)
-                
+            index = self.tree.indexAt(position)
+            if not index.isValid():
+                return
+            rows = self.tree.selected_rows()
+            parent = index.internalPointer()
+            menu = QMenu(self.tree)
+
+            if len(rows) > 1:
+                selection = self.model.selection_field(rows)
+                if selection is not None:
+                    action = QAction(f"Set Value on {len(rows)} Selected ...", self.tree)
+                    action.triggered.connect(self.bulk_set_value)
+                    menu.addAction(action)
+                    if selection[0] in ("kf_file_name", "nif_file_name") or selection == (None, TreeNode.ANIMATIONS):
+                        action = QAction(f"Replace Prefix on {len(rows)} Selected ...", self.tree)
+                        action.triggered.connect(self.bulk_replace_prefix)
+                        menu.addAction(action)
+                    if selection[0] is None:
+                        action = QAction(f"Remove {len(rows)} Selected", self.tree)
+                        action.triggered.connect(self.remove_selected)
+                        menu.addAction(action)
+            elif parent.kind in (TreeNode.ANIMATIONS, TreeNode.TRANSITIONS):
                 remove_action = QAction("Remove", self.tree)
-                remove_action.triggered.connect(lambda: self.remove_animation(item))
+                remove_action.triggered.connect(lambda: self.tree.delete_item(index))
                 menu.addAction(remove_action)
-                
-                menu.exec_(self.tree.viewport().mapToGlobal(position))
-            elif item and item.parent() and item.text(0).startswith("Transition "): 
-                menu = QMenu(self.tree)
-                
-                remove_action = QAction("Remove", self.tree)
-                remove_action.triggered.connect(lambda: self.remove_transition(item))
-                menu.addAction(remove_action)
-                
+
+            selection = self.model.selection_field(rows) if rows else None
+            if selection is not None and selection[0] is None:
+                menu.addSeparator()
+                action = QAction("Copy (Ctrl + C)", self.tree)
+                action.triggered.connect(self.copy_selected)
+                menu.addAction(action)
+                if selection[1] == TreeNode.ANIMATIONS:
+                    action = QAction("Duplicate (Ctrl + D)", self.tree)
+                    action.triggered.connect(self.duplicate_selected)
+                    menu.addAction(action)
+            if self.clipboard_items() is not None:
+                action = QAction("Paste (Ctrl + V)", self.tree)
+                action.triggered.connect(self.paste)
+                menu.addAction(action)
+
+            if not menu.isEmpty():
                 menu.exec_(self.tree.viewport().mapToGlobal(position))
 
         self.tree.setContextMenuPolicy(Qt.CustomContextMenu)
         self.tree.customContextMenuRequested.connect(show_context_menu)
 
+        # on the tree only, so the console keeps its own copy shortcut
+        for keys, slot in (("Ctrl+C", self.copy_selected), ("Ctrl+V", self.paste), ("Ctrl+D", self.duplicate_selected)):
+            shortcut = QShortcut(QKeySequence(keys), self.tree)
+            shortcut.setContext(Qt.WidgetShortcut)
+            shortcut.activated.connect(slot)
+
         header = self.tree.header()       
         header.setSectionResizeMode(0, QHeaderView.ResizeMode.ResizeToContents)
         header.setSectionResizeMode(1, QHeaderView.ResizeMode.ResizeToContents)
         header.setSectionResizeMode(2, QHeaderView.ResizeMode.Stretch)
 
-        main_layout.addWidget(self.tree)
-
-        self.rebuild_tree()
-
-        self.refresh_ui()
-
-        output_and_recalc_button = QVBoxLayout()
-        output_and_recalc_button.addWidget(self.console_text_box)
-
-        main_layout.addLayout(output_and_recalc_button)
-
-        container = QWidget()
-        container.setLayout(main_layout)
-        self.setCentralWidget(container)
+        self.search_box = QLineEdit(self)
+        self.search_box.setPlaceholderText("Filter animations: kf:_Run code:42 index:3 to:42 type:5")
+        self.search_box.setClearButtonEnabled(True)
+        self.search_status = QLabel(self)
+
+        # filter once typing pauses rather than on every key
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.apply_filter)
+        self.search_box.textChanged.connect(self.search_timer.start)
+
+        search_bar = QHBoxLayout()
+        search_bar.addWidget(self.search_box)
+        search_bar.addWidget(self.search_status)
+
+        tree_layout = QVBoxLayout()
+        tree_layout.setContentsMargins(0, 0, 0, 0)
+        tree_layout.addLayout(search_bar)
+        tree_layout.addWidget(self.tree)
+        tree_page = QWidget()
+        tree_page.setLayout(tree_layout)
+
+        self.matrix_view = QTableView(self)
+        self.matrix_view.setModel(self.matrix_model)
+        for header, size in ((self.matrix_view.horizontalHeader(), 48), (self.matrix_view.verticalHeader(), 22)):
+            header.setSectionResizeMode(QHeaderView.Fixed)
+            header.setDefaultSectionSize(size)
+
+        self.tabs = QTabWidget(self)
+        self.tabs.addTab(tree_page, "Tree")
+        self.tabs.addTab(self.matrix_view, "Transition Matrix")
+        self.tabs.currentChanged.connect(lambda _: self.refresh_matrix())
+
+        # replaces the document's page when it is reloaded (e.g. a merge)
+        old_page, self.document.page = self.document.page, self.tabs
+        index = self.workspace.indexOf(old_page) if old_page is not None else -1
+        if index >= 0:
+            self.workspace.blockSignals(True)
+            self.workspace.removeTab(index)
+            self.workspace.insertTab(index, self.tabs, "")
+            self.workspace.blockSignals(False)
+            old_page.deleteLater()
+        else:
+            self.workspace.addTab(self.tabs, "")
+        self.workspace.setCurrentWidget(self.tabs)
 
     def prompt_unsaved_should_continue(self):
         accept = False
         if self.unsaved_changes:
             reply = QMessageBox.question(self, 'Unsaved Changes',
-                                         "You have unsaved changes. Do you want to save before exiting?",
+                                         f"{os.path.basename(self.opened_filename)} has unsaved changes. Do you want to save before closing it?",
                                          QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel, QMessageBox.Cancel)
             if reply == QMessageBox.Yes:
-                if self.save_mission():
+                if self.save_mission(wait=True):
                     accept = True
             elif reply == QMessageBox.No:
                 accept = True
@@ -639,39 +1461,275 @@ class UberKFM(QMainWindow):
             accept = True
         return accept
 
+    def start_task(self, task, on_done):
+        if self.io_task is not None:
+            print("Wait for", self.io_task.description, "to finish first")
+            return False
+
+        self.io_task = task
+        self.progress_bar.setValue(0)
+        self.progress_label.setText(task.description)
+        for widget in (self.progress_label, self.progress_bar, self.cancel_button):
+            widget.show()
+
+        def finished():
+            self.io_task = None
+            for widget in (self.progress_label, self.progress_bar, self.cancel_button):
+                widget.hide()
+            if task.error == "cancelled":
+                print(task.description, "cancelled\n")
+            elif task.error:
+                print(task.error)
+            else:
+                on_done(task.result)
+
+        task.progress.connect(lambda done, total: self.progress_bar.setValue(int(100 * done / total) if total else 0))
+        task.finished.connect(finished)
+        task.start()
+        return True
+
     def load_mission_file(self, filename):
+        document = self.document_of(filename)
+        if document is not None:
+            self.workspace.setCurrentWidget(document.page)
+            return
         print("Reading", filename, "...")
+        self.start_task(IoTask(f"Reading {os.path.basename(filename)}", self.parse_cache.take, filename), lambda data: self.loaded(filename, data))
+
+    def load_folder(self):
+        directory = QFileDialog.getExistingDirectory(self, "Load KFM Files in Folder", self.filename_dir or "")
+        if not directory:
+            return
+        filenames = [filename for filename, _ in find_kfm_files([directory]) if self.document_of(filename) is None]
+        print("Reading", len(filenames), "files in", directory, "...")
+
+        def on_done(results):
+            for filename, data, error in results:
+                if error is not None:
+                    print("Can't read", filename, ":", error)
+                else:
+                    self.loaded(filename, data)
+        self.start_task(IoTask(f"Reading {len(filenames)} files", self.parse_cache.take_many, filenames), on_done)
+
+    def loaded(self, filename, data):
+        # opens data in a new tab, or in the tab of filename if it is open
         try:
-            with open(filename, 'rb') as file:
-                self.opened_filename = filename
-                self.filename_dir = os.path.dirname(filename)
+            document = self.document_of(filename)
+            if document is None:
+                document = EditorDocument(self, filename=filename)
+                self.documents.append(document)
+            self.document = document
 
-                self.data = KfmFormat.Data()
-                self.data.inspect(file)
-                self.data.read(file)
+            self.opened_filename = filename
+            self.filename_dir = os.path.dirname(filename)
+
+            self.data = data
             
-                print("... version", self.data.version)
+            print("... version", self.data.version)
 
-                print("    NIF File Name", self.data.nif_file_name.decode("ascii"))
-                print("    Found", len(self.data.animations), "animations\n")
+            print("    NIF File Name", self.data.nif_file_name.decode("ascii"))
+            print("    Found", len(self.data.animations), "animations\n")
 
-                self.init_ui()
+            self.init_ui()
+            self.model.reset_data(self.data)
+            self.matrix_model.reset_data(self.data)
 
-                data = io.BytesIO()
-                console_text = self.console_text_box.toPlainText()
-                self.data.write(data)
-                self.command_manager.history = [(None, data, console_text)]
+            self.command_manager.clear()
+            self.document.disk_generation = self.command_manager.generation
 
-                self.unsaved_changes = False
+            self.unsaved_changes = False
+            self.open_journal(filename)
+            self.refresh_ui()
         except:
             print(traceback.format_exc())
 
+    def open_journal(self, filename):
+        # journals the edits of filename, first offering to replay the edits
+        # of a previous session on it that did not end cleanly
+        self.close_journal(discard=True)
+        try:
+            file_digest = kfm_journal.file_digest(filename)
+            previous = kfm_journal.read_journal(filename)
+        except Exception:
+            print(traceback.format_exc())
+            return
+
+        entries = []
+        if previous is not None:
+            header, unsaved = previous
+            if header.get("sha1") != file_digest:
+                print("Discarding the journal of", filename, "as the file changed since it was written\n")
+            elif unsaved:
+                reply = QMessageBox.question(self, 'Recover Unsaved Changes',
+                                             f"{os.path.basename(filename)} has {len(unsaved)} unsaved edits from a previous session. Do you want to recover them?",
+                                             QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+                if reply == QMessageBox.Yes:
+                    applied = kfm_journal.replay(self.command_manager, unsaved)
+                    print(f"Recovered {applied} of {len(unsaved)} edits\n")
+                    entries = unsaved[:applied]
+
+        self.journal = kfm_journal.Journal(filename)
+        self.journal.start(file_digest, entries)
+        self.command_manager.journal = self.journal
+
+    def close_journal(self, discard):
+        if self.journal is not None:
+            if discard:
+                self.journal.discard()
+            self.journal.close()
+            self.journal = None
+            self.command_manager.journal = None
+
+    def compare_with(self):
+        if getattr(self, "data", None) is None:
+            return
+        filename, _ = QFileDialog.getOpenFileName(self, "Compare With KFM File", self.filename_dir, "KFM Files (*.kfm);;All Files (*)")
+        if not filename:
+            return
+        try:
+            changes = kfm_diff.diff(kfm_io.read_kfm(filename), self.data)
+        except Exception:
+            print(traceback.format_exc())
+            return
+        print(f"{len(changes)} differences from {filename} to the opened file")
+        for change in changes:
+            print(change)
+        print()
+
+    def merge_with(self):
+        # three-way merge of the opened data (ours) with a base and their
+        # version; the result replaces the opened data as one undoable
+        # command and the conflicts, which keep ours, are listed in their
+        # own tab
+        if getattr(self, "data", None) is None:
+            return
+        base, _ = QFileDialog.getOpenFileName(self, "Merge: Common Base Version", self.filename_dir, "KFM Files (*.kfm);;All Files (*)")
+        if not base:
+            return
+        theirs, _ = QFileDialog.getOpenFileName(self, "Merge: Their Version", self.filename_dir, "KFM Files (*.kfm);;All Files (*)")
+        if not theirs:
+            return
+        try:
+            merged, conflicts = kfm_diff.merge(kfm_io.read_kfm(base), self.data, kfm_io.read_kfm(theirs))
+            plain = to_plain(merged.to_data().kfm)
+        except Exception:
+            print(traceback.format_exc())
+            return
+
+        if not self.command_manager.execute(Command(type=CommandType.REPLACE_KFM, new_value=plain)):
+            return
+        print(f"Merged {theirs} into the opened file, {len(conflicts)} conflicts\n")
+        self.show_conflicts(conflicts)
+
+    # (kind, field) -> command that sets it
+    CONFLICT_COMMANDS = {
+        (kfm_diff.FILE, "nif_file_name"): CommandType.EDIT_NIF_FILENAME,
+        (kfm_diff.ANIMATION, "kf_file_name"): CommandType.EDIT_ANIMATION_KF_FILENAME,
+        (kfm_diff.ANIMATION, "index"): CommandType.EDIT_ANIMATION_INDEX,
+        (kfm_diff.TRANSITION, "type"): CommandType.EDIT_TRANSITION_TYPE,
+    }
+
+    def show_conflicts(self, conflicts):
+        # the conflicts of an earlier merge are gone once this one applied
+        self.close_conflicts()
+        if not conflicts:
+            return
+        self.conflicts = list(conflicts)
+        self.conflict_list = QListWidget(self)
+        for conflict in self.conflicts:
+            self.conflict_list.addItem(str(conflict))
+
+        use_theirs = QPushButton("Use Theirs", self)
+        use_theirs.clicked.connect(self.use_theirs)
+        use_ours = QPushButton("Use Ours", self)
+        use_ours.clicked.connect(lambda: self.resolve_conflict(self.conflict_list.currentRow()))
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(use_theirs)
+        buttons.addWidget(use_ours)
+        buttons.addStretch()
+        layout = QVBoxLayout()
+        layout.addWidget(self.conflict_list)
+        layout.addLayout(buttons)
+        page = QWidget()
+        page.setLayout(layout)
+        self.tabs.setCurrentIndex(self.tabs.addTab(page, f"Conflicts ({len(self.conflicts)})"))
+
+    def close_conflicts(self):
+        if self.conflict_list is not None:
+            page = self.conflict_list.parentWidget()
+            self.tabs.removeTab(self.tabs.indexOf(page))
+            page.deleteLater()
+        self.conflicts = None
+        self.conflict_list = None
+
+    def resolve_conflict(self, row):
+        # drops a resolved conflict from the list, and the tab with the last
+        if row < 0:
+            return
+        del self.conflicts[row]
+        self.conflict_list.takeItem(row)
+        if self.conflicts:
+            self.tabs.setTabText(self.tabs.indexOf(self.conflict_list.parentWidget()), f"Conflicts ({len(self.conflicts)})")
+        else:
+            self.close_conflicts()
+
+    def use_theirs(self):
+        row = self.conflict_list.currentRow()
+        if row < 0:
+            return
+        conflict = self.conflicts[row]
+        found, (animation_index, transition_index) = kfm_diff.locate(self.data, conflict.kind, conflict.key)
+        if conflict.kind == kfm_diff.FILE:
+            values = {conflict.key: conflict.theirs}
+        elif conflict.ours is not None and conflict.theirs is not None:
+            values = {name: conflict.theirs[name] for name in conflict.fields}
+        else:
+            values = None
+
+        if not found or values is None or any((conflict.kind, name) not in self.CONFLICT_COMMANDS for name in values):
+            print(f"Can't take theirs for {conflict} here, edit it by hand\n")
+            return
+        if self.command_manager.execute_many([
+            Command(type=self.CONFLICT_COMMANDS[(conflict.kind, name)], new_value=value, animation_index=animation_index, transition_index=transition_index)
+            for name, value in values.items()
+        ]):
+            self.resolve_conflict(row)
+
+    def replace_in_all_files(self):
+        # one transaction per file, so each file undoes on its own
+        if not self.documents:
+            return
+        fields = {"KF File Name": "kf_file_name", "NIF File Name": "nif_file_name", "Event Code": "event_code"}
+        name, ok = QInputDialog.getItem(self, "Replace in All Files", "Field:", list(fields), 0, False)
+        if not ok:
+            return
+        find, ok = QInputDialog.getText(self, "Replace in All Files", f"Find {name}:")
+        if not ok or not find:
+            return
+        replace, ok = QInputDialog.getText(self, "Replace in All Files", f"Replace '{find}' with:")
+        if not ok:
+            return
+
+        replaced = 0
+        files = 0
+        for document in self.documents:
+            try:
+                commands = replace_commands(document.data, document.command_manager.index, fields[name], find, replace)
+            except ValueError as e:
+                print(e, "\n")
+                return
+            if commands and document.command_manager.execute_many(commands):
+                print(f"... {len(commands)} in {os.path.basename(document.opened_filename)}")
+                replaced += len(commands)
+                files += 1
+        print(f"Replaced {name} '{find}' with '{replace}' {replaced} times in {files} of {len(self.documents)} files\n")
+
     def load_mission(self):
-        if self.prompt_unsaved_should_continue():
-            options = QFileDialog.Options()
-            filename, _ = QFileDialog.getOpenFileName(self, "Load KFM File", "", "KFM Files (*.kfm);;All Files (*)", options=options)
-            if filename:
-                self.load_mission_file(filename)
+        options = QFileDialog.Options()
+        filename, _ = QFileDialog.getOpenFileName(self, "Load KFM File", self.filename_dir or "", "KFM Files (*.kfm);;All Files (*)", options=options)
+        if filename:
+            self.load_mission_file(filename)
 
     def get_default_save_filename(base_filename):
         base_name, ext = os.path.splitext(base_filename)
@@ -682,7 +1740,7 @@ class UberKFM(QMainWindow):
             count += 1
         return new_filename
 
-    def save_mission(self, ask=True):
+    def save_mission(self, ask=True, wait=False):
         if getattr(self, "data", None) is not None:
             if ask:
                 options = QFileDialog.Options()
@@ -690,27 +1748,91 @@ class UberKFM(QMainWindow):
             else:
                 filename = self.opened_filename
             if filename:
-                with open(filename, 'wb') as file:
-                    if self.data:
-                        self.data.write(file)
-                        self.unsaved_changes = False
-                        self.refresh_ui()
+                # copy here so the worker writes a consistent snapshot while
+                # editing carries on; it serializes the copy too
+                try:
+                    snapshot = kfm_io.snapshot(self.data)
+                except Exception:
+                    print(traceback.format_exc())
+                    return False
+                document = self.document
+                generation = self.command_manager.generation
+                saved = []
+
+                def on_done(payload):
+                    print("Saved", filename, "\n")
+                    saved.append(filename)
+                    if os.path.abspath(filename) == os.path.abspath(document.opened_filename):
+                        document.disk_generation = generation
+                        # the journal now goes against the file as written,
+                        # keeping the edits made while it was being written;
+                        # until then it still matches the old file, so a
+                        # save that fails or never starts loses nothing
+                        if document.journal is not None:
+                            document.journal.restart(kfm_journal.digest(payload), generation, document.command_manager.snapshot)
+                    if document.command_manager.generation == generation:
+                        document.unsaved_changes = False
+                    document.refresh_ui()
+
+                task = IoTask(f"Saving {os.path.basename(filename)}", kfm_io.write_snapshot, snapshot, filename)
+                journal = document.journal
+                if journal is not None:
+                    task.finished.connect(lambda: task.error and journal.abort_save())
+                if not self.start_task(task, on_done):
+                    return False
+                if journal is not None:
+                    journal.begin_save()
+                if wait:
+                    task.wait()
+                    QApplication.processEvents()
+                    return bool(saved)
                 return True
             else:
                 return False
 
     def closeEvent(self, event):
-        if self.prompt_unsaved_should_continue():
-            event.accept()
-        else:
-            event.ignore()
+        if self.io_task is not None:
+            self.io_task.wait()
+            QApplication.processEvents()
+        for document in list(self.documents):
+            if not self.close_document(document):
+                event.ignore()
+                return
+        event.accept()
 
 if __name__ == '__main__':
+    # report how long each startup phase took and quit once the window is
+    # up and the format (and the file given, if any) is loaded
+    profile = '--profile-startup' in sys.argv
+    if profile:
+        sys.argv.remove('--profile-startup')
+
     app = QApplication(sys.argv)
+    startup_mark("QApplication")
 
     window = UberKFM()
+    startup_mark("main window")
     if len(sys.argv) > 1:
         file_path = sys.argv[1]
         window.load_mission_file(file_path)  
 
+    # the format classes are created once the window shows
+    preload = []
+    QTimer.singleShot(0, lambda: preload.append(kfm_io.preload_format()))
+
+    if profile:
+        def ready():
+            if window.io_task is not None or any(thread.is_alive() for thread in preload):
+                QTimer.singleShot(5, ready)
+                return
+            startup_mark("format and file loaded")
+            print(startup_report(), file=sys.__stdout__)
+            window.close()
+            app.quit()
+
+        def first_event_loop_turn():
+            startup_mark("first event loop turn")
+            QTimer.singleShot(0, ready)
+        QTimer.singleShot(0, first_event_loop_turn)
+
     sys.exit(app.exec_())
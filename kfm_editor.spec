@@ -1,16 +1,43 @@
 # -*- mode: python ; coding: utf-8 -*-
 
+import os
+import sys
+import ast
+
+# build the prebuilt KFM schema so the frozen editor doesn't parse kfm.xml
+sys.path.insert(0, SPECPATH)
+from our_pyffi.pyffi.formats.kfm import KfmFormat
+schema_file = KfmFormat.write_schema()
+
+# the command line modes are run with runpy, which the analysis can't see;
+# read them from kfm_editor.py rather than importing it, which needs Qt
+with open(os.path.join(SPECPATH, 'kfm_editor.py'), encoding='utf-8') as file:
+    cli_modes = next(
+        ast.literal_eval(node.value) for node in ast.parse(file.read()).body
+        if isinstance(node, ast.Assign) and any(getattr(target, 'id', None) == 'CLI_MODES' for target in node.targets)
+    )
+
+# modules the editor never imports at run time; distutils and setuptools
+# only come in through pyffi's setup.py helpers
+excludes = [
+    'distutils', 'setuptools', 'pkg_resources', 'tkinter', 'unittest', 'doctest', 'pydoc',
+    'numpy', 'PyQt5.QtNetwork', 'PyQt5.QtQml', 'PyQt5.QtQuick', 'PyQt5.QtSql', 'PyQt5.QtTest',
+    'PyQt5.QtXml', 'PyQt5.QtSvg', 'PyQt5.QtDBus', 'PyQt5.QtMultimedia', 'PyQt5.QtWebEngineWidgets',
+    'PyQt5.QtBluetooth', 'PyQt5.QtPositioning', 'PyQt5.QtSensors', 'PyQt5.QtSerialPort',
+]
 
 a = Analysis(
     ['kfm_editor.py'],
-    pathex=['./our_pyffi/pyffi'],
+    pathex=['./our_pyffi/pyffi', './our_pyffi'],
     binaries=[],
-    datas=[],
-    hiddenimports=[],
+    # nif.xml for the KF previews, which import NifFormat at run time
+    datas=[(schema_file, os.path.join('our_pyffi', 'pyffi', 'formats', 'kfm')),
+           (os.path.join('our_pyffi', 'pyffi', 'formats', 'nif', 'nifxml', 'nif.xml'), os.path.join('pyffi', 'formats', 'nif', 'nifxml'))],
+    hiddenimports=['pyffi.formats.nif'] + sorted(cli_modes.values()),
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=excludes,
     noarchive=False,
     optimize=0,
 )
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+# On-disk index of the references in every KFM below some directories:
+# NIF and master name, the KF file and event code of each animation and the
+# transition edges between event codes. Files are read with the single-pass
+# codec in a process pool, and an update only rereads the files whose mtime
+# or size changed, so asking "which KFMs use this KF" never opens a KFM.
+#
+# The index is one JSON file:
+#
+#   {"index": 1, "roots": [directory...], "files": {path: entry}}
+#
+# where an entry is
+#
+#   {"stamp": [mtime_ns, size], "version": int, "nif": name, "master": name,
+#    "animations": [[event_code, kf name]...],
+#    "transitions": [[source event code, target event code, type]...]}
+#
+# or {"stamp": [...], "error": message} for a file that could not be read.
+# Names are stored as latin-1 text, as in kfm_commands.to_plain.
+
+import sys
+import os
+import json
+import argparse
+import collections
+
+from kfm_io import kfm_format, kfm_codec, write_bytes_atomic
+
+INDEX_VERSION = 1
+
+DEFAULT_INDEX = "kfm_index.json"
+
+def name_key(name):
+    # references are matched the way the game looks files up: case does
+    # not matter and either slash separates directories
+    return name.replace("\\", "/").lower()
+
+def _name_matches(name, query):
+    # a query without a directory matches the file name in any directory
+    name, query = name_key(name), name_key(query)
+    return name == query or name.endswith("/" + query.lstrip("/"))
+
+def scan_file(filename, stamp=None):
+    # the index entry of one KFM
+    if stamp is None:
+        stamp = _stamp(os.stat(filename))
+    try:
+        with open(filename, 'rb') as file:
+            kfm = kfm_codec().read(file.read())
+    except (OSError, ValueError) as e:
+        return {"stamp": stamp, "error": str(e)}
+
+    animations = []
+    transitions = []
+    for anim in kfm.animations:
+        animations.append([anim.event_code, anim.kf_file_name.decode("latin-1")])
+        ts = anim.transitions
+        transitions.extend([anim.event_code, target, type_] for target, type_ in zip(ts.animation, ts.type))
+    return {
+        "stamp": stamp,
+        "version": kfm.version,
+        "nif": kfm.nif_file_name.decode("latin-1"),
+        "master": kfm.master.decode("latin-1"),
+        "animations": animations,
+        "transitions": transitions,
+    }
+
+def _scan_job(job):
+    return job[0], scan_file(*job)
+
+def _stamp(stat):
+    return [stat.st_mtime_ns, stat.st_size]
+
+def walk_kfm_files(root):
+    # {path: stamp} of the KFMs below root; scandir hands out the stat
+    # without a second lookup on most platforms
+    re_filename = kfm_format().RE_FILENAME
+    found = {}
+    pending = [root]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    pending.append(entry.path)
+                elif re_filename.match(entry.name):
+                    found[os.path.abspath(entry.path)] = _stamp(entry.stat())
+            except OSError:
+                pass
+    return found
+
+class KfmFileIndex:
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.roots = []
+        self.files = {}
+        self._reverse = None
+        if filename is not None and os.path.exists(filename):
+            self.load(filename)
+
+    def load(self, filename):
+        with open(filename, encoding='utf-8') as file:
+            index = json.load(file)
+        if index.get("index") != INDEX_VERSION:
+            # an index from another version is rebuilt by the next update
+            return
+        self.roots = index["roots"]
+        self.files = index["files"]
+        self._reverse = None
+
+    def save(self, filename=None):
+        filename = filename or self.filename
+        payload = json.dumps({"index": INDEX_VERSION, "roots": self.roots, "files": self.files}, separators=(",", ":"))
+        write_bytes_atomic(payload.encode('utf-8'), filename)
+
+    def update(self, roots=None, jobs=None, progress=None):
+        # brings the index up to date with the KFMs below roots (default: the
+        # roots indexed before), returns {"scanned", "unchanged", "removed",
+        # "errors"}; progress(done, total) counts the files read
+        roots = [os.path.abspath(root) for root in roots] if roots else list(self.roots)
+        for root in roots:
+            if root not in self.roots:
+                self.roots.append(root)
+
+        found = {}
+        for root in roots:
+            found.update(walk_kfm_files(root))
+
+        # files below the updated roots that are gone
+        removed = [path for path in self.files
+                   if path not in found and any(_below(path, root) for root in roots)]
+        for path in removed:
+            del self.files[path]
+
+        work = [(path, stamp) for path, stamp in found.items()
+                if self.files.get(path, {}).get("stamp") != stamp]
+        for path, entry in self._scan(work, jobs, progress):
+            self.files[path] = entry
+
+        self._reverse = None
+        return {
+            "scanned": len(work),
+            "unchanged": len(found) - len(work),
+            "removed": len(removed),
+            "errors": sum(1 for path, _ in work if "error" in self.files[path]),
+        }
+
+    @staticmethod
+    def _scan(work, jobs, progress):
+        # a pool only pays off once there are enough files to spread
+        if jobs == 1 or len(work) < 64:
+            yield from _reported(map(_scan_job, work), len(work), progress)
+            return
+        # imported here, as in kfm_batch
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunksize = max(1, len(work) // (8 * (jobs or os.cpu_count() or 1)))
+            yield from _reported(executor.map(_scan_job, work, chunksize=chunksize), len(work), progress)
+
+    def reverse(self):
+        # file name -> [(path, detail)] for nif, master and kf names, and
+        # event code -> [(path, ...)] for animations and transition targets;
+        # names are keyed by the lowercase file name without its directory
+        if self._reverse is None:
+            reverse = {kind: collections.defaultdict(list) for kind in ("nif", "master", "kf", "event", "target")}
+            for path, entry in self.files.items():
+                if "error" in entry:
+                    continue
+                for kind in ("nif", "master"):
+                    if entry[kind]:
+                        reverse[kind][_base_key(entry[kind])].append((path, entry[kind]))
+                for event_code, kf in entry["animations"]:
+                    reverse["kf"][_base_key(kf)].append((path, event_code, kf))
+                    reverse["event"][event_code].append((path, kf))
+                for source, target, type_ in entry["transitions"]:
+                    reverse["target"][target].append((path, source, type_))
+            self._reverse = reverse
+        return self._reverse
+
+    def _by_name(self, kind, name):
+        return [hit for hit in self.reverse()[kind].get(_base_key(name), []) if _name_matches(hit[-1], name)]
+
+    def files_using_nif(self, name):
+        # [path]
+        return [path for path, _ in self._by_name("nif", name)]
+
+    def files_using_master(self, name):
+        # [path]
+        return [path for path, _ in self._by_name("master", name)]
+
+    def files_using_kf(self, name):
+        # [(path, event code of the animation)]
+        return [(path, event_code) for path, event_code, kf in self._by_name("kf", name)]
+
+    def files_with_event(self, event_code):
+        # [(path, kf name)]
+        return list(self.reverse()["event"].get(event_code, []))
+
+    def transitions_to(self, event_code):
+        # [(path, source event code, transition type)]
+        return list(self.reverse()["target"].get(event_code, []))
+
+    def errors(self):
+        return {path: entry["error"] for path, entry in self.files.items() if "error" in entry}
+
+def _reported(results, total, progress):
+    if progress is not None:
+        progress(0, total)
+    for done, result in enumerate(results, 1):
+        if progress is not None and (done % 256 == 0 or done == total):
+            progress(done, total)
+        yield result
+
+def _base_key(name):
+    return name_key(name).rsplit("/", 1)[-1]
+
+def _below(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kfm_editor.py --index", description="Index the references of every KFM below some directories and query them.")
+    parser.add_argument("-i", "--index", default=DEFAULT_INDEX, help=f"index file (default: {DEFAULT_INDEX})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    update = commands.add_parser("update", help="scan new and changed KFMs")
+    update.add_argument("paths", nargs="*", help="directories to index (default: the ones indexed before)")
+    update.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per core)")
+
+    query = commands.add_parser("query", help="list the KFMs referencing a file or event code")
+    group = query.add_mutually_exclusive_group(required=True)
+    group.add_argument("--nif", help="KFMs using this NIF")
+    group.add_argument("--master", help="KFMs with this master")
+    group.add_argument("--kf", help="KFMs with an animation in this KF")
+    group.add_argument("--event", type=int, help="KFMs with an animation with this event code")
+    group.add_argument("--transition-to", type=int, help="KFMs with a transition to this event code")
+
+    commands.add_parser("errors", help="list the KFMs that could not be read")
+    args = parser.parse_args(argv)
+
+    index = KfmFileIndex(args.index)
+
+    if args.command == "update":
+        if not args.paths and not index.roots:
+            parser.error("no directories given and the index has none")
+        counts = index.update(args.paths, jobs=args.jobs)
+        index.save()
+        print(f"{counts['scanned']} scanned, {counts['unchanged']} unchanged, {counts['removed']} removed, {counts['errors']} unreadable, {len(index.files)} indexed")
+        return 0
+
+    if args.command == "errors":
+        for path, error in sorted(index.errors().items()):
+            print(f"{path}: {error}")
+        return 0
+
+    if args.nif is not None:
+        hits = [(path,) for path in index.files_using_nif(args.nif)]
+    elif args.master is not None:
+        hits = [(path,) for path in index.files_using_master(args.master)]
+    elif args.kf is not None:
+        hits = [(path, f"event {event_code}") for path, event_code in index.files_using_kf(args.kf)]
+    elif args.event is not None:
+        hits = index.files_with_event(args.event)
+    else:
+        hits = [(path, f"from {source}, type {type_}") for path, source, type_ in index.transitions_to(args.transition_to)]
+
+    for hit in sorted(hits):
+        print("  ".join(str(part) for part in hit))
+    return 0 if hits else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+# KFM file reading and writing shared by the editor and the batch mode:
+# progress reporting, cancellation and atomic saves
+
+import os
+import sys
+import io
+import tempfile
+import threading
+import contextlib
+import collections
+
+
+class Cancelled(Exception):
+    pass
+
+class ProgressStream:
+    # wraps a stream and calls progress(done, total) every `step` bytes read or
+    # written; progress may raise Cancelled to abort the operation
+    def __init__(self, stream, total, progress, step=1 << 16):
+        self.stream = stream
+        self.total = total
+        self.progress = progress
+        self.step = step
+        self.next_report = 0
+
+    def _advance(self):
+        pos = self.stream.tell()
+        if pos >= self.next_report:
+            self.next_report = pos + self.step
+            self.progress(pos, self.total)
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self._advance()
+        return data
+
+    def readline(self, size=-1):
+        data = self.stream.readline(size)
+        self._advance()
+        return data
+
+    def write(self, data):
+        result = self.stream.write(data)
+        self._advance()
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def kfm_format():
+    # the format classes are only created on first use, so starting the
+    # editor doesn't wait for them
+    from our_pyffi.pyffi.formats.kfm import KfmFormat
+    return KfmFormat
+
+def kfm_codec():
+    # the single-pass reader, for tools that only look at the values
+    from our_pyffi.pyffi.formats.kfm import codec
+    return codec
+
+def nif_format():
+    # for the KF previews; NifFormat imports pyffi by its own name, so the
+    # directory holding it has to be on the path
+    pyffi_parent = os.path.join(os.path.dirname(os.path.abspath(__file__)), "our_pyffi")
+    if pyffi_parent not in sys.path:
+        sys.path.append(pyffi_parent)
+    from pyffi.formats.nif import NifFormat
+    return NifFormat
+
+def preload_format():
+    # creates the format classes in the background, for the first file
+    # opened after startup
+    thread = threading.Thread(target=kfm_format, name="kfm-format", daemon=True)
+    thread.start()
+    return thread
+
+def read_kfm(filename, progress=None):
+    data = kfm_format().Data()
+    with open(filename, 'rb') as file:
+        stream = file
+        if progress is not None:
+            stream = ProgressStream(file, os.fstat(file.fileno()).st_size, progress)
+        data.inspect(stream)
+        data.read(stream)
+        if progress is not None:
+            progress(stream.total, stream.total)
+    return data
+
+def serialize(data):
+    buf = io.BytesIO()
+    data.write(buf)
+    return buf.getvalue()
+
+def snapshot(data):
+    # copy of data in the codec's compact model, quick enough to take on the
+    # GUI thread; write_snapshot serializes it on a worker while editing
+    # goes on
+    return kfm_codec().KfmFile.from_data(data)
+
+@contextlib.contextmanager
+def open_atomic(filename, mode='wb', **kwargs):
+    # write next to the target and rename over it, so a crash or cancel
+    # mid-write never leaves a truncated file behind
+    filename = os.path.abspath(filename)
+    directory, name = os.path.split(filename)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_filename = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, mode, **kwargs) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+
+        if os.path.exists(filename):
+            os.chmod(tmp_filename, os.stat(filename).st_mode & 0o7777)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+def write_bytes_atomic(payload, filename, progress=None, chunk_size=1 << 20):
+    with open_atomic(filename) as file:
+        view = memoryview(payload)
+        for start in range(0, len(view), chunk_size):
+            file.write(view[start:start + chunk_size])
+            if progress is not None:
+                progress(min(start + chunk_size, len(view)), len(view))
+
+def write_kfm(data, filename, progress=None):
+    write_bytes_atomic(serialize(data), filename, progress)
+
+def write_snapshot(kfm_file, filename, progress=None):
+    # returns the bytes written
+    payload = kfm_codec().write(kfm_file)
+    write_bytes_atomic(payload, filename, progress)
+    return payload
+
+class ParseCache:
+    # parsed files parked by path, valid while the file's mtime and size are
+    # unchanged; the least recently parked are dropped first. take() hands
+    # the data over rather than sharing it, so an edited copy is never
+    # served from the cache - park it again with put() once it matches the
+    # file on disk.
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def stamp(filename):
+        stat = os.stat(filename)
+        return stat.st_mtime_ns, stat.st_size
+
+    def take(self, filename, progress=None):
+        path = os.path.abspath(filename)
+        with self.lock:
+            entry = self.entries.pop(path, None)
+        if entry is not None and entry[0] == self.stamp(path):
+            if progress is not None:
+                progress(1, 1)
+            return entry[1]
+        return read_kfm(filename, progress)
+
+    def put(self, filename, data):
+        path = os.path.abspath(filename)
+        try:
+            stamp = self.stamp(path)
+        except OSError:
+            return
+        with self.lock:
+            self.entries[path] = (stamp, data)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def take_many(self, filenames, progress=None):
+        # [(filename, data or None, error or None)], progress counts files
+        results = []
+        for done, filename in enumerate(filenames):
+            if progress is not None:
+                progress(done, len(filenames))
+            try:
+                results.append((filename, self.take(filename), None))
+            except Exception as e:
+                results.append((filename, None, str(e)))
+        if progress is not None:
+            progress(len(filenames), len(filenames))
+        return results
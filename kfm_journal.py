@@ -0,0 +1,233 @@
+# Append-only autosave journal: every command applied to an opened KFM file
+# is appended to a small file next to it, so unsaved work survives a crash
+# and can be recovered by replaying the journal against the file as it was
+# when the journal was started.
+#
+# The journal is JSON lines. The first line is a header naming the file and
+# the SHA-1 of its contents, every further line is one history step:
+#
+#   {"do": {command}}       a command, same fields as a kfm_batch script step
+#   {"do": [{command}...]}  a transaction
+#   {"undo": 1}, {"redo": 1}
+#
+# Undo and redo entries only go as far back as the journal does. Undoing a
+# step from before it is journalled as a replace_kfm command holding the
+# data it led to.
+
+import os
+import json
+import queue
+import hashlib
+import logging
+import threading
+
+from kfm_commands import CommandType, Command
+
+JOURNAL_VERSION = 1
+
+log = logging.getLogger(__name__)
+
+def journal_path(filename):
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, f".{name}.journal")
+
+def digest(payload):
+    return hashlib.sha1(payload).hexdigest()
+
+def file_digest(filename):
+    with open(filename, 'rb') as file:
+        return digest(file.read())
+
+def command_to_dict(command):
+    return {
+        "type": command.type.value,
+        "new_value": command.new_value,
+        "animation_index": command.animation_index,
+        "transition_index": command.transition_index,
+    }
+
+def command_from_dict(step):
+    return Command(
+        type=CommandType(step["type"]),
+        new_value=step.get("new_value"),
+        animation_index=step.get("animation_index"),
+        transition_index=step.get("transition_index")
+    )
+
+def read_journal(filename):
+    # (header, entries) of the journal of filename, None if there is none;
+    # a line torn by a crash mid-append is skipped
+    try:
+        with open(journal_path(filename), encoding='utf-8') as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return None
+
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            log.warning("Skipping damaged journal line %r", line[:80])
+    if not records or records[0].get("journal") != JOURNAL_VERSION:
+        return None
+    return records[0], records[1:]
+
+def replay(manager, entries):
+    # re-applies journal entries through manager, returns the number of
+    # entries that applied; stops at the first one that doesn't, including
+    # an undo or redo with nothing to undo or redo
+    applied = 0
+    for entry in entries:
+        if "do" in entry:
+            if isinstance(entry["do"], list):
+                ok = manager.execute_many([command_from_dict(step) for step in entry["do"]])
+            else:
+                ok = manager.execute(command_from_dict(entry["do"]))
+            if not ok:
+                break
+        elif "undo" in entry:
+            if manager.history_pointer == 0:
+                break
+            manager.undo()
+        elif "redo" in entry:
+            if manager.history_pointer == len(manager.history):
+                break
+            manager.redo()
+        applied += 1
+    return applied
+
+def replay_depths(entries, depths=(0, 0)):
+    # (undo steps, redo steps) that replaying entries leaves in a history
+    # that has depths of them, None if one of them undoes or redoes past it
+    undoable, redoable = depths
+    for entry in entries:
+        if "undo" in entry:
+            if not undoable:
+                return None
+            undoable, redoable = undoable - 1, redoable + 1
+        elif "redo" in entry:
+            if not redoable:
+                return None
+            undoable, redoable = undoable + 1, redoable - 1
+        else:
+            undoable, redoable = undoable + 1, 0
+    return undoable, redoable
+
+class Journal:
+    # appends happen on a writer thread, record() only queues the line so
+    # CommandManager.execute never waits for the disk. Lines that pile up
+    # while an fsync runs are written and synced together.
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = journal_path(filename)
+        self.queue = queue.Queue()
+        # (generation, entry) of the entries recorded while a save is being
+        # written, so restart() can keep the ones after the data it wrote;
+        # None when no save is
+        self.entries = None
+        # undo and redo steps a replay of the journal has, see record_undo
+        self.depths = (0, 0)
+        self.thread = threading.Thread(target=self._run, name="kfm-journal", daemon=True)
+        self.thread.start()
+
+    def start(self, file_digest, entries=()):
+        # truncates the journal, the opened file now has this digest;
+        # entries, such as the ones just recovered, are kept in the new
+        # journal
+        entries = list(entries)
+        self.depths = replay_depths(entries) or (0, 0)
+        header = {"journal": JOURNAL_VERSION, "file": os.path.basename(self.filename), "sha1": file_digest}
+        self.queue.put(("start", "\n".join(json.dumps(record) for record in [header] + entries)))
+
+    def begin_save(self):
+        self.entries = []
+
+    def abort_save(self):
+        self.entries = None
+
+    def restart(self, file_digest, generation, snapshot):
+        # the file now holds the data as it was at generation; call only once
+        # it is written, so a failed save leaves the journal as it was. When
+        # the steps since then undo past it, the new journal starts from
+        # snapshot(), a command that recreates the current data, instead
+        kept = [entry for g, entry in self.entries or () if g > generation]
+        self.entries = None
+        if replay_depths(kept) is None:
+            kept = [{"do": command_to_dict(snapshot())}]
+        self.start(file_digest, kept)
+
+    def record(self, command, generation):
+        if isinstance(command, list):
+            self._append({"do": [command_to_dict(c) for c in command]}, generation)
+        else:
+            self._append({"do": command_to_dict(command)}, generation)
+
+    def record_undo(self, generation, snapshot):
+        # a replay only has the history of the journal, not the steps made
+        # before it started (or before the last save); an undo or redo of
+        # those is journalled as snapshot(), a command that recreates the
+        # data it led to
+        if self.depths[0]:
+            self._append({"undo": 1}, generation)
+        else:
+            self.record(snapshot(), generation)
+
+    def record_redo(self, generation, snapshot):
+        if self.depths[1]:
+            self._append({"redo": 1}, generation)
+        else:
+            self.record(snapshot(), generation)
+
+    def _append(self, entry, generation):
+        self.depths = replay_depths([entry], self.depths)
+        if self.entries is not None:
+            self.entries.append((generation, entry))
+        self.queue.put(("append", json.dumps(entry)))
+
+    def discard(self):
+        self.queue.put(("discard", None))
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(("close", None))
+        self.thread.join()
+
+    def _run(self):
+        file = None
+        running = True
+        while running:
+            ops = [self.queue.get()]
+            while True:
+                try:
+                    ops.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                for op, line in ops:
+                    if op != "append" and file is not None:
+                        file.close()
+                        file = None
+
+                    if op == "start":
+                        file = open(self.path, 'wb')
+                    elif op == "discard":
+                        if os.path.exists(self.path):
+                            os.remove(self.path)
+                    elif op == "close":
+                        running = False
+
+                    if line is not None and file is not None:
+                        file.write(line.encode('utf-8') + b"\n")
+
+                if file is not None:
+                    file.flush()
+                    os.fsync(file.fileno())
+            except Exception:
+                log.exception("Could not write the journal %s", self.path)
+            finally:
+                for _ in ops:
+                    self.queue.task_done()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+# Sequence metadata of the KF files that KFM animations refer to: the name,
+# start and stop time and text keys of the NiControllerSequence.
+#
+# read_sequence parses the header and then only the sequence block and the
+# text key block it links to, seeking past the rest where the header has
+# block sizes (20.2.0.7 and up) and reading forward to them otherwise. Files
+# whose layout the short path can't follow are read in full.
+#
+# PreviewCache hands out what it has without ever waiting: unknown files are
+# queued for a background thread, and on_loaded(path) is called from that
+# thread once a result is in. Results are kept per path and valid while the
+# file's mtime and size are unchanged, so rows that scroll into view again
+# cost a stat.
+
+import os
+import time
+import threading
+import collections
+
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from kfm_io import nif_format
+
+SEQUENCE_TYPES = ("NiControllerSequence", "NiSequence")
+TEXT_KEYS_TYPE = "NiTextKeyExtraData"
+
+@dataclass
+class SequenceInfo:
+    name: str = ""
+    start_time: Optional[float] = None
+    stop_time: Optional[float] = None
+    # (time, text) pairs in file order
+    text_keys: List[Tuple[float, str]] = field(default_factory=list)
+    # why the file has no sequence to show, None when it has one
+    error: Optional[str] = None
+
+    @property
+    def duration(self):
+        if self.start_time is not None:
+            return self.stop_time - self.start_time
+        if self.text_keys:
+            times = [time for time, _ in self.text_keys]
+            return max(times) - min(times)
+        return None
+
+    def __str__(self):
+        if self.error is not None:
+            return self.error
+        text = self.name
+        if self.duration is not None:
+            text += f"  {self.duration:.2f} s"
+        if self.text_keys:
+            text += f"  [{', '.join(key for _, key in self.text_keys)}]"
+        return text
+
+    def details(self):
+        # multi-line description, for tooltips
+        if self.error is not None:
+            return self.error
+        lines = [f"Sequence {self.name}"]
+        if self.start_time is not None:
+            lines.append(f"Time {self.start_time:.3f} - {self.stop_time:.3f} s")
+        lines.extend(f"{time:8.3f}  {key}" for time, key in self.text_keys)
+        return "\n".join(lines)
+
+def _text(value):
+    return value.decode("latin-1") if isinstance(value, bytes) else str(value)
+
+def _info(data, sequence, text_keys):
+    info = SequenceInfo(name=_text(sequence.name))
+    # NiControllerSequence times are in the file from 10.1.0.106 on
+    if data.version >= 0x0A01006A and hasattr(sequence, "stop_time"):
+        info.start_time = sequence.start_time
+        info.stop_time = sequence.stop_time
+    if text_keys is not None:
+        info.text_keys = [(key.time, _text(key.value)) for key in text_keys.text_keys]
+    return info
+
+def _block_type(data, block_num):
+    header = data.header
+    return header.block_types[header.block_type_index[block_num] & 0xfff].decode("ascii")
+
+def _read_block(stream, data, block_num):
+    # one block at the stream position, with the block indices it links to
+    NifFormat = nif_format()
+    block_type = _block_type(data, block_num)
+    if data.version <= 0x0A01006A and not block_type.startswith("bhk"):
+        # block tag, as in NifFormat.Data.read
+        stream.read(4)
+    block = getattr(NifFormat, block_type)()
+    data._link_stack = []
+    block.read(stream, data)
+    return block, data._link_stack
+
+def _text_keys_link(links, types):
+    # the text key block among the blocks a sequence links to
+    return next((link for link in links if 0 <= link < len(types) and types[link] == TEXT_KEYS_TYPE), None)
+
+def _read_full(stream):
+    data = nif_format().Data()
+    stream.seek(0)
+    data.read(stream)
+    for block in data.blocks:
+        if type(block).__name__ in SEQUENCE_TYPES:
+            # the struct hands out the Ref itself rather than its block
+            text_keys = block.text_keys
+            return _info(data, block, text_keys.get_value() if isinstance(text_keys, nif_format().Ref) else text_keys)
+    return SequenceInfo(error="no sequence")
+
+def _read_sequence(stream):
+    data = nif_format().Data()
+    data.inspect_version_only(stream)
+    data.header.read(stream, data=data)
+    # NiDataStream blocks carry their usage in the type name
+    if data.version < 0x05000001 or any(b"\x01" in name for name in data.header.block_types):
+        return _read_full(stream)
+    data._string_list = list(data.header.strings)
+    types = [_block_type(data, num) for num in range(data.header.num_blocks)]
+    sequence_type = next((block_type for block_type in types if block_type in SEQUENCE_TYPES), None)
+    if sequence_type is None:
+        return SequenceInfo(error="no sequence")
+
+    start = stream.tell()
+    if data.version >= 0x14020007:
+        # seek straight to the two blocks
+        offsets = [start]
+        for size in data.header.block_size:
+            offsets.append(offsets[-1] + size)
+        stream.seek(offsets[types.index(sequence_type)])
+        sequence, links = _read_block(stream, data, types.index(sequence_type))
+        text_keys_num = _text_keys_link(links, types)
+        text_keys = None
+        if text_keys_num is not None:
+            stream.seek(offsets[text_keys_num])
+            text_keys, _ = _read_block(stream, data, text_keys_num)
+        return _info(data, sequence, text_keys)
+
+    # read forward until both are in, keeping the text keys on the way in
+    # case they come before the sequence
+    sequence = text_keys_num = None
+    text_keys = {}
+    for num, block_type in enumerate(types):
+        block, links = _read_block(stream, data, num)
+        if block_type == TEXT_KEYS_TYPE:
+            text_keys[num] = block
+        if sequence is None and block_type == sequence_type:
+            sequence = block
+            text_keys_num = _text_keys_link(links, types)
+        if sequence is not None and (text_keys_num is None or text_keys_num in text_keys):
+            break
+    return _info(data, sequence, text_keys.get(text_keys_num))
+
+def read_sequence(filename):
+    # SequenceInfo of a KF file, with error set when it can't be read
+    try:
+        with open(filename, 'rb') as stream:
+            return _read_sequence(stream)
+    except OSError as e:
+        return SequenceInfo(error=e.strerror or str(e))
+    except Exception as e:
+        return SequenceInfo(error=f"unreadable: {e}")
+
+class PreviewCache:
+    # get() runs for every visible row on every paint, so it never touches
+    # the disk: the worker thread reads the files, and checks again whether
+    # a file changed once its entry is older than recheck seconds
+    def __init__(self, on_loaded=None, reader=read_sequence, recheck=2.0):
+        self.on_loaded = on_loaded
+        self.reader = reader
+        self.recheck = recheck
+        # path -> (stamp, SequenceInfo, time checked)
+        self.entries = {}
+        # paths to read or check, the most recently asked for first, so rows
+        # in view are read before the ones that scrolled past
+        self.queue = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.thread = None
+
+    @staticmethod
+    def stamp(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, path):
+        # SequenceInfo of path, None until it has been read; an entry due
+        # for a check is returned as it is while the worker checks it
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and time.monotonic() - entry[2] < self.recheck:
+                return entry[1]
+            self.queue[path] = None
+            self.queue.move_to_end(path, last=False)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="kf-preview", daemon=True)
+                self.thread.start()
+            self.wake.notify()
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.queue.clear()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.wake.wait()
+                path, _ = self.queue.popitem(last=False)
+                entry = self.entries.get(path)
+            # stamped before reading, so a write during the read is read again
+            stamp = self.stamp(path)
+            if entry is not None and entry[0] == stamp:
+                with self.lock:
+                    self.entries[path] = (stamp, entry[1], time.monotonic())
+                continue
+            info = self.reader(path) if stamp is not None else SequenceInfo(error="not found")
+            with self.lock:
+                self.entries[path] = (stamp, info, time.monotonic())
+            if self.on_loaded is not None:
+                self.on_loaded(path)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# Resolves the NIF and KF names in KFM files against asset directories.
+#
+# A name matches a file below one of the asset roots the way the game looks
+# it up: case does not matter (as for KfmFormat.FilePath.get_hash) and
+# either slash separates directories. A name without a directory matches
+# the file name anywhere below the roots; a name with directories must match
+# the end of the path. When several files match, the one next to the KFM
+# wins, otherwise the reference is ambiguous.
+#
+# The roots are walked once into an AssetIndex, after which every lookup is
+# a dict lookup, so checking a whole directory of KFMs costs one read of
+# each KFM. check_files spreads those reads over a process pool.
+
+import sys
+import os
+import argparse
+
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from kfm_index import name_key, scan_file, walk_kfm_files
+
+RESOLVED = "resolved"
+MISSING = "missing"
+AMBIGUOUS = "ambiguous"
+
+FIELD_NAMES = {"nif_file_name": "NIF File Name", "kf_file_name": "KF File Name"}
+
+@dataclass
+class Resolution:
+    status: str
+    # the matching files, several for an ambiguous reference
+    paths: List[str] = field(default_factory=list)
+
+    def __str__(self):
+        if self.status == RESOLVED:
+            return self.paths[0]
+        if self.status == MISSING:
+            return "not found below the asset roots"
+        return f"{len(self.paths)} files match:\n" + "\n".join(self.paths)
+
+@dataclass
+class Reference:
+    field: str
+    # row of the animation, None for the NIF
+    animation: Optional[int]
+    name: str
+    resolution: Resolution
+
+    def __str__(self):
+        where = FIELD_NAMES[self.field] if self.animation is None else f"Animation {self.animation + 1} {FIELD_NAMES[self.field]}"
+        text = f"{self.resolution.status:>9} {where} {self.name!r}"
+        if self.resolution.status == AMBIGUOUS:
+            text += ": " + ", ".join(self.resolution.paths)
+        return text
+
+class AssetIndex:
+    # file name -> paths of the files below the roots
+    def __init__(self, roots=(), progress=None):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.by_name = {}
+        for done, root in enumerate(self.roots):
+            if progress is not None:
+                progress(done, len(self.roots))
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames:
+                    self.by_name.setdefault(name.lower(), []).append(os.path.join(dirpath, name))
+        if progress is not None:
+            progress(len(self.roots), len(self.roots))
+
+    def __len__(self):
+        return sum(len(paths) for paths in self.by_name.values())
+
+    def resolve(self, name, kfm_dir=None):
+        # Resolution of name, referenced from a KFM in kfm_dir
+        key = name_key(name).strip("/")
+        paths = self.by_name.get(key.rsplit("/", 1)[-1], [])
+        if "/" in key:
+            paths = [path for path in paths if name_key(path).endswith("/" + key)]
+        if len(paths) > 1 and kfm_dir is not None:
+            beside = name_key(os.path.join(os.path.abspath(kfm_dir), key))
+            paths = [path for path in paths if name_key(path) == beside] or paths
+        if not paths:
+            return Resolution(MISSING)
+        return Resolution(RESOLVED if len(paths) == 1 else AMBIGUOUS, list(paths))
+
+    def references(self, names, kfm_dir=None):
+        # [Reference] for the (field, animation row, name) triples of a file,
+        # empty names are not references
+        return [Reference(field, row, name, self.resolve(name, kfm_dir)) for field, row, name in names if name]
+
+def data_names(data):
+    # (field, animation row, name) of the references in a KfmFormat.Data
+    names = [("nif_file_name", None, data.nif_file_name.decode("latin-1"))]
+    names.extend(("kf_file_name", row, anim.kf_file_name.decode("latin-1")) for row, anim in enumerate(data.animations))
+    return names
+
+def entry_names(entry):
+    # the same for a kfm_index entry
+    names = [("nif_file_name", None, entry["nif"])]
+    names.extend(("kf_file_name", row, kf) for row, (_, kf) in enumerate(entry["animations"]))
+    return names
+
+def check_file(filename, assets):
+    # {"file", "error" or "references": [Reference]} with the references
+    # that did not resolve
+    entry = scan_file(filename)
+    if "error" in entry:
+        return {"file": filename, "error": entry["error"]}
+    references = assets.references(entry_names(entry), os.path.dirname(os.path.abspath(filename)))
+    return {"file": filename, "references": [ref for ref in references if ref.resolution.status != RESOLVED]}
+
+# the AssetIndex of a pool worker, sent once rather than with every file
+_worker_assets = None
+
+def _init_worker(assets):
+    global _worker_assets
+    _worker_assets = assets
+
+def _check_job(filename):
+    return check_file(filename, _worker_assets)
+
+def check_files(filenames, assets, jobs=None, progress=None):
+    # check_file of every file, in order; progress counts files
+    total = len(filenames)
+    if progress is not None:
+        progress(0, total)
+    if jobs == 1 or total < 64:
+        results = (check_file(filename, assets) for filename in filenames)
+        executor = None
+    else:
+        # imported here, as in kfm_batch. Spawned rather than forked, the
+        # editor calls this from a worker thread
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_worker, initargs=(assets,))
+        chunksize = max(1, total // (8 * (jobs or os.cpu_count() or 1)))
+        results = executor.map(_check_job, filenames, chunksize=chunksize)
+
+    report = []
+    try:
+        for done, result in enumerate(results, 1):
+            report.append(result)
+            if progress is not None and (done % 64 == 0 or done == total):
+                progress(done, total)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return report
+
+def find_files(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(walk_kfm_files(path)))
+        else:
+            filenames.append(os.path.abspath(path))
+    return filenames
+
+def format_report(report):
+    # the lines of a check_files report and a one line summary
+    lines = []
+    counts = {MISSING: 0, AMBIGUOUS: 0}
+    errors = 0
+    for result in report:
+        if "error" in result:
+            errors += 1
+            lines.append(f"{result['file']}: {result['error']}")
+            continue
+        if result["references"]:
+            lines.append(result["file"])
+        for ref in result["references"]:
+            counts[ref.resolution.status] += 1
+            lines.append("  " + str(ref))
+    summary = f"{len(report)} files, {counts[MISSING]} missing and {counts[AMBIGUOUS]} ambiguous references"
+    if errors:
+        summary += f", {errors} unreadable"
+    return lines, summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kfm_editor.py --resolve", description="Report the NIF and KF references of KFM files that are missing from, or ambiguous in, the asset directories.")
+    parser.add_argument("paths", nargs="+", help="KFM files or directories to search for KFM files")
+    parser.add_argument("-a", "--assets", action="append", help="asset directory to resolve against, may be given several times (default: the paths given)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per core)")
+    args = parser.parse_args(argv)
+
+    assets = AssetIndex(args.assets or [path for path in args.paths if os.path.isdir(path)])
+    lines, summary = format_report(check_files(find_files(args.paths), assets, jobs=args.jobs))
+    for line in lines:
+        print(line)
+    print(summary)
+    return 1 if lines else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,604 @@
+#!/usr/bin/env python
+
+# Lossless JSON and YAML interchange for KFM files, for reviewing, diffing
+# and generating them as text.
+#
+# A document is one mapping:
+#
+#   {"kfm_text": 1, "version": "2.2.0.1b", "dos_eol": false,
+#    "unknown_byte": 0, "nif_file_name": ..., "master": ...,
+#    "unknown_int_1": ..., "unknown_int_2": ..., "unknown_float_1": ...,
+#    "unknown_float_2": ..., "unknown_int_3": ...,
+#    "animations": [{"event_code", "name", "kf_file_name", "index",
+#                    "transitions": [{"animation", "type", "duration",
+#                                     "intermediate_anims": [{"unknown_int", "event"}],
+#                                     "num_text_key_pairs"}],
+#                    "unknown_data": [{"string_1", "string_2", "unk_float_1".."unk_float_4"}],
+#                    "unknown_int",
+#                    "unknown_data_2": [{"string_1", "unk_float"}]}]}
+#
+# with the field names of kfm.xml. Only the fields the version has are
+# written, and missing ones read as their defaults. Strings are latin-1
+# text, as in kfm_commands.to_plain, so any byte survives, and floats are
+# written as the shortest decimal that reads back as the same float32.
+# The default NaN is written as NaN (.nan in YAML); a NaN with other bits,
+# a sign or a payload, is written as the string "nan:0x" and its float32
+# bits, e.g. "nan:0xffc00001", and reads back to those bits. Signalling
+# NaNs cannot be kept: Python quiets them as it unpacks the float32, so
+# they arrive here, as in the codec, with the quiet bit set.
+#
+# Both directions stream: the writer emits one animation at a time from the
+# codec's KfmFile, and the readers hand out one animation at a time, which
+# goes straight into the KfmFile, so no document tree is built on the way.
+
+import sys
+import os
+import re
+import json
+import math
+import struct
+import argparse
+
+from kfm_io import kfm_format, kfm_codec, open_atomic, write_bytes_atomic
+
+TEXT_VERSION = 1
+
+JSON = "json"
+YAML = "yaml"
+EXTENSIONS = {".json": JSON, ".yaml": YAML, ".yml": YAML}
+
+# versions at which fields come and go, as in the codec
+_V_1_2_0_0 = 0x01020000
+_V_1_2_4B = 0x01024B00
+_V_2_0_0_0 = 0x02000000
+_V_2_2_0_1B = 0x0202001B
+
+# transitions of this type have no details
+_NO_DETAILS = 5
+
+_FLOAT32 = struct.Struct("<f")
+_UINT32 = struct.Struct("<I")
+_DEFAULT_NAN = _UINT32.unpack(_FLOAT32.pack(math.nan))[0]
+_NAN_BITS = re.compile(r"nan:0x([0-9a-fA-F]{8})\Z")
+
+_DELIMITER = re.compile(r"[,:\]}]")
+
+FILE_FIELDS = {
+    "dos_eol": bool, "unknown_byte": int, "nif_file_name": str, "master": str,
+    "unknown_int_1": int, "unknown_int_2": int, "unknown_float_1": float, "unknown_float_2": float,
+    "unknown_int_3": int,
+}
+ANIMATION_FIELDS = {"event_code": int, "name": str, "kf_file_name": str, "index": int, "unknown_int": int}
+TRANSITION_FIELDS = {"animation": int, "type": int, "duration": float, "num_text_key_pairs": int}
+INTERMEDIATE_FIELDS = {"unknown_int": int, "event": str}
+UNKNOWN_DATA_FIELDS = {"string_1": str, "string_2": str, "unk_float_1": float, "unk_float_2": float,
+                       "unk_float_3": float, "unk_float_4": float}
+UNKNOWN_DATA_2_FIELDS = {"string_1": str, "unk_float": float}
+
+def format_of(filename):
+    # JSON or YAML by the extension of a text file, None for others
+    return EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+def _short_float(value):
+    # shortest decimal that reads back as the same float32
+    if not math.isfinite(value):
+        if math.isnan(value):
+            bits = _UINT32.unpack(_FLOAT32.pack(value))[0]
+            if bits != _DEFAULT_NAN:
+                return f"nan:0x{bits:08x}"
+        return value
+    packed = _FLOAT32.pack(value)
+    for digits in range(6, 10):
+        short = float(f"{value:.{digits}g}")
+        if _FLOAT32.pack(short) == packed:
+            return short
+    return value
+
+def _text(value):
+    return value.decode("latin-1")
+
+# writing
+
+def _file_items(kfm):
+    # (name, value) of the file fields the version has
+    version = kfm.version
+    yield "dos_eol", kfm.dos_eol
+    if version >= _V_2_0_0_0:
+        yield "unknown_byte", kfm.unknown_byte
+    if version >= _V_1_2_0_0:
+        yield "nif_file_name", _text(kfm.nif_file_name)
+        yield "master", _text(kfm.master)
+        yield "unknown_int_1", kfm.unknown_int_1
+        yield "unknown_int_2", kfm.unknown_int_2
+        yield "unknown_float_1", _short_float(kfm.unknown_float_1)
+        yield "unknown_float_2", _short_float(kfm.unknown_float_2)
+        yield "unknown_int_3", kfm.unknown_int_3
+
+def _animation_record(anim, version):
+    # plain record of one animation; the transitions and unknown data are
+    # lists of records
+    record = {"event_code": anim.event_code}
+    if version <= _V_1_2_4B:
+        record["name"] = _text(anim.name)
+    record["kf_file_name"] = _text(anim.kf_file_name)
+    record["index"] = anim.index
+    transitions = []
+    ts = anim.transitions
+    for target, type_, duration, intermediates, text_key_pairs in zip(
+            ts.animation, ts.type, ts.duration, ts.intermediate_anims, ts.num_text_key_pairs):
+        transition = {"animation": target, "type": type_}
+        if type_ != _NO_DETAILS:
+            transition["duration"] = _short_float(duration)
+            transition["intermediate_anims"] = [{"unknown_int": i.unknown_int, "event": _text(i.event)} for i in intermediates]
+            transition["num_text_key_pairs"] = text_key_pairs
+        transitions.append(transition)
+    record["transitions"] = transitions
+    if version == _V_2_2_0_1B:
+        record["unknown_data"] = [
+            dict({"string_1": _text(u.string_1), "string_2": _text(u.string_2)},
+                 **{f"unk_float_{i}": _short_float(f) for i, f in enumerate(u.unk_floats, 1)})
+            for u in anim.unknown_data]
+        record["unknown_int"] = anim.unknown_int
+        record["unknown_data_2"] = [{"string_1": _text(u.string_1), "unk_float": _short_float(u.unk_float)}
+                                    for u in anim.unknown_data_2]
+    return record
+
+def _version_string(version):
+    for string, number in kfm_format().versions.items():
+        if number == version:
+            return string
+    raise ValueError("KFM version 0x%08X not supported." % version)
+
+def write_json(kfm, stream):
+    # one field per line, and one line per transition and unknown data
+    # record, so diffs point at the record that changed
+    write = stream.write
+    write('{\n  "kfm_text": %d,\n  "version": %s' % (TEXT_VERSION, json.dumps(_version_string(kfm.version))))
+    for name, value in _file_items(kfm):
+        write(',\n  "%s": %s' % (name, json.dumps(value)))
+    if kfm.version < _V_1_2_0_0:
+        write("\n}\n")
+        return
+    write(',\n  "animations": [')
+    for i, anim in enumerate(kfm.animations):
+        write(",\n    {" if i else "\n    {")
+        for j, (name, value) in enumerate(_animation_record(anim, kfm.version).items()):
+            write(",\n      " if j else "\n      ")
+            write(json.dumps(name) + ": ")
+            if isinstance(value, list) and value:
+                write("[\n        " + ",\n        ".join(json.dumps(item) for item in value) + "\n      ]")
+            else:
+                write(json.dumps(value))
+        write("\n    }")
+    write("\n  ]\n}\n" if kfm.animations else "]\n}\n")
+
+def _yaml():
+    # PyYAML is only needed for YAML
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError("YAML needs PyYAML (pip install pyyaml)")
+    return yaml
+
+def _yaml_scalar(value):
+    yaml = _yaml()
+    if isinstance(value, str):
+        return yaml.ScalarEvent(None, None, (False, True), value, style='"')
+    if isinstance(value, bool):
+        text = "true" if value else "false"
+    elif isinstance(value, float) and not math.isfinite(value):
+        text = ".nan" if math.isnan(value) else (".inf" if value > 0 else "-.inf")
+    else:
+        text = repr(value)
+    return yaml.ScalarEvent(None, None, (True, False), text)
+
+def _yaml_flow(value):
+    # a record inside a list, on one line
+    yaml = _yaml()
+    if isinstance(value, dict):
+        yield yaml.MappingStartEvent(None, None, True, flow_style=True)
+        for name, item in value.items():
+            yield _yaml_scalar(name)
+            yield from _yaml_flow(item)
+        yield yaml.MappingEndEvent()
+    elif isinstance(value, list):
+        yield yaml.SequenceStartEvent(None, None, True, flow_style=True)
+        for item in value:
+            yield from _yaml_flow(item)
+        yield yaml.SequenceEndEvent()
+    else:
+        yield _yaml_scalar(value)
+
+def _yaml_document(kfm):
+    yaml = _yaml()
+    yield yaml.StreamStartEvent()
+    yield yaml.DocumentStartEvent()
+    yield yaml.MappingStartEvent(None, None, True, flow_style=False)
+    yield _yaml_scalar("kfm_text")
+    yield _yaml_scalar(TEXT_VERSION)
+    yield _yaml_scalar("version")
+    yield _yaml_scalar(_version_string(kfm.version))
+    for name, value in _file_items(kfm):
+        yield _yaml_scalar(name)
+        yield _yaml_scalar(value)
+    if kfm.version >= _V_1_2_0_0:
+        yield _yaml_scalar("animations")
+        yield yaml.SequenceStartEvent(None, None, True, flow_style=False)
+        for anim in kfm.animations:
+            yield from _animation_yaml(_animation_record(anim, kfm.version))
+        yield yaml.SequenceEndEvent()
+    yield yaml.MappingEndEvent()
+    yield yaml.DocumentEndEvent()
+    yield yaml.StreamEndEvent()
+
+def _animation_yaml(record):
+    yaml = _yaml()
+    # the animation as a block mapping, its records one flow mapping per line
+    yield yaml.MappingStartEvent(None, None, True, flow_style=False)
+    for name, value in record.items():
+        yield _yaml_scalar(name)
+        if isinstance(value, list):
+            yield yaml.SequenceStartEvent(None, None, True, flow_style=not value)
+            for item in value:
+                yield from _yaml_flow(item)
+            yield yaml.SequenceEndEvent()
+        else:
+            yield _yaml_scalar(value)
+    yield yaml.MappingEndEvent()
+
+def write_yaml(kfm, stream):
+    yaml = _yaml()
+    # libyaml's emitter when PyYAML was built with it, it is many times faster
+    yaml.emit(_yaml_document(kfm), stream, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper), width=1 << 16)
+
+def dump(kfm, stream, format=JSON):
+    # writes a codec KfmFile or a KfmFormat.Data to a text stream
+    if not isinstance(kfm, kfm_codec().KfmFile):
+        kfm = kfm_codec().KfmFile.from_data(kfm)
+    (write_yaml if format == YAML else write_json)(kfm, stream)
+
+# reading
+
+class _JsonScanner:
+    # pulls JSON values off a text stream a chunk at a time; values are
+    # decoded with json's own decoder once they are wholly in the buffer
+    def __init__(self, stream, chunk_size=1 << 16):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # next character that isn't white space, "" at the end
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"expected {' or '.join(repr(c) for c in chars)} but got {char or 'end of file'!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                if self.eof or not self.fill():
+                    raise ValueError(f"bad JSON: {e.msg}")
+                continue
+            # a number cut off by the end of the buffer reads as a shorter
+            # one, so a value counts once the delimiter after it is in
+            if not self.eof and not _DELIMITER.search(self.buffer, end) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        # (key, value) of the top level mapping, "animations" as an
+        # iterator over the animation records
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            if key == "animations":
+                yield key, self.elements()
+            else:
+                yield key, self.value()
+            if self.expect(",}") == "}":
+                return
+
+    def elements(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+def _read_json(stream):
+    return _JsonScanner(stream).items()
+
+def _yaml_plain(text):
+    # plain scalars by the YAML core schema, as far as KFM values go
+    lowered = text.lower()
+    if lowered in ("true", "false"):
+        return lowered == "true"
+    if lowered in ("null", "~", ""):
+        return None
+    if lowered in (".nan",):
+        return math.nan
+    if lowered in (".inf", "+.inf", "-.inf"):
+        return -math.inf if lowered.startswith("-") else math.inf
+    try:
+        return int(text, 0)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+def _yaml_value(events, event):
+    yaml = _yaml()
+    if isinstance(event, yaml.ScalarEvent):
+        return event.value if event.style else _yaml_plain(event.value)
+    if isinstance(event, yaml.MappingStartEvent):
+        mapping = {}
+        for event in events:
+            if isinstance(event, yaml.MappingEndEvent):
+                return mapping
+            mapping[_yaml_value(events, event)] = _yaml_value(events, next(events))
+    if isinstance(event, yaml.SequenceStartEvent):
+        sequence = []
+        for event in events:
+            if isinstance(event, yaml.SequenceEndEvent):
+                return sequence
+            sequence.append(_yaml_value(events, event))
+    raise ValueError(f"unexpected {type(event).__name__} in YAML")
+
+def _read_yaml(stream):
+    yaml = _yaml()
+    events = yaml.parse(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    for event in events:
+        if isinstance(event, yaml.MappingStartEvent):
+            break
+        if not isinstance(event, (yaml.StreamStartEvent, yaml.DocumentStartEvent)):
+            raise ValueError("a KFM document is a mapping")
+    for event in events:
+        if isinstance(event, yaml.MappingEndEvent):
+            return
+        key = _yaml_value(events, event)
+        event = next(events)
+        if key == "animations" and isinstance(event, yaml.SequenceStartEvent):
+            yield key, _yaml_elements(events)
+        else:
+            yield key, _yaml_value(events, event)
+
+def _yaml_elements(events):
+    yaml = _yaml()
+    for event in events:
+        if isinstance(event, yaml.SequenceEndEvent):
+            return
+        yield _yaml_value(events, event)
+
+def _nan(text):
+    # the float of a "nan:0x..." NaN written by _short_float, None for others
+    match = _NAN_BITS.match(text)
+    if not match:
+        return None
+    value = _FLOAT32.unpack(_UINT32.pack(int(match.group(1), 16)))[0]
+    return value if math.isnan(value) else None
+
+def _checked(value, type_, where):
+    if type_ is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if type_ is float and isinstance(value, str) and _nan(value) is not None:
+        return _nan(value)
+    if type(value) is not type_:
+        raise ValueError(f"{where} should be {type_.__name__}, not {value!r}")
+    if type_ is str:
+        try:
+            return value.encode("latin-1")
+        except UnicodeEncodeError:
+            raise ValueError(f"{where} has characters outside latin-1: {value!r}")
+    return value
+
+def _fields(record, fields, where):
+    # record checked against fields, strings as bytes
+    if not isinstance(record, dict):
+        raise ValueError(f"{where} should be a mapping, not {record!r}")
+    unknown = set(record) - set(fields)
+    if unknown:
+        raise ValueError(f"{where} has unknown fields {', '.join(sorted(unknown))}")
+    return {name: _checked(value, fields[name], f"{where} {name}") for name, value in record.items()}
+
+def _list(record, name, where):
+    value = record.pop(name, [])
+    if not isinstance(value, list):
+        raise ValueError(f"{where} {name} should be a list, not {value!r}")
+    return value
+
+def _animation(record, where):
+    codec = kfm_codec()
+    if not isinstance(record, dict):
+        raise ValueError(f"{where} should be a mapping, not {record!r}")
+    record = dict(record)
+    transitions = _list(record, "transitions", where)
+    unknown_data = _list(record, "unknown_data", where)
+    unknown_data_2 = _list(record, "unknown_data_2", where)
+    anim = codec.Animation()
+    for name, value in _fields(record, ANIMATION_FIELDS, where).items():
+        setattr(anim, name, value)
+    for i, transition in enumerate(transitions):
+        t_where = f"{where} transition {i + 1}"
+        if isinstance(transition, dict):
+            transition = dict(transition)
+        intermediates = _list(transition, "intermediate_anims", t_where) if isinstance(transition, dict) else []
+        t = _fields(transition, TRANSITION_FIELDS, t_where)
+        anim.transitions.append(
+            t.get("animation", 0), t.get("type", 0), t.get("duration", 0.0),
+            (codec.IntermediateAnim(**_fields(inter, INTERMEDIATE_FIELDS, f"{t_where} intermediate anim {j + 1}"))
+             for j, inter in enumerate(intermediates)),
+            t.get("num_text_key_pairs", 0))
+    for i, u in enumerate(unknown_data):
+        u = _fields(u, UNKNOWN_DATA_FIELDS, f"{where} unknown data {i + 1}")
+        anim.unknown_data.append(codec.UnknownData(
+            u.get("string_1", b""), u.get("string_2", b""),
+            tuple(u.get(f"unk_float_{n}", 0.0) for n in range(1, 5))))
+    for i, u in enumerate(unknown_data_2):
+        anim.unknown_data_2.append(codec.UnknownData2(**_fields(u, UNKNOWN_DATA_2_FIELDS, f"{where} unknown data 2 {i + 1}")))
+    return anim
+
+def _build(items):
+    # KfmFile from (key, value) pairs, the animations added as they come
+    kfm = kfm_codec().KfmFile()
+    seen = set()
+    for key, value in items:
+        if key in seen:
+            raise ValueError(f"{key} given twice")
+        seen.add(key)
+        if key == "kfm_text":
+            if value != TEXT_VERSION:
+                raise ValueError(f"kfm_text {value!r} not supported")
+        elif key == "version":
+            if value not in kfm_format().versions:
+                raise ValueError(f"KFM version {value!r} not supported")
+            kfm.version = kfm_format().versions[value]
+        elif key == "animations":
+            if isinstance(value, list):
+                value = iter(value)
+            elif not hasattr(value, "__next__"):
+                raise ValueError(f"animations should be a list, not {value!r}")
+            for i, record in enumerate(value):
+                kfm.animations.append(_animation(record, f"animation {i + 1}"))
+        elif key in FILE_FIELDS:
+            setattr(kfm, key, _checked(value, FILE_FIELDS[key], key))
+        else:
+            raise ValueError(f"unknown field {key}")
+    if "version" not in seen:
+        raise ValueError("no version given")
+    return kfm
+
+def load(stream, format=JSON):
+    # codec KfmFile from a text stream
+    return _build(_read_yaml(stream) if format == YAML else _read_json(stream))
+
+def load_data(stream, format=JSON):
+    # the same as a KfmFormat.Data
+    return load(stream, format).to_data()
+
+# files
+
+def export_file(filename, output, format=JSON):
+    with open(filename, 'rb') as file:
+        kfm = kfm_codec().read(file.read())
+    with open_atomic(output, 'w', encoding='utf-8', newline='\n') as file:
+        dump(kfm, file, format)
+
+def import_file(filename, output):
+    with open(filename, encoding='utf-8') as file:
+        kfm = load(file, format_of(filename))
+    write_bytes_atomic(kfm_codec().write(kfm), output)
+
+def _convert_job(job):
+    # (input, output, error or None)
+    command, filename, output, format = job
+    try:
+        if command == "export":
+            export_file(filename, output, format)
+        else:
+            import_file(filename, output)
+    except (OSError, ValueError) as e:
+        return filename, output, str(e)
+    except Exception as e:
+        # PyYAML's errors are not ValueErrors
+        return filename, output, f"{type(e).__name__}: {e}"
+    return filename, output, None
+
+def _output_name(command, filename, format):
+    if command == "export":
+        return filename + (".yaml" if format == YAML else ".json")
+    base = os.path.splitext(filename)[0]
+    return base if kfm_format().RE_FILENAME.match(os.path.basename(base)) else base + ".kfm"
+
+def find_jobs(command, paths, output_dir=None, format=JSON):
+    # (command, input, output, format) per file; directories are searched
+    # recursively and mirrored below output_dir
+    re_filename = kfm_format().RE_FILENAME
+    wanted = (lambda name: re_filename.match(name)) if command == "export" else format_of
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if wanted(name):
+                        filename = os.path.join(dirpath, name)
+                        output = _output_name(command, filename, format)
+                        if output_dir:
+                            output = os.path.join(output_dir, os.path.relpath(output, path))
+                        jobs.append((command, filename, output, format))
+        else:
+            output = _output_name(command, path, format)
+            if output_dir:
+                output = os.path.join(output_dir, os.path.basename(output))
+            jobs.append((command, path, output, format))
+    return jobs
+
+def convert(jobs, workers=None):
+    if workers == 1 or len(jobs) <= 1:
+        return [_convert_job(job) for job in jobs]
+    # imported here, as in kfm_batch
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_convert_job, jobs, chunksize=max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kfm_editor.py --text", description="Convert KFM files to and from lossless JSON or YAML.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="write FILE.kfm.json (or .yaml) for every KFM")
+    export.add_argument("paths", nargs="+", help="KFM files or directories to search for KFM files")
+    export.add_argument("-f", "--format", choices=[JSON, YAML], default=JSON, help="text format (default: json)")
+
+    import_ = commands.add_parser("import", help="write a KFM for every .json, .yaml or .yml file")
+    import_.add_argument("paths", nargs="+", help="text files or directories to search for them")
+
+    for command in (export, import_):
+        command.add_argument("-o", "--output-dir", help="write below this directory instead of next to the input files")
+        command.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per core)")
+    args = parser.parse_args(argv)
+
+    jobs = find_jobs(args.command, args.paths, args.output_dir, getattr(args, "format", None))
+    failed = 0
+    for filename, output, error in convert(jobs, args.jobs):
+        if error is not None:
+            failed += 1
+            print(f"{filename}: {error}")
+    print(f"{len(jobs) - failed} converted, {failed} failed" if jobs else "no files found")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
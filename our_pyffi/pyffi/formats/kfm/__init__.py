@@ -156,6 +156,8 @@ class KfmFormat(object_models.xml.FileFormat):
     # KFMXMLPATH env var, or KfmFormat module directory
     xml_file_path = [os.getenv('KFMXMLPATH'),
                      os.path.join(os.path.dirname(__file__), "kfmxml")]
+    # prebuilt by KfmFormat.write_schema(), e.g. when freezing the editor
+    schema_file_name = 'kfm.schema'
     
     xml_source = """<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE niftoolsxml>
@@ -348,7 +350,8 @@ class KfmFormat(object_models.xml.FileFormat):
                 0x01024b00: "1.2.4b",
                 0x0200000b: "2.0.0.0b",
                 0x0201000b: "2.1.0.0b",
-                0x0202000b: "2.2.0.0b"}[version])
+                0x0202000b: "2.2.0.0b",
+                0x0202001b: "2.2.0.1b"}[version])
 
     # other types with internal implementation
     class FilePath(SizedString):
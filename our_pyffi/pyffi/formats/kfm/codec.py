@@ -0,0 +1,473 @@
+"""
+:mod:`pyffi.formats.kfm.codec` --- Fast KFM reader and writer
+=============================================================
+
+A single pass reader and writer for the KFM grammar of :class:`KfmFormat`,
+working on a bytes-like object rather than a stream. The file is held in
+a compact model: :class:`KfmFile` and :class:`Animation` use ``__slots__``,
+and the transitions of an animation are stored column-wise in
+:class:`array.array` objects.
+
+:func:`read` and :func:`write` handle every version in
+:attr:`KfmFormat.versions` and reproduce the file byte for byte;
+:meth:`KfmFile.from_data` and :meth:`KfmFile.to_data` convert from and to
+the generic :class:`KfmFormat.Data`.
+
+>>> from pyffi.formats.kfm import codec
+>>> with open(filename, 'rb') as stream: # doctest: +SKIP
+...     kfm = codec.read(stream.read())
+>>> data = kfm.to_data() # doctest: +SKIP
+"""
+
+# --------------------------------------------------------------------------
+# ***** BEGIN LICENSE BLOCK *****
+#
+# Copyright (c) 2007-2012, Python File Format Interface
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#
+#    * Neither the name of the Python File Format Interface
+#      project nor the names of its contributors may be used to endorse
+#      or promote products derived from this software without specific
+#      prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# ***** END LICENSE BLOCK *****
+# --------------------------------------------------------------------------
+
+from array import array
+import struct
+
+from . import KfmFormat
+
+_HEADER = b";Gamebryo KFM File Version "
+# stop at the same string length as SizedString.read
+_MAX_STRING = 10000
+# the transition fields that are only there when the type is not 5
+_NO_DETAILS = 5
+
+_V_1_2_0_0 = 0x01020000
+_V_1_2_4B = 0x01024B00
+_V_2_0_0_0 = 0x02000000
+_V_2_2_0_1B = 0x0202001B
+
+_BYTE = struct.Struct("<B")
+_INT = struct.Struct("<i")
+_UINT = struct.Struct("<I")
+_FLOAT = struct.Struct("<f")
+_INT_INT = struct.Struct("<ii")
+_FLOAT_INT = struct.Struct("<fi")
+_FILE_FIELDS = struct.Struct("<iiffi")
+_FLOAT_4 = struct.Struct("<ffff")
+
+
+class IntermediateAnim(object):
+    __slots__ = ("unknown_int", "event")
+
+    def __init__(self, unknown_int=0, event=b""):
+        self.unknown_int = unknown_int
+        self.event = event
+
+    def __eq__(self, other):
+        return (self.unknown_int, self.event) == (other.unknown_int, other.event)
+
+    def __repr__(self):
+        return "IntermediateAnim(%r, %r)" % (self.unknown_int, self.event)
+
+
+class UnknownData(object):
+    __slots__ = ("string_1", "string_2", "unk_floats")
+
+    def __init__(self, string_1=b"", string_2=b"", unk_floats=(0.0, 0.0, 0.0, 0.0)):
+        self.string_1 = string_1
+        self.string_2 = string_2
+        self.unk_floats = tuple(unk_floats)
+
+    def __eq__(self, other):
+        return (self.string_1, self.string_2, self.unk_floats) == (other.string_1, other.string_2, other.unk_floats)
+
+
+class UnknownData2(object):
+    __slots__ = ("string_1", "unk_float")
+
+    def __init__(self, string_1=b"", unk_float=0.0):
+        self.string_1 = string_1
+        self.unk_float = unk_float
+
+    def __eq__(self, other):
+        return (self.string_1, self.unk_float) == (other.string_1, other.unk_float)
+
+
+class Transitions(object):
+    """The transitions of one animation, one array per field. Transitions
+    of type 5 have no details in the file; their duration and
+    num_text_key_pairs are 0 here."""
+
+    __slots__ = ("animation", "type", "duration", "num_text_key_pairs", "intermediate_anims")
+
+    def __init__(self):
+        self.animation = array("i")
+        self.type = array("i")
+        self.duration = array("f")
+        self.num_text_key_pairs = array("i")
+        # tuple of IntermediateAnim per transition, mostly empty
+        self.intermediate_anims = []
+
+    def __len__(self):
+        return len(self.animation)
+
+    def append(self, animation, type_, duration=0.0, intermediate_anims=(), num_text_key_pairs=0):
+        self.animation.append(animation)
+        self.type.append(type_)
+        self.duration.append(duration)
+        self.num_text_key_pairs.append(num_text_key_pairs)
+        self.intermediate_anims.append(tuple(intermediate_anims))
+
+    def __eq__(self, other):
+        return (self.animation == other.animation and self.type == other.type
+                and self.duration == other.duration
+                and self.num_text_key_pairs == other.num_text_key_pairs
+                and self.intermediate_anims == other.intermediate_anims)
+
+
+class Animation(object):
+    __slots__ = ("event_code", "name", "kf_file_name", "index", "transitions",
+                 "unknown_data", "unknown_int", "unknown_data_2")
+
+    def __init__(self, event_code=0, kf_file_name=b"", index=0, name=b""):
+        self.event_code = event_code
+        # up to version 1.2.4b
+        self.name = name
+        self.kf_file_name = kf_file_name
+        self.index = index
+        self.transitions = Transitions()
+        # version 2.2.0.1b only
+        self.unknown_data = []
+        self.unknown_int = 0
+        self.unknown_data_2 = []
+
+    def __eq__(self, other):
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+
+class KfmFile(object):
+    """A KFM file as plain values and arrays. Fields the version of the
+    file does not have keep their defaults and are not written."""
+
+    __slots__ = ("version", "dos_eol", "unknown_byte", "nif_file_name", "master",
+                 "unknown_int_1", "unknown_int_2", "unknown_float_1", "unknown_float_2",
+                 "animations", "unknown_int_3")
+
+    def __init__(self, version=0x0202000B):
+        self.version = version
+        # header line ends on \r\n rather than \n
+        self.dos_eol = False
+        # from version 2.0.0.0b
+        self.unknown_byte = 0
+        # from version 1.2.0.0
+        self.nif_file_name = b""
+        self.master = b""
+        self.unknown_int_1 = 0
+        self.unknown_int_2 = 0
+        self.unknown_float_1 = 0.0
+        self.unknown_float_2 = 0.0
+        self.animations = []
+        self.unknown_int_3 = 0
+
+    def __eq__(self, other):
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    @classmethod
+    def from_data(cls, data):
+        """Copy of a :class:`KfmFormat.Data`.
+
+        :param data: The data to copy.
+        :type data: :class:`KfmFormat.Data`
+        :rtype: :class:`KfmFile`
+        """
+        kfm = data.kfm
+        self = cls(data.version)
+        self.dos_eol = kfm._header_string_value_._doseol
+        self.unknown_byte = kfm.unknown_byte
+        self.nif_file_name = kfm.nif_file_name
+        self.master = kfm.master
+        self.unknown_int_1 = kfm.unknown_int_1
+        self.unknown_int_2 = kfm.unknown_int_2
+        self.unknown_float_1 = kfm.unknown_float_1
+        self.unknown_float_2 = kfm.unknown_float_2
+        self.unknown_int_3 = kfm.unknown_int_3
+        for anim in kfm.animations:
+            a = Animation(anim.event_code, anim.kf_file_name, anim.index, anim.name)
+            for t in anim.transitions:
+                a.transitions.append(
+                    t.animation, t.type, t.duration,
+                    (IntermediateAnim(i.unknown_int, i.event) for i in t.intermediate_anims),
+                    t.num_text_key_pairs)
+            a.unknown_data = [UnknownData(u.string_1, u.string_2, (u.unk_float_1, u.unk_float_2, u.unk_float_3, u.unk_float_4))
+                              for u in anim.unknown_data]
+            a.unknown_int = anim.unknown_int
+            a.unknown_data_2 = [UnknownData2(u.string_1, u.unk_float) for u in anim.unknown_data_2]
+            self.animations.append(a)
+        return self
+
+    def to_data(self):
+        """Copy as a :class:`KfmFormat.Data`.
+
+        :rtype: :class:`KfmFormat.Data`
+        """
+        data = KfmFormat.Data(version=self.version)
+        kfm = data.kfm
+        kfm._header_string_value_._doseol = self.dos_eol
+        kfm.unknown_byte = self.unknown_byte
+        kfm.nif_file_name = self.nif_file_name
+        kfm.master = self.master
+        kfm.unknown_int_1 = self.unknown_int_1
+        kfm.unknown_int_2 = self.unknown_int_2
+        kfm.unknown_float_1 = self.unknown_float_1
+        kfm.unknown_float_2 = self.unknown_float_2
+        kfm.unknown_int_3 = self.unknown_int_3
+        kfm.num_animations = len(self.animations)
+        kfm.animations.update_size()
+        for anim, a in zip(kfm.animations, self.animations):
+            anim.event_code = a.event_code
+            anim.name = a.name
+            anim.kf_file_name = a.kf_file_name
+            anim.index = a.index
+            ts = a.transitions
+            anim.num_transitions = len(ts)
+            anim.transitions.update_size()
+            for i, t in enumerate(anim.transitions):
+                t.animation = ts.animation[i]
+                t.type = ts.type[i]
+                t.duration = ts.duration[i]
+                t.num_text_key_pairs = ts.num_text_key_pairs[i]
+                t.num_intermediate_anims = len(ts.intermediate_anims[i])
+                t.intermediate_anims.update_size()
+                for inter, ia in zip(t.intermediate_anims, ts.intermediate_anims[i]):
+                    inter.unknown_int = ia.unknown_int
+                    inter.event = ia.event
+            anim.num_unknown_data = len(a.unknown_data)
+            anim.unknown_data.update_size()
+            for u, ud in zip(anim.unknown_data, a.unknown_data):
+                u.string_1 = ud.string_1
+                u.string_2 = ud.string_2
+                u.unk_float_1, u.unk_float_2, u.unk_float_3, u.unk_float_4 = ud.unk_floats
+            anim.unknown_int = a.unknown_int
+            anim.num_unknown_data_2 = len(a.unknown_data_2)
+            anim.unknown_data_2.update_size()
+            for u, ud in zip(anim.unknown_data_2, a.unknown_data_2):
+                u.string_1 = ud.string_1
+                u.unk_float = ud.unk_float
+        return data
+
+
+def _version_strings():
+    return dict((number, string) for string, number in KfmFormat.versions.items())
+
+
+def read(buffer):
+    """Parse a KFM file from a bytes-like object.
+
+    :param buffer: The whole file.
+    :type buffer: ``bytes``, ``bytearray``, ``memoryview`` or ``mmap``
+    :rtype: :class:`KfmFile`
+    """
+    view = memoryview(buffer)
+    size = len(view)
+
+    # header line
+    line_end = bytes(view[:64]).find(b"\n")
+    header = bytes(view[:line_end]) if line_end >= 0 else b""
+    dos_eol = header.endswith(b"\r")
+    if dos_eol:
+        header = header[:-1]
+    if not header.startswith(_HEADER):
+        raise ValueError("Not a KFM file.")
+    version = KfmFormat.versions.get(header[len(_HEADER):].decode("ascii", "replace"))
+    if version is None:
+        raise ValueError("KFM version not supported.")
+    pos = line_end + 1
+
+    self = KfmFile(version)
+    self.dos_eol = dos_eol
+
+    def string(pos):
+        length, = _UINT.unpack_from(view, pos)
+        pos += 4
+        if length > _MAX_STRING:
+            raise ValueError("string too long (0x%08X at 0x%08X)" % (length, pos - 4))
+        if pos + length > size:
+            raise ValueError("string runs past the end of the file at 0x%08X" % pos)
+        return bytes(view[pos:pos + length]), pos + length
+
+    def count(value, pos):
+        if value < 0:
+            raise ValueError("negative count %i at 0x%08X" % (value, pos))
+        return value
+
+    try:
+        if version >= _V_2_0_0_0:
+            self.unknown_byte, = _BYTE.unpack_from(view, pos)
+            pos += 1
+        if version >= _V_1_2_0_0:
+            self.nif_file_name, pos = string(pos)
+            self.master, pos = string(pos)
+            (self.unknown_int_1, self.unknown_int_2, self.unknown_float_1,
+             self.unknown_float_2, num_animations) = _FILE_FIELDS.unpack_from(view, pos)
+            pos += _FILE_FIELDS.size
+            animations = self.animations
+            has_name = version <= _V_1_2_4B
+            has_unknown_data = version == _V_2_2_0_1B
+            for _ in range(count(num_animations, pos - 4)):
+                event_code, = _INT.unpack_from(view, pos)
+                anim = Animation(event_code)
+                pos += 4
+                if has_name:
+                    anim.name, pos = string(pos)
+                anim.kf_file_name, pos = string(pos)
+                anim.index, num_transitions = _INT_INT.unpack_from(view, pos)
+                pos += 8
+
+                # fill plain lists, the arrays are made in one go
+                targets = []
+                types = []
+                durations = []
+                text_key_pairs = []
+                intermediates = []
+                for _ in range(count(num_transitions, pos - 4)):
+                    target, type_ = _INT_INT.unpack_from(view, pos)
+                    pos += 8
+                    targets.append(target)
+                    types.append(type_)
+                    if type_ == _NO_DETAILS:
+                        durations.append(0.0)
+                        text_key_pairs.append(0)
+                        intermediates.append(())
+                        continue
+                    duration, num_intermediate = _FLOAT_INT.unpack_from(view, pos)
+                    pos += 8
+                    durations.append(duration)
+                    if num_intermediate:
+                        inter = []
+                        for _ in range(count(num_intermediate, pos - 4)):
+                            unknown_int, = _INT.unpack_from(view, pos)
+                            event, pos = string(pos + 4)
+                            inter.append(IntermediateAnim(unknown_int, event))
+                        intermediates.append(tuple(inter))
+                    else:
+                        intermediates.append(())
+                    text_key_pairs.append(_INT.unpack_from(view, pos)[0])
+                    pos += 4
+                ts = anim.transitions
+                ts.animation = array("i", targets)
+                ts.type = array("i", types)
+                ts.duration = array("f", durations)
+                ts.num_text_key_pairs = array("i", text_key_pairs)
+                ts.intermediate_anims = intermediates
+
+                if has_unknown_data:
+                    num_unknown_data, = _UINT.unpack_from(view, pos)
+                    pos += 4
+                    for _ in range(num_unknown_data):
+                        string_1, pos = string(pos)
+                        string_2, pos = string(pos)
+                        anim.unknown_data.append(UnknownData(string_1, string_2, _FLOAT_4.unpack_from(view, pos)))
+                        pos += 16
+                    anim.unknown_int, num_unknown_data_2 = struct.unpack_from("<II", view, pos)
+                    pos += 8
+                    for _ in range(num_unknown_data_2):
+                        string_1, pos = string(pos)
+                        anim.unknown_data_2.append(UnknownData2(string_1, _FLOAT.unpack_from(view, pos)[0]))
+                        pos += 4
+                animations.append(anim)
+            self.unknown_int_3, = _INT.unpack_from(view, pos)
+            pos += 4
+    except struct.error:
+        raise ValueError("unexpected end of file at 0x%08X" % pos)
+
+    if pos != size:
+        raise ValueError("end of file not reached: corrupt kfm file?")
+    return self
+
+
+def write(kfm_file):
+    """Serialize a :class:`KfmFile`.
+
+    :param kfm_file: The file to serialize.
+    :type kfm_file: :class:`KfmFile`
+    :rtype: ``bytes``
+    """
+    version = kfm_file.version
+    try:
+        version_string = _version_strings()[version]
+    except KeyError:
+        raise ValueError("KFM version 0x%08X not supported." % version)
+    parts = [_HEADER, version_string.encode("ascii"), b"\r\n" if kfm_file.dos_eol else b"\n"]
+    append = parts.append
+    int_ = _INT.pack
+
+    def string(value):
+        append(_UINT.pack(len(value)))
+        append(value)
+
+    if version >= _V_2_0_0_0:
+        append(_BYTE.pack(kfm_file.unknown_byte))
+    if version >= _V_1_2_0_0:
+        string(kfm_file.nif_file_name)
+        string(kfm_file.master)
+        append(_FILE_FIELDS.pack(kfm_file.unknown_int_1, kfm_file.unknown_int_2, kfm_file.unknown_float_1,
+                                 kfm_file.unknown_float_2, len(kfm_file.animations)))
+        has_name = version <= _V_1_2_4B
+        has_unknown_data = version == _V_2_2_0_1B
+        for anim in kfm_file.animations:
+            append(int_(anim.event_code))
+            if has_name:
+                string(anim.name)
+            string(anim.kf_file_name)
+            ts = anim.transitions
+            append(_INT_INT.pack(anim.index, len(ts)))
+            for target, type_, duration, intermediates, text_key_pairs in zip(
+                    ts.animation, ts.type, ts.duration, ts.intermediate_anims, ts.num_text_key_pairs):
+                append(_INT_INT.pack(target, type_))
+                if type_ == _NO_DETAILS:
+                    continue
+                append(_FLOAT_INT.pack(duration, len(intermediates)))
+                for inter in intermediates:
+                    append(int_(inter.unknown_int))
+                    string(inter.event)
+                append(int_(text_key_pairs))
+            if has_unknown_data:
+                append(_UINT.pack(len(anim.unknown_data)))
+                for u in anim.unknown_data:
+                    string(u.string_1)
+                    string(u.string_2)
+                    append(_FLOAT_4.pack(*u.unk_floats))
+                append(struct.pack("<II", anim.unknown_int, len(anim.unknown_data_2)))
+                for u in anim.unknown_data_2:
+                    string(u.string_1)
+                    append(_FLOAT.pack(u.unk_float))
+        append(int_(kfm_file.unknown_int_3))
+    return b"".join(parts)
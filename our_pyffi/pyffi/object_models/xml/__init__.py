@@ -47,6 +47,9 @@ import sys
 import xml.etree.ElementTree as ET
 
 import io
+import hashlib
+import pickle
+import tempfile
 
 import os
 import sys
@@ -101,19 +104,108 @@ class MetaFileFormat(object_models.MetaFileFormat):
             start = time.time()
             
             xml_source = dct.get('xml_source')
-            if xml_source:
-                xml_file = io.StringIO(xml_source)
-            else:
+            if not xml_source:
                 xml_file = cls.openfile(xml_file_name, cls.xml_file_path)
-            
+                try:
+                    xml_source = xml_file.read()
+                finally:
+                    xml_file.close()
+            # kept for write_schema, which parses the xml again
+            cls._xml_class_dict = dct
+            cls._xml_digest = hashlib.sha1(xml_source.encode("utf-8")).hexdigest()
+
             xmlp = XmlParser(cls)
-            try:
-                xmlp.load_xml(xml_file)
-            finally:
-                xml_file.close()
+            cache_file = cls.schema_cache_path()
+            for schema_file in (cls.schema_path(), cache_file):
+                if schema_file and xmlp.load_schema(schema_file, cls._xml_digest):
+                    cls.logger.debug("Loaded schema %s." % schema_file)
+                    break
+            else:
+                if cache_file and xmlp.records is None:
+                    xmlp.records = []
+                xmlp.load_xml(io.StringIO(xml_source))
+                if cache_file and xmlp.records is not None:
+                    try:
+                        _save_schema(cache_file, cls._xml_digest, cls.versions, cls.games, xmlp.records)
+                        _prune_schema_cache(cache_file)
+                    except (OSError, pickle.PicklingError) as e:
+                        cls.logger.debug("Could not cache schema in %s: %s" % (cache_file, e))
 
             cls.logger.debug("Parsing finished in %.3f seconds." % (time.time() - start))
 
+# bump when the records or the classes they pickle change shape
+SCHEMA_VERSION = 2
+
+# modules of this package that shape the parsed classes; the cache key
+# covers their stats too, so editing one of them invalidates the cache
+SCHEMA_MODULES = ["__init__.py", "struct_.py", "array.py", "expression.py", "bit_struct.py", "struct_compiler.py"]
+
+# first line of every schema file; the second is the SHA-256 of the pickle
+# that follows, so only files written by _save_schema are unpickled
+SCHEMA_MAGIC = b"pyffi schema\n"
+
+def _default_schema_cache_dir():
+    # Set PYFFI_SCHEMA_CACHE to a directory to cache schemas there instead,
+    # or to an empty string to turn the cache off.
+    path = os.environ.get("PYFFI_SCHEMA_CACHE")
+    if path is not None:
+        return path or None
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pyffi", "schemas")
+
+def _save_schema(filename, digest, versions, games, records):
+    # written next to the target and renamed over it, so processes
+    # starting together never read a partial schema
+    schema = {
+        "digest": digest,
+        "versions": versions,
+        "games": games,
+        "records": records,
+        }
+    payload = pickle.dumps(schema, protocol=pickle.HIGHEST_PROTOCOL)
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_filename = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(SCHEMA_MAGIC)
+            file.write(hashlib.sha256(payload).hexdigest().encode("ascii") + b"\n")
+            file.write(payload)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+def _load_schema(filename):
+    # the schema saved by _save_schema; raises ValueError for any other file
+    with open(filename, "rb") as file:
+        if file.readline() != SCHEMA_MAGIC:
+            raise ValueError("not a pyffi schema")
+        checksum = file.readline().strip()
+        payload = file.read()
+    if hashlib.sha256(payload).hexdigest().encode("ascii") != checksum:
+        raise ValueError("checksum mismatch")
+    return pickle.loads(payload)
+
+def _prune_schema_cache(filename):
+    # removes the other cached schemas of the same format, which were built
+    # from older xml or code
+    directory, name = os.path.split(filename)
+    prefix = name.rsplit("-", 1)[0] + "-"
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for other in names:
+        if other != name and other.startswith(prefix) and other.endswith(".schema"):
+            try:
+                os.remove(os.path.join(directory, other))
+            except OSError:
+                pass
+
 class FileFormat(object_models.FileFormat, metaclass=MetaFileFormat):
     """This class can be used as a base class for file formats
     described by an xml file."""
@@ -135,6 +227,65 @@ class FileFormat(object_models.FileFormat, metaclass=MetaFileFormat):
     xml_bit_struct = []
     xml_struct = []
 
+    #: Override: file name of a prebuilt schema (see :meth:`write_schema`)
+    #: next to the module of the format. When it exists and was built from
+    #: the same xml, the classes are created from it instead of parsing the
+    #: xml.
+    schema_file_name = None
+
+    #: Directory where parsed schemas are cached, keyed by the xml and the
+    #: code that parses it; ``None`` turns the cache off. Defaults to the
+    #: ``PYFFI_SCHEMA_CACHE`` environment variable, where an empty value
+    #: turns it off, else to ``pyffi/schemas`` in the user's cache
+    #: directory. Only the latest schema of each format is kept.
+    schema_cache_dir = _default_schema_cache_dir()
+
+    @classmethod
+    def schema_cache_path(cls):
+        """Full path of the cached schema for the current xml, or ``None``
+        if caching is off."""
+        if not cls.schema_cache_dir:
+            return None
+        key = hashlib.sha1(("%s %s %d.%d" % (cls._xml_digest, SCHEMA_VERSION, sys.version_info[0], sys.version_info[1])).encode("ascii"))
+        # the module of the format, and the ones that shape its classes
+        here = os.path.dirname(os.path.abspath(__file__))
+        paths = [getattr(sys.modules.get(cls.__module__), "__file__", None)]
+        paths += [os.path.join(here, name) for name in SCHEMA_MODULES]
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except (TypeError, OSError):
+                continue
+            key.update(b"%d %d" % (stat.st_mtime_ns, stat.st_size))
+        return os.path.join(cls.schema_cache_dir, "%s-%s.schema" % (cls.__name__, key.hexdigest()[:16]))
+
+    @classmethod
+    def schema_path(cls):
+        """Full path of the prebuilt schema, or ``None`` if the format has
+        none."""
+        if not cls.schema_file_name:
+            return None
+        module = sys.modules[cls.__module__]
+        return os.path.join(os.path.dirname(os.path.abspath(module.__file__)), cls.schema_file_name)
+
+    @classmethod
+    def write_schema(cls, filename=None):
+        """Parse the xml of the format again and save the result as a
+        prebuilt schema, by default to :meth:`schema_path`.
+
+        :param filename: Where to write the schema.
+        :type filename: ``str``
+        """
+        filename = filename or cls.schema_path()
+        # parse into a scratch class so the record starts from the same
+        # state as the import did
+        records = []
+        dct = dict(cls._xml_class_dict, _schema_records=records, schema_file_name=None, schema_cache_dir=None)
+        dct.pop("__classcell__", None)
+        scratch = type(cls)(cls.__name__, cls.__bases__, dct)
+        _save_schema(filename, cls._xml_digest, scratch.versions, scratch.games, records)
+        return filename
+
 class StructAttribute(object):
     """Helper class to collect attribute data of struct add tags."""
 
@@ -254,6 +405,32 @@ class BitStructAttribute(object):
         if self.ver2:
             self.ver2 = cls.version_number(self.ver2)
 
+class _SchemaPickler(pickle.Pickler):
+    """Pickles the classes of the format by their name in the format, so
+    they resolve to the classes of the importing process."""
+
+    def __init__(self, file, cls):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.cls = cls
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, type):
+            return None
+        if getattr(self.cls, obj.__name__, None) is obj:
+            return obj.__name__
+        for name, value in vars(self.cls).items():
+            if value is obj:
+                return name
+        return None
+
+class _SchemaUnpickler(pickle.Unpickler):
+    def __init__(self, file, cls):
+        super().__init__(file)
+        self.cls = cls
+
+    def persistent_load(self, pid):
+        return getattr(self.cls, pid)
+
 class XmlError(Exception):
     """The XML handler will throw this exception if something goes wrong while
     parsing."""
@@ -287,6 +464,9 @@ class XmlParser:
         self.tokens = [ ]
         self.versions = [ ([], ("versions", "until", "since")), ]
 
+        # when writing a schema: (tag, pickled class) for each created class
+        self.records = cls.__dict__.get("_schema_records")
+
     def load_xml(self, file):
         """Loads an XML (can be filepath or open file) and does all parsing"""
         tree = ET.parse(file)
@@ -294,6 +474,46 @@ class XmlParser:
         self.load_root(root)
         self.final_cleanup()
             
+    def load_schema(self, filename, digest):
+        """Creates the classes from a saved schema (prebuilt by
+        FileFormat.write_schema or cached) instead of parsing the xml.
+        Returns False, leaving the classes as they were, if the schema is
+        missing, was built from other xml or does not load."""
+        try:
+            schema = _load_schema(filename)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            self.cls.logger.warning("Schema %s is damaged (%s), parsing the xml instead." % (filename, e))
+            return False
+        if schema.get("digest") != digest:
+            self.cls.logger.warning("Schema %s is out of date, parsing the xml instead." % filename)
+            return False
+
+        saved = dict(vars(self.cls))
+        lists = [(classes, len(classes)) for classes in (self.cls.xml_enum, self.cls.xml_alias, self.cls.xml_bit_struct, self.cls.xml_struct)]
+        try:
+            self.cls.versions.update(schema["versions"])
+            self.cls.games.update(schema["games"])
+            for tag, record in schema["records"]:
+                self.class_name, self.base_class, self.class_dict = _SchemaUnpickler(io.BytesIO(record), self.cls).load()
+                self.create_class(tag)
+            self.final_cleanup()
+        except Exception as e:
+            self.cls.logger.warning("Schema %s does not load (%s), parsing the xml instead." % (filename, e))
+            # undo the partial replay
+            for name in set(vars(self.cls)) - set(saved):
+                delattr(self.cls, name)
+            for name, value in saved.items():
+                if vars(self.cls).get(name) is not value:
+                    setattr(self.cls, name, value)
+            for classes, size in lists:
+                del classes[size:]
+            self.cls.versions.clear()
+            self.cls.games.clear()
+            return False
+        return True
+
     def load_root(self, root):
         """Goes over all children of the root node and calls the appropriate function depending on type of the child"""
         for child in root:
@@ -513,6 +733,19 @@ class XmlParser:
         """Creates a class for <tag> (tag name of the class that was just finished)"""
         # assign it to cls.<class_name> if it has not been implemented internally
 
+        if self.records is not None:
+            # before the class exists and before final_cleanup resolves
+            # names, so it replays the same way
+            record = io.BytesIO()
+            try:
+                _SchemaPickler(record, self.cls).dump((self.class_name, self.base_class, self.class_dict))
+                self.records.append((tag, record.getvalue()))
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                if "_schema_records" in self.cls.__dict__:
+                    raise
+                self.cls.logger.debug("Not caching the schema, %s does not pickle: %s" % (self.class_name, e))
+                self.records = None
+
         # type(name, bases, dict) returns a new type object, essentially a dynamic form of the class statement
         cls_klass = getattr(self.cls, self.class_name, None)
         # does the class exist?
@@ -40,8 +40,17 @@
 # --------------------------------------------------------------------------
 
 # note: some imports are defined at the end to avoid problems with circularity
+import array
 import logging
+import operator
+import struct
 import weakref
+from itertools import repeat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 import os
@@ -49,6 +58,7 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)))
 
 from utils.graph import DetailNode, EdgeFilter
+from object_models.xml.struct_compiler import basic_struct_code
 
 
 class _ListWrap(list, DetailNode):
@@ -128,10 +138,26 @@ class _ListWrap(list, DetailNode):
 
 class Array(_ListWrap):
     """A general purpose class for 1 or 2 dimensional arrays consisting of
-    either BasicBase or StructBase elements."""
+    either BasicBase or StructBase elements.
+
+    Arrays of structs with a static layout are read into columns, and
+    hold views on these; see :mod:`~pyffi.object_models.xml.columnar`."""
 
     logger = logging.getLogger("pyffi.nif.data.array")
     arg = None  # default argument
+    _columnar = None  # (layout, [(columns, views)]) of a columnar read
+
+    def __new__(
+            cls,
+            element_type=None,
+            element_type_template=None,
+            element_type_argument=None,
+            count1=None, count2=None,
+            parent=None):
+        # one dimensional arrays of fixed size numbers are packed
+        if cls is Array and count2 is None and PackedArray.packs(element_type):
+            cls = PackedArray
+        return _ListWrap.__new__(cls)
 
     def __init__(
             self,
@@ -186,18 +212,18 @@ class Array(_ListWrap):
     def _len1(self):
         """The length the array should have, obtained by evaluating the count1 expression."""
         if self._parent is None:
-            return self._count1.eval()
+            return self._count1.compile()(None)
         else:
-            return self._count1.eval(self._parent())
+            return self._count1.compile()(self._parent())
 
     def _len2(self, index1):
         """The length the array should have, obtained by evaluating the count2 expression."""
         if self._count2 is None:
             raise ValueError('single array treated as double array (bug?)')
         if self._parent is None:
-            expr = self._count2.eval()
+            expr = self._count2.compile()(None)
         else:
-            expr = self._count2.eval(self._parent())
+            expr = self._count2.compile()(self._parent())
         if isinstance(expr, int):
             return expr
         else:
@@ -297,9 +323,17 @@ class Array(_ListWrap):
         if len1 > 0x10000000:
             raise ValueError('array too long (%i)' % len1)
         del self[0:self.__len__()]
+        self._columnar = None
 
         # read array
+        layout = columnar.layout(
+            self._elementType, data,
+            self._elementTypeTemplate, self._elementTypeArgument)
         if self._count2 is None:
+            if layout is not None:
+                self._columnar = (
+                    layout, [self._read_columns(self, layout, stream, data, len1)])
+                return
             for i in range(len1):
                 elem = self._elementType(
                     template=self._elementTypeTemplate,
@@ -308,19 +342,36 @@ class Array(_ListWrap):
                 elem.read(stream, data)
                 self.append(elem)
         else:
+            rows = []
             for i in range(len1):
                 len2i = self._len2(i)
                 if len2i > 0x10000000:
                     raise ValueError('array too long (%i)' % len2i)
                 elemlist = _ListWrap(self._elementType, parent=self)
-                for j in range(len2i):
-                    elem = self._elementType(
-                        template=self._elementTypeTemplate,
-                        argument=self._elementTypeArgument,
-                        parent=elemlist)
-                    elem.read(stream, data)
-                    elemlist.append(elem)
+                if layout is not None:
+                    rows.append(
+                        self._read_columns(elemlist, layout, stream, data, len2i))
+                else:
+                    for j in range(len2i):
+                        elem = self._elementType(
+                            template=self._elementTypeTemplate,
+                            argument=self._elementTypeArgument,
+                            parent=elemlist)
+                        elem.read(stream, data)
+                        elemlist.append(elem)
                 self.append(elemlist)
+            if layout is not None:
+                self._columnar = (layout, rows)
+
+    @staticmethod
+    def _read_columns(elemlist, layout, stream, data, count):
+        """Read C{count} elements at once, and fill C{elemlist} with
+        views on their columns."""
+        count = max(count, 0)
+        columns = layout.read(stream, data, count)
+        views = list(map(layout.view_type(), repeat(columns, count), range(count)))
+        list.extend(elemlist, views)
+        return columns, views
 
     def write(self, stream, data):
         """Write array to stream."""
@@ -331,7 +382,11 @@ class Array(_ListWrap):
                              (self.__len__(), len1))
         if len1 > 0x10000000:
             raise ValueError('array too long (%i)' % len1)
+        layout = self._columnar_layout(data)
         if self._count2 is None:
+            if layout is not None and layout.write(
+                    stream, data, self._columnar[1][0][0], len1):
+                return
             for elem in list.__iter__(self):
                 elem.write(stream, data)
         else:
@@ -342,6 +397,9 @@ class Array(_ListWrap):
                                      (elemlist.__len__(), len2i))
                 if len2i > 0x10000000:
                     raise ValueError('array too long (%i)' % len2i)
+                if layout is not None and layout.write(
+                        stream, data, self._columnar[1][i][0], len2i):
+                    continue
                 for elem in list.__iter__(elemlist):
                     elem.write(stream, data)
 
@@ -385,9 +443,33 @@ class Array(_ListWrap):
 
     def get_size(self, data=None):
         """Calculate the sum of the size of all elements in the array."""
+        layout = self._columnar_layout(data)
+        if layout is not None:
+            return layout.size * sum(len(views) for _, views in self._columnar[1])
         return sum(
             (elem.get_size(data) for elem in self._elementList()), 0)
 
+    def _columnar_layout(self, data):
+        """The layout for writing and sizing all elements at once: if
+        the array still holds the views that it read, and their layout
+        stores the same fields as the layout for C{data}."""
+        if self._columnar is None:
+            return None
+        layout, rows = self._columnar
+        elemlists = [self] if self._count2 is None else list(list.__iter__(self))
+        if len(elemlists) != len(rows):
+            return None
+        for elemlist, (_, views) in zip(elemlists, rows):
+            if (list.__len__(elemlist) != len(views)
+                    or not all(map(operator.is_, list.__iter__(elemlist), views))):
+                return None
+        current = columnar.layout(
+            self._elementType, data,
+            self._elementTypeTemplate, self._elementTypeArgument)
+        if current is None or current.signature != layout.signature:
+            return None
+        return current
+
     def get_hash(self, data=None):
         """Calculate a hash value for the array, as a tuple."""
         hsh = []
@@ -411,5 +493,231 @@ class Array(_ListWrap):
                     yield elem
 
 
+class PackedArray(Array):
+    """A one dimensional array of fixed size integers or floats, stored in
+    an :class:`array.array` rather than as one object per element, and
+    read and written in one go. :class:`Array` creates one in its place
+    when the element type reads, writes and converts its value as
+    :class:`~pyffi.object_models.common.Int` or
+    :class:`~pyffi.object_models.common.Float` do.
+
+    Items are got and set as values, as for any array of basic types, and
+    assigned values are checked and converted by the element type's
+    ``set_value``. Where objects are needed, as for
+    :meth:`get_detail_child_nodes`, the elements are views on an index
+    of the array.
+
+    :meth:`numpy_view` gives a NumPy array sharing the storage, if NumPy
+    is installed. Reading the array replaces the storage, and resizing it
+    fails while a view exists.
+    """
+
+    @staticmethod
+    def packs(element_type):
+        """Whether arrays of *element_type* are packed."""
+        return basic_struct_code(element_type, columnar.PACKED_METHODS) is not None
+
+    def __init__(
+            self,
+            element_type=None,
+            element_type_template=None,
+            element_type_argument=None,
+            count1=None, count2=None,
+            parent=None):
+        if count2 is not None:
+            raise ValueError("packed arrays have one dimension")
+        _ListWrap.__init__(self, element_type=element_type, parent=parent)
+        self._elementType = element_type
+        self._elementTypeTemplate = element_type_template
+        self._elementTypeArgument = element_type_argument
+        self._count1 = count1
+        self._count2 = None
+        code = basic_struct_code(element_type, columnar.PACKED_METHODS)
+        self._float = (code == "f")
+        self._size = struct.calcsize("<" + code)
+        self._values = array.array(columnar.typecode(code))
+        self._values.frombytes(bytes(max(self._len1(), 0) * self._values.itemsize))
+
+    def _convert(self, value):
+        """The value as set_value of the element type would store it."""
+        if isinstance(value, BasicBase):
+            value = value.get_value()
+        if self._float:
+            return float(value)
+        if type(value) is int and self._elementType._min <= value <= self._elementType._max:
+            return value
+        elem = self._elementType()
+        elem.set_value(value)
+        return elem._value
+
+    def _item(self, index):
+        return columnar.item_type(self._elementType)(self, index)
+
+    def numpy_view(self):
+        """A NumPy array sharing the storage of this array."""
+        if numpy is None:
+            raise ImportError("numpy_view requires numpy")
+        return numpy.asarray(memoryview(self._values))
+
+    # list interface
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __reversed__(self):
+        return reversed(self._values)
+
+    def __contains__(self, value):
+        return value in self._values
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._values[index].tolist()
+        return self._values[index]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._values[index] = array.array(
+                self._values.typecode, [self._convert(item) for item in value])
+        else:
+            self._values[index] = self._convert(value)
+
+    def __delitem__(self, index):
+        del self._values[index]
+
+    def __eq__(self, other):
+        if isinstance(other, PackedArray):
+            return self._values == other._values
+        try:
+            return (len(self) == len(other)
+                    and all(mine == theirs for mine, theirs in zip(self._values, other)))
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._values.tolist())
+
+    def append(self, value):
+        self._values.append(self._convert(value))
+
+    def extend(self, values):
+        self._values.extend(
+            array.array(self._values.typecode, [self._convert(value) for value in values]))
+
+    def insert(self, index, value):
+        self._values.insert(index, self._convert(value))
+
+    def pop(self, index=-1):
+        return self._values.pop(index)
+
+    def remove(self, value):
+        self._values.remove(value)
+
+    def index(self, value, *args):
+        return self._values.index(value, *args)
+
+    def count(self, value):
+        return self._values.count(value)
+
+    def clear(self):
+        del self._values[:]
+
+    def reverse(self):
+        self._values.reverse()
+
+    def sort(self, key=None, reverse=False):
+        self._values[:] = array.array(
+            self._values.typecode, sorted(self._values, key=key, reverse=reverse))
+
+    # Array
+
+    def __str__(self):
+        text = '%s instance at 0x%08X\n' % (self.__class__, id(self))
+        for i in range(min(len(self), 17)):
+            text += "%i: %s\n" % (i, self._item(i))
+        if len(self) > 17:
+            text += "etc...\n"
+        return text
+
+    def update_size(self):
+        """Update the array size. Call this function whenever the size
+        parameters change in C{parent}."""
+        old_size = len(self._values)
+        new_size = self._len1()
+        if new_size < old_size:
+            del self._values[new_size:]
+        else:
+            self._values.frombytes(bytes((new_size - old_size) * self._values.itemsize))
+
+    def read(self, stream, data):
+        """Read array from stream."""
+        self._elementTypeArgument = self.arg
+        len1 = self._len1()
+        self.logger.debug("Reading array of size " + str(len1))
+        if len1 > 0x10000000:
+            raise ValueError('array too long (%i)' % len1)
+        size = max(len1, 0) * self._size
+        payload = stream.read(size)
+        if len(payload) != size:
+            raise struct.error("unpack requires a buffer of %i bytes" % size)
+        values = array.array("f" if self._float else self._values.typecode)
+        values.frombytes(payload)
+        if columnar.byte_swapped(data):
+            values.byteswap()
+        self._values = array.array("d", values) if self._float else values
+
+    def write(self, stream, data):
+        """Write array to stream."""
+        self._elementTypeArgument = self.arg
+        len1 = self._len1()
+        if len1 != len(self._values):
+            raise ValueError('array size (%i) different from to field describing number of elements (%i)' %
+                             (len(self._values), len1))
+        if len1 > 0x10000000:
+            raise ValueError('array too long (%i)' % len1)
+        values = self._values
+        if self._float:
+            values = array.array("f", values)
+            # overflows turn into infinities; Float writes those as NaN
+            if float("inf") in values or float("-inf") in values:
+                for elem in self._elementList():
+                    elem.write(stream, data)
+                return
+        if columnar.byte_swapped(data):
+            if values is self._values:
+                values = array.array(values.typecode, values)
+            values.byteswap()
+        stream.write(values.tobytes())
+
+    def get_size(self, data=None):
+        """Calculate the sum of the size of all elements in the array."""
+        return len(self._values) * self._size
+
+    def _elementList(self, **kwargs):
+        """Generator for listing all elements."""
+        for index in range(len(self._values)):
+            yield self._item(index)
+
+    # DetailNode
+
+    def get_detail_child_nodes(self, edge_filter=EdgeFilter()):
+        """Yield children."""
+        return self._elementList()
+
+    def get_detail_child_names(self, edge_filter=EdgeFilter()):
+        """Yield child names."""
+        return ("[%i]" % row for row in range(len(self._values)))
+
+
 from object_models.xml.basic import BasicBase
 from object_models.xml.struct_ import StructBase
+from object_models.xml import columnar
@@ -423,7 +423,7 @@ class BitStructBase(DetailNode, metaclass=_MetaBitStructBase):
             # print("user version check passed") # debug
 
             # check condition
-            if not (attr.cond is None) and not attr.cond.eval(self):
+            if not (attr.cond is None) and not attr.cond.compile()(self):
                 continue
             # print("condition passed") # debug
 
@@ -0,0 +1,461 @@
+"""Columnar storage for arrays of small structs of a fixed layout.
+
+Vertices, normals, triangles, texture coordinates, colors and keys are
+arrays of structs, and each struct holds an object for each of its
+attributes, which makes such arrays slow to read and heavy to keep. Once
+the version, user version, template and argument are known, most of
+these structs have a static layout: every attribute that can be present
+is an integer or float that :class:`~pyffi.object_models.common.Int` or
+:class:`~pyffi.object_models.common.Float` read as is, or again a
+struct with a static layout, and no condition depends on the values
+read.
+
+:func:`layout` finds that layout. :meth:`Array.read` then reads all
+elements at once into one :class:`array.array` per field, and fills the
+array with views: instances of a subclass of the struct type that get
+and set their values in these columns, and behave as the struct does
+otherwise. Attributes that are not part of the layout, such as those
+of other versions, are created on first use. :meth:`Array.write` and
+:meth:`Array.get_size` use the layout as long as the array still holds
+the views it read.
+
+Layouts are cached. Whenever a struct type has no static layout, or its
+logger wants debug messages, :func:`layout` returns ``None`` and the
+array holds struct instances. Set :data:`enabled` to ``False`` to always
+have those.
+"""
+
+# --------------------------------------------------------------------------
+# ***** BEGIN LICENSE BLOCK *****
+#
+# Copyright (c) 2007-2012, Python File Format Interface
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#
+#    * Neither the name of the Python File Format Interface
+#      project nor the names of its contributors may be used to endorse
+#      or promote products derived from this software without specific
+#      prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# ***** END LICENSE BLOCK *****
+# --------------------------------------------------------------------------
+
+# note: some imports are defined at the end to avoid problems with circularity
+import array
+import logging
+import struct
+import types
+
+
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)))
+
+from object_models.xml.struct_compiler import basic_struct_code, refers_only_to
+
+#: Whether :func:`layout` finds layouts at all.
+enabled = True
+
+#: Methods that a basic type must take from Int or Float as is, for its
+#: values to be stored in an :class:`array.array`.
+PACKED_METHODS = ("read", "write", "get_size", "get_value", "set_value")
+
+# methods of the struct type that must be those of StructBase
+_STRUCT_METHODS = ("__init__", "read", "write", "get_size",
+                   "_get_filtered_attribute_list")
+
+# (struct type, version, user version, template, argument) -> Layout or None
+_cache = {}
+
+logger = logging.getLogger("pyffi.object_models.xml.columnar")
+
+
+def typecode(code):
+    """The :mod:`array` type code for storing values of the given
+    :mod:`struct` code. Floats are stored in double precision, as
+    :class:`~pyffi.object_models.common.Float` keeps them until written."""
+    if code == "f":
+        return "d"
+    size = struct.calcsize("<" + code)
+    for typecode in ("bhilq" if code.islower() else "BHILQ"):
+        if array.array(typecode).itemsize == size:
+            return typecode
+    raise ValueError("no array type code for '%s'" % code)
+
+
+def byte_swapped(data):
+    """Whether values in the byte order of *data* must be byte swapped."""
+    byte_order = getattr(data, "_byte_order", "<")
+    if byte_order == "<":
+        return sys.byteorder != "little"
+    elif byte_order in (">", "!"):
+        return sys.byteorder != "big"
+    return False
+
+
+_item_types = {}
+
+
+def item_type(element_type):
+    """A subclass of the basic type *element_type* whose value is an item
+    of a sequence, such as an :class:`array.array` or a
+    :class:`PackedArray`. It takes the sequence and the index."""
+    item_type = _item_types.get(element_type)
+    if item_type is None:
+        def __init__(self, values, index):
+            self._values = values
+            self._index = index
+
+        def get(self):
+            return self._values[self._index]
+
+        def set(self, value):
+            self._values[self._index] = value
+
+        item_type = type(element_type)(
+            element_type.__name__, (element_type,),
+            dict(__init__=__init__, _value=property(get, set),
+                 __module__=element_type.__module__))
+        _item_types[element_type] = item_type
+    return item_type
+
+
+class _NotStatic(Exception):
+    """Raised for struct types without a static layout."""
+
+
+def layout(struct_type, data, template=None, argument=None):
+    """Return the layout of *struct_type* for *data*.
+
+    :param struct_type: The element type of the array.
+    :param data: The data that is being read, written or sized.
+    :param template: The template type of the elements.
+    :param argument: The argument of the elements.
+    :return: A :class:`Layout`, or ``None`` if the elements must be
+        struct instances.
+    """
+    if not enabled or not isinstance(struct_type, type) \
+       or not issubclass(struct_type, StructBase):
+        return None
+    if struct_type.logger.isEnabledFor(logging.DEBUG):
+        return None
+    if data is None:
+        key = (struct_type, None, None, template, argument)
+    else:
+        key = (struct_type, data.version, data.user_version, template, argument)
+    return _get(key)
+
+
+def clear():
+    """Drop all layouts."""
+    _cache.clear()
+
+
+def _get(key):
+    """The cached layout for the *key* of :func:`layout`."""
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # unhashable argument
+        return None
+    try:
+        result = _layout(*key)
+    except _NotStatic as exc:
+        logger.debug("no layout for %s: %s" % (key[0].__name__, exc))
+        result = None
+    _cache[key] = result
+    return result
+
+
+def _layout(struct_type, version, user_version, template, argument):
+    """Find the layout, following
+    :meth:`StructBase._get_filtered_attribute_list`."""
+    if not isinstance(struct_type, type) or not issubclass(struct_type, StructBase):
+        raise _NotStatic("not a struct")
+    for name in _STRUCT_METHODS:
+        if getattr(struct_type, name) is not getattr(StructBase, name):
+            raise _NotStatic("%s is overridden" % name)
+    # the attributes that StructBase.__init__ creates instances for
+    instances = {}
+    for attr in struct_type._attribute_list:
+        instances.setdefault(attr.name, attr)
+    arguments = types.SimpleNamespace(arg=argument)
+    versions = types.SimpleNamespace(version=version, user_version=user_version)
+    fields = []
+    names = set()
+    for attr in struct_type._attribute_list:
+        if version is not None:
+            if attr.ver1 is not None and version < attr.ver1:
+                continue
+            if attr.ver2 is not None and version > attr.ver2:
+                continue
+        if (attr.userver is not None and user_version is not None
+            and user_version != attr.userver):
+            continue
+        if attr.cond is not None:
+            if not refers_only_to(attr.cond, ("arg",)):
+                raise _NotStatic("condition of %s" % attr.name)
+            if not attr.cond.compile()(arguments):
+                continue
+        if (version is not None and user_version is not None
+            and attr.vercond is not None):
+            if not refers_only_to(attr.vercond, ("version", "user_version")):
+                raise _NotStatic("version condition of %s" % attr.name)
+            if not attr.vercond.compile()(versions):
+                continue
+        if attr.name in names:
+            continue
+        names.add(attr.name)
+        if attr.is_abstract:
+            continue
+        fields.append(_field(instances[attr.name], version, user_version, template))
+    return Layout(struct_type, template, argument, fields)
+
+
+def _field(attr, version, user_version, template):
+    """The ``(name, type, code or layout)`` of an attribute."""
+    if attr.arr1 is not None:
+        raise _NotStatic("%s is an array" % attr.name)
+    if not isinstance(attr.arg, (int, type(None))):
+        raise _NotStatic("argument of %s" % attr.name)
+    type_ = attr.type_ if attr.type_ != type(None) else template
+    code = basic_struct_code(type_, PACKED_METHODS)
+    if code is not None:
+        return attr.name, type_, code
+    sub_template = attr.template if attr.template != type(None) else template
+    sub = _get((type_, version, user_version, sub_template, attr.arg))
+    if sub is None:
+        raise _NotStatic("%s has no layout" % attr.name)
+    return attr.name, type_, sub
+
+
+class Layout(object):
+    """The static layout of a struct type for a version, user version,
+    template and argument.
+
+    :ivar fields: ``(name, type, code)`` for the integers and floats
+        present, and ``(name, type, layout)`` for the structs present,
+        in order.
+    :ivar codes: The :mod:`struct` codes of all columns, those of
+        nested structs included.
+    :ivar size: The size of one element in bytes.
+    :ivar signature: Equal for layouts that store the same fields in
+        the same way.
+    """
+
+    def __init__(self, struct_type, template, argument, fields):
+        self.struct_type = struct_type
+        self.template = template
+        self.argument = argument
+        self.fields = fields
+        self.codes = []
+        signature = []
+        for name, type_, sub in fields:
+            if isinstance(sub, Layout):
+                self.codes.extend(sub.codes)
+                signature.append((name, sub.signature))
+            else:
+                self.codes.append(sub)
+                signature.append((name, sub))
+        self.signature = tuple(signature)
+        self.size = struct.calcsize("<" + "".join(self.codes))
+        self._view_types = {}
+
+    def _homogeneous(self):
+        """The code of all columns, if they are all the same."""
+        codes = set(self.codes)
+        return codes.pop() if len(codes) == 1 else None
+
+    def read(self, stream, data, count):
+        """Read *count* elements, and return their columns."""
+        size = count * self.size
+        payload = stream.read(size)
+        if len(payload) != size:
+            raise struct.error("unpack requires a buffer of %i bytes" % size)
+        width = len(self.codes)
+        if not width:
+            return []
+        code = self._homogeneous()
+        if code is not None:
+            # one array, its columns are every width'th item
+            values = array.array("f" if code == "f" else typecode(code))
+            values.frombytes(payload)
+            if byte_swapped(data):
+                values.byteswap()
+            columns = [values[column::width] for column in range(width)]
+        else:
+            fmt = getattr(data, "_byte_order", "<") + "".join(self.codes)
+            columns = list(zip(*struct.iter_unpack(fmt, payload))) or [()] * width
+        for column, code in enumerate(self.codes):
+            values = columns[column]
+            if not isinstance(values, array.array) or values.typecode != typecode(code):
+                columns[column] = array.array(typecode(code), values)
+        return columns
+
+    def write(self, stream, data, columns, count):
+        """Write *count* elements from their columns. Returns ``False``,
+        having written nothing, if a value does not fit."""
+        width = len(self.codes)
+        code = self._homogeneous()
+        if code is not None:
+            values = array.array("f" if code == "f" else typecode(code))
+            if width == 1 and code != "f":
+                values.extend(columns[0])
+            else:
+                values.frombytes(bytes(count * width * values.itemsize))
+                for column in range(width):
+                    values[column::width] = (
+                        array.array("f", columns[column]) if code == "f"
+                        else columns[column])
+            # overflows turn into infinities; Float writes those as NaN
+            if code == "f" and (float("inf") in values or float("-inf") in values):
+                return False
+            if byte_swapped(data):
+                values.byteswap()
+            stream.write(values.tobytes())
+        elif width:
+            packer = struct.Struct(getattr(data, "_byte_order", "<") + "".join(self.codes))
+            try:
+                payload = b"".join(map(packer.pack, *columns))
+            except (OverflowError, struct.error):
+                return False
+            stream.write(payload)
+        return True
+
+    def view_type(self, base=0):
+        """The class of the views on an element whose fields are stored
+        in the columns from *base* on. Its instances take the list of
+        columns and the index of the element."""
+        view_type = self._view_types.get(base)
+        if view_type is None:
+            view_type = self._view_types[base] = self._make_view_type(base)
+        return view_type
+
+    def _make_view_type(self, base):
+        struct_type = self.struct_type
+        namespace = dict(__slots__=(), __module__=struct_type.__module__,
+                         _attrs=[], _layout=self, arg=self.argument)
+        present = set()
+        column = base
+        for name, type_, sub in self.fields:
+            present.add(name)
+            if isinstance(sub, Layout):
+                namespace.update(_struct_field(name, type_, sub.view_type(column)))
+                column += len(sub.codes)
+            else:
+                namespace.update(_basic_field(name, type_, column))
+                column += 1
+        item_names = []
+        absent = {}
+        for attr in struct_type._attribute_list:
+            if attr.name in item_names:
+                continue
+            item_names.append(attr.name)
+            if attr.name not in present:
+                absent["_%s_value_" % attr.name] = attr
+        namespace["_item_names"] = tuple(item_names)
+        namespace["_absent"] = absent
+        return type(struct_type)(struct_type.__name__, (View, struct_type), namespace)
+
+
+def _basic_field(name, type_, column):
+    """Properties of a view for an integer or float in *column*."""
+    item = item_type(type_)
+
+    def get(self):
+        return self._columns[column][self._index]
+
+    def set(self, value):
+        item(self._columns[column], self._index).set_value(value)
+
+    def get_item(self):
+        return item(self._columns[column], self._index)
+
+    return {name: property(get, set), "_%s_value_" % name: property(get_item)}
+
+
+def _struct_field(name, type_, view_type):
+    """Properties of a view for a nested struct, itself viewed through
+    *view_type*."""
+    def get(self):
+        return view_type(self._columns, self._index)
+
+    def set(self, value):
+        if not isinstance(value, type_):
+            raise TypeError("expected %s but got %s"
+                            % (type_.__name__, value.__class__.__name__))
+        get(self).deepcopy(value)
+
+    return {name: property(get, set), "_%s_value_" % name: property(get)}
+
+
+class View(object):
+    """Base of the view types made by :meth:`Layout.view_type`."""
+
+    __slots__ = ("_columns", "_index")
+
+    _absent = {}
+    _item_names = ()
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    @property
+    def _items(self):
+        return [getattr(self, "_%s_value_" % name) for name in self._item_names]
+
+    def __getattr__(self, name):
+        # attributes that are not part of the layout are created as
+        # StructBase.__init__ does, on first use
+        attr = self._absent.get(name)
+        if attr is None:
+            raise AttributeError("'%s' object has no attribute '%s'"
+                                 % (self.__class__.__name__, name))
+        template = self._layout.template
+        rt_type = attr.type_ if attr.type_ != type(None) else template
+        rt_template = attr.template if attr.template != type(None) else template
+        rt_arg = attr.arg if isinstance(attr.arg, (int, type(None))) \
+            else getattr(self, attr.arg)
+        if attr.arr1 is None:
+            value = rt_type(template=rt_template, argument=rt_arg, parent=self)
+            if attr.default is not None:
+                value.set_value(attr.default)
+        else:
+            value = Array(element_type=rt_type,
+                          element_type_template=rt_template,
+                          element_type_argument=rt_arg,
+                          count1=attr.arr1, count2=attr.arr2,
+                          parent=self)
+        setattr(self, name, value)
+        return value
+
+
+from object_models.xml.array import Array
+from object_models.xml.struct_ import StructBase
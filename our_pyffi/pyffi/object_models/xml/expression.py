@@ -40,10 +40,29 @@
 # ***** END LICENSE BLOCK *****
 # --------------------------------------------------------------------------
 
+import operator
 import re
 import sys  # stderr (for debugging)
 
 
+def _and(left, right):
+    return left and right
+
+
+def _or(left, right):
+    return left or right
+
+
+# functions for the binary operators, for Expression.compile
+_FUNCTIONS = {
+    '==': operator.eq, '!=': operator.ne, '>=': operator.ge,
+    '<=': operator.le, '&&': _and, '||': _or, '&': operator.and_,
+    '|': operator.or_, '-': operator.sub, '>': operator.gt,
+    '<': operator.lt, '/': operator.truediv, '*': operator.mul,
+    '+': operator.add, '%': operator.mod,
+}
+
+
 class Expression(object):
     """This class represents an expression.
 
@@ -73,6 +92,14 @@ class Expression(object):
     True
     >>> bool(Expression('1 != 1').eval())
     False
+
+    :meth:`compile` gives a function that does the same as :meth:`eval`
+    without walking the tree on every call:
+
+    >>> Expression('x || y').compile()(a)
+    1
+    >>> Expression('(99 & 15) == 3').compile()(None)
+    True
     """
 
     operators = set(('==', '!=', '>=', '<=', '&&', '||', '&', '|', '-', '!',
@@ -86,6 +113,65 @@ class Expression(object):
         except:
             print("error while parsing expression '%s'" % expr_str)
             raise
+        self._function = None
+
+    def __getstate__(self):
+        # the compiled function is rebuilt on demand, and does not pickle
+        state = self.__dict__.copy()
+        state["_function"] = None
+        return state
+
+    def compile(self):
+        """Return a function that evaluates the expression like
+        :meth:`eval`, taking the data (which may be ``None``) as its
+        only argument.
+        The function is built on first use, and built again after
+        :meth:`map_` changed the operands."""
+        function = self.__dict__.get("_function")
+        if function is None:
+            function = self._function = self._build()
+        return function
+
+    def _build(self):
+        left = self._operand_function(self._left, True)
+        if not self._op:
+            return left
+        right = self._operand_function(self._right, False)
+        if self._op == '!':
+            return lambda data: not right(data)
+        try:
+            func = _FUNCTIONS[self._op]
+        except KeyError:
+            raise NotImplementedError("expression syntax error: operator '" + self._op + "' not implemented")
+        # constants on the right, such as 'x == 1', are common
+        if isinstance(self._right, int) and not isinstance(self._right, bool):
+            value = self._right
+            return lambda data: func(left(data), value)
+        return lambda data: func(left(data), right(data))
+
+    @staticmethod
+    def _operand_function(operand, dotted):
+        """A function giving the value of one operand, as in :meth:`eval`.
+        Only left hand side names are followed through dots."""
+        if isinstance(operand, Expression):
+            return operand.compile()
+        elif isinstance(operand, str):
+            if operand == '""' or not operand:
+                return lambda data: ""
+            elif dotted or "." not in operand:
+                # attrgetter walks dotted names itself
+                return operator.attrgetter(operand)
+            else:
+                return lambda data: getattr(data, operand)
+        elif isinstance(operand, type):
+            return lambda data: isinstance(data, operand)
+        elif operand is None:
+            def missing(data):
+                raise ValueError("expression syntax error: missing operand")
+            return missing
+        else:
+            assert (isinstance(operand, int))  # debug
+            return lambda data: operand
 
     def eval(self, data=None):
         """Evaluate the expression to an integer."""
@@ -341,6 +427,7 @@ class Expression(object):
         return start_pos, end_pos
 
     def map_(self, func):
+        self._function = None
         if isinstance(self._left, Expression):
             self._left.map_(func)
         else:
@@ -50,6 +50,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.
 
 from utils.graph import DetailNode, GlobalNode, EdgeFilter
 import object_models.common
+from object_models.xml import struct_compiler
 
 class _MetaStructBase(type):
     """This metaclass checks for the presence of _attrs and _is_template
@@ -360,6 +361,11 @@ class StructBase(GlobalNode, metaclass=_MetaStructBase):
 
     def read(self, stream, data):
         """Read structure from stream."""
+        # use the function compiled for this version, if there is one
+        compiled = struct_compiler.get(self.__class__, "read", data)
+        if compiled is not None:
+            compiled(self, stream, data)
+            return
         # read all attributes
         for attr in self._get_filtered_attribute_list(data):
             # skip abstract attributes
@@ -379,6 +385,11 @@ class StructBase(GlobalNode, metaclass=_MetaStructBase):
 
     def write(self, stream, data):
         """Write structure to stream."""
+        # use the function compiled for this version, if there is one
+        compiled = struct_compiler.get(self.__class__, "write", data)
+        if compiled is not None:
+            compiled(self, stream, data)
+            return
         # write all attributes
         for attr in self._get_filtered_attribute_list(data):
             # skip abstract attributes
@@ -453,6 +464,10 @@ class StructBase(GlobalNode, metaclass=_MetaStructBase):
 
     def get_size(self, data=None):
         """Calculate the structure size in bytes."""
+        # use the function compiled for this version, if there is one
+        compiled = struct_compiler.get(self.__class__, "get_size", data)
+        if compiled is not None:
+            return compiled(self, data)
         # calculate size
         size = 0
         for attr in self._get_filtered_attribute_list(data):
@@ -557,12 +572,12 @@ class StructBase(GlobalNode, metaclass=_MetaStructBase):
             #print("user version check passed") # debug
 
             # check conditions
-            if attr.cond is not None and not attr.cond.eval(self):
+            if attr.cond is not None and not attr.cond.compile()(self):
                 continue
 
             if (version is not None and user_version is not None
                 and attr.vercond is not None):
-                if not attr.vercond.eval(data):
+                if not attr.vercond.compile()(data):
                     continue
 
             #print("condition passed") # debug
@@ -588,6 +603,10 @@ class StructBase(GlobalNode, metaclass=_MetaStructBase):
         """Set a (non-basic) attribute."""
         # check class
         attr = getattr(self, "_" + name + "_value_")
+        if isinstance(value, View) and value._layout.struct_type is attr.__class__:
+            # views on the columns of an array are copied rather than shared
+            attr.deepcopy(value)
+            return
         if attr.__class__ is not value.__class__:
             raise TypeError("expected %s but got %s"
                             % (attr.__class__.__name__,
@@ -653,3 +672,4 @@ class StructBase(GlobalNode, metaclass=_MetaStructBase):
 
 from object_models.xml.basic import BasicBase
 from object_models.xml.array import Array
+from object_models.xml.columnar import View
@@ -0,0 +1,366 @@
+"""Specialised read, write and get_size functions for struct types.
+
+:meth:`StructBase.read`, :meth:`~StructBase.write` and
+:meth:`~StructBase.get_size` find the active attributes anew on every
+call: they check the version range, user version, condition and version
+condition of each attribute, and keep track of the names already seen.
+For a given struct class and file version most of that is fixed, so
+:func:`get` builds, once per class, version, user version and byte order,
+a Python function that handles exactly the attributes that can be
+present:
+
+* attributes outside the version range or of another user version are
+  left out, and version conditions that only look at the version and
+  user version are decided when the function is built;
+* the remaining conditions are inlined as Python expressions, and names
+  that may occur twice get a local flag instead of a set;
+* runs of integers and floats that are read and written as is by
+  :class:`~pyffi.object_models.common.Int` and
+  :class:`~pyffi.object_models.common.Float` are read and written with
+  a single :class:`struct.Struct`.
+
+The functions are cached. Whenever no function can be built, or the
+logger of the struct wants debug messages, :func:`get` returns
+``None`` and the struct uses its interpreted methods. Set :data:`enabled`
+to ``False`` to always use those.
+"""
+
+# --------------------------------------------------------------------------
+# ***** BEGIN LICENSE BLOCK *****
+#
+# Copyright (c) 2007-2012, Python File Format Interface
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials provided
+#      with the distribution.
+#
+#    * Neither the name of the Python File Format Interface
+#      project nor the names of its contributors may be used to endorse
+#      or promote products derived from this software without specific
+#      prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# ***** END LICENSE BLOCK *****
+# --------------------------------------------------------------------------
+
+import keyword
+import logging
+import struct
+
+#: Whether :func:`get` builds functions at all.
+enabled = True
+
+# (class, kind, version, user version, byte order) -> function or None
+_cache = {}
+
+logger = logging.getLogger("pyffi.object_models.xml.struct_compiler")
+
+_SIGNATURES = {
+    "read": "self, stream, data",
+    "write": "self, stream, data",
+    "get_size": "self, data",
+}
+
+_OPERATORS = {
+    '==': '==', '!=': '!=', '>=': '>=', '<=': '<=', '&&': 'and', '||': 'or',
+    '&': '&', '|': '|', '-': '-', '<': '<', '>': '>', '/': '/', '*': '*',
+    '+': '+', '%': '%',
+}
+
+
+class _Unsupported(Exception):
+    """Raised for attributes that the compiler cannot handle."""
+
+
+class _Version(object):
+    """Stands in for the data when deciding version conditions."""
+
+    def __init__(self, version, user_version):
+        self.version = version
+        self.user_version = user_version
+
+
+def get(cls, kind, data):
+    """Return the compiled *kind* method of *cls* for *data*.
+
+    :param cls: The struct class.
+    :param kind: ``"read"``, ``"write"`` or ``"get_size"``.
+    :param data: The data that is being read, written or sized.
+    :return: A function taking the same arguments as the method, or
+        ``None`` if the interpreted method must be used.
+    """
+    if not enabled or data is None or data.version is None:
+        return None
+    if cls.logger.isEnabledFor(logging.DEBUG):
+        return None
+    key = (cls, kind, data.version, data.user_version,
+           getattr(data, "_byte_order", "<"))
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    try:
+        func = compile_method(cls, kind, *key[2:])
+    except Exception as exc:
+        logger.debug("cannot compile %s.%s: %s" % (cls.__name__, kind, exc))
+        func = None
+    _cache[key] = func
+    return func
+
+
+def clear():
+    """Drop all compiled functions."""
+    _cache.clear()
+
+
+def compile_method(cls, kind, version, user_version, byte_order="<"):
+    """Build the *kind* method of *cls* for the given version, user
+    version and byte order. The source code of the function is stored
+    in its ``source`` attribute.
+    """
+    namespace = {"struct_error": struct.error}
+    entries, flags = _active_attributes(cls, version, user_version, namespace)
+    source = "\n".join(_Writer(kind, byte_order, flags, namespace).function(entries))
+    exec(compile(source, "<%s.%s 0x%08X>" % (cls.__name__, kind, version), "exec"),
+         namespace)
+    func = namespace[kind]
+    func.source = source
+    return func
+
+
+def _active_attributes(cls, version, user_version, namespace):
+    """The attributes of *cls* that can be active, as a list of
+    ``(attr, conditions)`` with the conditions as Python source, and the
+    names that need a flag because a duplicate depends on them.
+
+    Follows :meth:`StructBase._get_filtered_attribute_list`.
+    """
+    entries = []
+    # name -> whether an earlier attribute of that name is always taken
+    always = {}
+    flags = set()
+    for attr in cls._attribute_list:
+        if attr.ver1 is not None and version < attr.ver1:
+            continue
+        if attr.ver2 is not None and version > attr.ver2:
+            continue
+        if (attr.userver is not None and user_version is not None
+            and user_version != attr.userver):
+            continue
+        if always.get(attr.name):
+            continue
+        conditions = []
+        if attr.cond is not None:
+            conditions.append(_expression(attr.cond, "self", namespace))
+        if attr.vercond is not None and user_version is not None:
+            if refers_only_to(attr.vercond, ("version", "user_version")):
+                if not attr.vercond.eval(_Version(version, user_version)):
+                    continue
+            else:
+                conditions.append(_expression(attr.vercond, "data", namespace))
+        if attr.name in always:
+            # an earlier attribute of this name may have been taken
+            flags.add(attr.name)
+            conditions.append("not %s" % _flag(attr.name))
+        entries.append((attr, conditions))
+        always[attr.name] = not conditions
+    return entries, flags
+
+
+def refers_only_to(expr, names):
+    """Whether *expr* only looks at the given attribute *names*."""
+    for operand in (expr._left, expr._right):
+        if hasattr(operand, "_op"):
+            if not refers_only_to(operand, names):
+                return False
+        elif isinstance(operand, str):
+            if operand and operand != '""' \
+               and operand.split(".")[0] not in names:
+                return False
+        elif isinstance(operand, type):
+            return False
+    return True
+
+
+def _expression(expr, target, namespace):
+    """Python source that evaluates *expr* like ``expr.eval(target)``."""
+    if not expr._op:
+        return _operand(expr._left, target, namespace, left=True)
+    right = _operand(expr._right, target, namespace, left=False)
+    if expr._op == '!':
+        return "(not %s)" % right
+    left = _operand(expr._left, target, namespace, left=True)
+    return "(%s %s %s)" % (left, _OPERATORS[expr._op], right)
+
+
+def _operand(operand, target, namespace, left):
+    if hasattr(operand, "_op"):
+        return _expression(operand, target, namespace)
+    elif isinstance(operand, str):
+        if operand == '""' or not operand:
+            return '""'
+        # only the left hand side follows dotted names
+        source = target
+        for part in (operand.split(".") if left else [operand]):
+            source = _attribute(source, part)
+        return source
+    elif isinstance(operand, type):
+        return "isinstance(%s, %s)" % (target, _constant(operand, namespace))
+    elif isinstance(operand, int):
+        return repr(operand)
+    raise _Unsupported("operand %r" % (operand,))
+
+
+def _attribute(source, name):
+    if name.isidentifier() and not keyword.iskeyword(name):
+        return "%s.%s" % (source, name)
+    return "getattr(%s, %r)" % (source, name)
+
+
+def _constant(value, namespace):
+    name = "const_%i" % len(namespace)
+    namespace[name] = value
+    return name
+
+
+def _flag(name):
+    return "seen_%s" % "".join(char if char.isalnum() else "_" for char in name)
+
+
+def _value(attr):
+    return _attribute("self", "_%s_value_" % attr.name)
+
+
+def basic_struct_code(type_, methods=("read", "write", "get_size")):
+    """The :mod:`struct` code of a basic type whose *methods* all come
+    from :class:`~pyffi.object_models.common.Int` or
+    :class:`~pyffi.object_models.common.Float`, else ``None``.
+    """
+    if not isinstance(type_, type):
+        return None
+    owners = set()
+    for name in methods:
+        owners.add(next((base for base in type_.__mro__ if name in vars(base)), None))
+    if len(owners) != 1:
+        return None
+    owner, = owners
+    # the format modules import common both as pyffi.object_models.common
+    # and as object_models.common
+    if owner is None or owner.__name__ not in ("Int", "Float") \
+       or not owner.__module__.endswith("object_models.common"):
+        return None
+    if owner.__name__ == "Float":
+        return "f"
+    if struct.calcsize("<" + type_._struct) != type_._size:
+        return None
+    return type_._struct
+
+
+def _struct_code(attr):
+    """The :mod:`struct` code of an attribute that is read, written and
+    sized by :class:`~pyffi.object_models.common.Int` or
+    :class:`~pyffi.object_models.common.Float` as is, else ``None``.
+    """
+    if attr.arr1 is not None or attr.arg is not None or attr.is_abstract:
+        return None
+    return basic_struct_code(attr.type_)
+
+
+class _Writer(object):
+    """Writes the source code of one function."""
+
+    def __init__(self, kind, byte_order, flags, namespace):
+        self.kind = kind
+        self.byte_order = byte_order
+        self.flags = flags
+        self.namespace = namespace
+        self.lines = []
+
+    def function(self, entries):
+        self.lines.append("def %s(%s):" % (self.kind, _SIGNATURES[self.kind]))
+        for name in sorted(self.flags):
+            self.lines.append("    %s = False" % _flag(name))
+        if self.kind == "get_size":
+            self.lines.append("    size = 0")
+        run = []
+        for attr, conditions in entries:
+            code = None if conditions else _struct_code(attr)
+            if code is not None:
+                run.append((attr, code))
+                continue
+            self.packed(run)
+            run = []
+            self.attribute(attr, conditions)
+        self.packed(run)
+        if self.kind == "get_size":
+            self.lines.append("    return size")
+        elif len(self.lines) == 1:
+            self.lines.append("    pass")
+        return self.lines
+
+    def attribute(self, attr, conditions):
+        indent = "    "
+        body = [] if attr.is_abstract else self.body(attr)
+        if attr.name in self.flags:
+            body.append("%s = True" % _flag(attr.name))
+        if not body:
+            return
+        if conditions:
+            self.lines.append("%sif %s:" % (indent, " and ".join(conditions)))
+            indent += "    "
+        self.lines.extend(indent + line for line in body)
+
+    def body(self, attr):
+        if self.kind == "get_size":
+            code = _struct_code(attr)
+            if code is not None:
+                return ["size += %i" % struct.calcsize("<" + code)]
+            return ["size += %s.get_size(data)" % _value(attr)]
+        if isinstance(attr.arg, (int, type(None))):
+            arg = repr(attr.arg)
+        else:
+            arg = _attribute("self", attr.arg)
+        return ["value = %s" % _value(attr),
+                "value.arg = %s" % arg,
+                "value.%s(stream, data)" % self.kind]
+
+    def packed(self, run):
+        """Handle a run of unconditional integers and floats at once."""
+        if not run:
+            return
+        packer = struct.Struct(self.byte_order + "".join(code for _, code in run))
+        targets = ", ".join("%s._value" % _value(attr) for attr, _ in run)
+        if self.kind == "get_size":
+            self.lines.append("    size += %i" % packer.size)
+        elif self.kind == "read":
+            self.lines.append("    %s, = %s(stream.read(%i))"
+                              % (targets, _constant(packer.unpack, self.namespace), packer.size))
+        else:
+            # on overflow write them one by one, for the float fallback
+            # and for the error message
+            self.lines.extend([
+                "    try:",
+                "        stream.write(%s(%s))" % (_constant(packer.pack, self.namespace), targets),
+                "    except (OverflowError, struct_error):"])
+            self.lines.extend("        %s.write(stream, data)" % _value(attr) for attr, _ in run)
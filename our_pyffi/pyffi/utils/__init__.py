@@ -42,29 +42,44 @@
 # ***** END LICENSE BLOCK *****
 
 import os
-from distutils.cmd import Command
 
 
-class BuildDoc(Command): # pragma: no cover
-    """
-    Distutils command to stop setup.py from throwing errors
-    if sphinx is not installed
-    """
-    
-    description = 'Sphinx is not installed'
-    user_options = []
-    
-    def initialize_options(self):
-        self.source_dir = self.build_dir = None
-        self.project = ''
-        self.version = ''
-        self.release = ''
-    
-    def finalize_options(self):
-        return
-
-    def run(self):
-        raise ModuleNotFoundError("Sphinx is not installed")
+def __getattr__(name):
+    # BuildDoc is only needed by setup.py; importing distutils (and with it
+    # setuptools) costs more than the rest of the package import, so it is
+    # only done when BuildDoc is asked for
+    if name == "BuildDoc":
+        global BuildDoc
+        BuildDoc = _build_doc_class()
+        return BuildDoc
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _build_doc_class():
+    from distutils.cmd import Command
+
+    class BuildDoc(Command): # pragma: no cover
+        """
+        Distutils command to stop setup.py from throwing errors
+        if sphinx is not installed
+        """
+
+        description = 'Sphinx is not installed'
+        user_options = []
+
+        def initialize_options(self):
+            self.source_dir = self.build_dir = None
+            self.project = ''
+            self.version = ''
+            self.release = ''
+
+        def finalize_options(self):
+            return
+
+        def run(self):
+            raise ModuleNotFoundError("Sphinx is not installed")
+
+    return BuildDoc
 
 
 def walk(top, topdown=True, onerror=None, re_filename=None):
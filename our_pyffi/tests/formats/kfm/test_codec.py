@@ -0,0 +1,103 @@
+import io
+import os
+import unittest
+
+from nose.tools import assert_equals, assert_true, raises
+
+from pyffi.formats.kfm import KfmFormat
+from pyffi.formats.kfm import codec
+
+test_root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+kfm_file = os.path.join(test_root, 'spells', 'kfm', 'files', 'test.kfm')
+
+
+def read_data(payload):
+    data = KfmFormat.Data()
+    stream = io.BytesIO(payload)
+    data.inspect(stream)
+    data.read(stream)
+    return data
+
+
+def write_data(data):
+    stream = io.BytesIO()
+    data.write(stream)
+    return stream.getvalue()
+
+
+def synthetic(version):
+    kfm = codec.KfmFile(version)
+    kfm.dos_eol = version < 0x02000000
+    kfm.unknown_byte = 1
+    kfm.nif_file_name = b"Test.nif"
+    kfm.master = b"Bip01"
+    kfm.unknown_int_1 = -7
+    kfm.unknown_float_1 = 0.5
+    kfm.unknown_float_2 = 1.25
+    kfm.unknown_int_3 = 3
+    for code in range(4):
+        anim = codec.Animation(code, b"anim%i.kf" % code, code + 10)
+        anim.transitions.append((code + 1) % 4, 5)
+        anim.transitions.append((code + 2) % 4, 2, 0.25, [codec.IntermediateAnim(1, b"Hit")], 2)
+        anim.transitions.append((code + 3) % 4, 1, 0.75)
+        if version <= 0x01024B00:
+            anim.name = b"Anim %i" % code
+        if version == 0x0202001B:
+            anim.unknown_data = [codec.UnknownData(b"a", b"b", (1.0, 2.0, 3.0, 4.0))]
+            anim.unknown_int = 9
+            anim.unknown_data_2 = [codec.UnknownData2(b"c", 0.5), codec.UnknownData2(b"d", -0.5)]
+        kfm.animations.append(anim)
+    return kfm
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        with open(kfm_file, 'rb') as stream:
+            self.payload = stream.read()
+
+    def test_read_write_file(self):
+        kfm = codec.read(self.payload)
+        assert_equals(kfm.nif_file_name, b"Test.nif")
+        assert_equals([anim.kf_file_name for anim in kfm.animations],
+                      [b"Test_MD_Idle.kf", b"Test_MD_Run.kf", b"Test_MD_Walk.kf", b"Test_MD_Die.kf"])
+        assert_equals(codec.write(kfm), self.payload)
+
+    def test_data_conversion(self):
+        data = read_data(self.payload)
+        kfm = codec.KfmFile.from_data(data)
+        assert_equals(kfm, codec.read(self.payload))
+        assert_equals(write_data(kfm.to_data()), self.payload)
+
+    def test_all_versions(self):
+        for version in KfmFormat.versions.values():
+            kfm = synthetic(version)
+            payload = codec.write(kfm)
+            # the generic reader agrees on every byte
+            data = read_data(payload)
+            assert_equals(data.version, version)
+            assert_equals(write_data(data), payload)
+            assert_equals(codec.KfmFile.from_data(data), codec.read(payload))
+            assert_equals(write_data(codec.read(payload).to_data()), payload)
+            assert_equals(codec.write(codec.read(memoryview(payload))), payload)
+
+    def test_transition_columns(self):
+        kfm = codec.read(codec.write(synthetic(0x0202000B)))
+        transitions = kfm.animations[0].transitions
+        assert_equals(len(transitions), 3)
+        assert_equals(list(transitions.type), [5, 2, 1])
+        assert_equals(list(transitions.duration), [0.0, 0.25, 0.75])
+        assert_equals(transitions.intermediate_anims[1], (codec.IntermediateAnim(1, b"Hit"),))
+        assert_true(all(len(column) == 3 for column in (transitions.animation, transitions.num_text_key_pairs)))
+
+    @raises(ValueError)
+    def test_truncated(self):
+        codec.read(self.payload[:-3])
+
+    @raises(ValueError)
+    def test_trailing_bytes(self):
+        codec.read(self.payload + b"\0")
+
+    @raises(ValueError)
+    def test_not_kfm(self):
+        codec.read(b";Gamebryo NIF File Version 20.0.0.5\n")
@@ -0,0 +1,302 @@
+import io
+import re
+import struct
+import unittest
+
+from nose.tools import assert_equals, assert_true, assert_false, assert_is_none, raises
+
+import pyffi.object_models.xml
+import object_models.common
+from object_models.xml import StructAttribute as Attr
+from object_models.xml import columnar
+from object_models.xml.struct_ import StructBase
+
+
+class SimpleFormat(object):
+    UInt = object_models.common.UInt
+    UShort = object_models.common.UShort
+    Float = object_models.common.Float
+    SizedString = object_models.common.SizedString
+
+    @staticmethod
+    def name_attribute(name):
+        return name
+
+    @staticmethod
+    def version_number(version_str):
+        return int(version_str)
+
+
+class Vector(StructBase):
+    _is_template = False
+    _attrs = [
+        Attr(SimpleFormat, dict(name='x', type='Float')),
+        Attr(SimpleFormat, dict(name='y', type='Float')),
+        Attr(SimpleFormat, dict(name='z', type='Float')),
+    ]
+SimpleFormat.Vector = Vector
+
+
+class Face(StructBase):
+    _is_template = False
+    _attrs = [
+        Attr(SimpleFormat, dict(name='v_1', type='UShort')),
+        Attr(SimpleFormat, dict(name='v_2', type='UShort')),
+        Attr(SimpleFormat, dict(name='normal', type='Vector')),
+        Attr(SimpleFormat, dict(name='material', type='UInt', ver1='2')),
+    ]
+SimpleFormat.Face = Face
+
+
+class Key(StructBase):
+    _is_template = False
+    _attrs = [
+        Attr(SimpleFormat, dict(name='time', type='Float')),
+        Attr(SimpleFormat, dict(name='value', type='TEMPLATE')),
+        Attr(SimpleFormat, dict(name='forward', type='TEMPLATE', cond='arg == 2')),
+    ]
+SimpleFormat.Key = Key
+
+
+class Named(StructBase):
+    _is_template = False
+    _attrs = [
+        Attr(SimpleFormat, dict(name='name', type='SizedString')),
+        Attr(SimpleFormat, dict(name='x', type='Float')),
+    ]
+SimpleFormat.Named = Named
+
+
+class Optional(StructBase):
+    _is_template = False
+    _attrs = [
+        Attr(SimpleFormat, dict(name='has_x', type='UInt')),
+        Attr(SimpleFormat, dict(name='x', type='Float', cond='has_x')),
+    ]
+SimpleFormat.Optional = Optional
+
+
+class X(StructBase):
+    _is_template = False
+    _attrs = [
+        Attr(SimpleFormat, dict(name='num', type='UInt')),
+        Attr(SimpleFormat, dict(name='key_type', type='UInt')),
+        Attr(SimpleFormat, dict(name='vectors', type='Vector', arr1='num')),
+        Attr(SimpleFormat, dict(name='faces', type='Face', arr1='num')),
+        Attr(SimpleFormat, dict(name='keys', type='Key', arg='key_type', arr1='num')),
+        Attr(SimpleFormat, dict(name='rows', type='Vector', arr1='num', arr2='num')),
+        Attr(SimpleFormat, dict(name='named', type='Named', arr1='num')),
+    ]
+X._attrs[4].template = Vector
+
+
+class Data(object):
+    _byte_order = '<'
+
+    def __init__(self, version=3, user_version=0):
+        self.version = version
+        self.user_version = user_version
+
+
+def make_x():
+    x = X()
+    x.num = 2
+    x.key_type = 2
+    for name in ('vectors', 'faces', 'keys', 'rows', 'named'):
+        getattr(x, name).update_size()
+    for i in range(2):
+        x.vectors[i].x = i + 0.5
+        x.vectors[i].z = -i
+        x.faces[i].v_1 = i
+        x.faces[i].v_2 = 100 + i
+        x.faces[i].normal.y = 1
+        x.faces[i].material = 7 + i
+        # as it would have been read
+        x.keys[i].arg = 2
+        x.keys[i].time = i
+        x.keys[i].value.x = 2 * i
+        x.keys[i].forward.z = 3
+        x.named[i].name = b"n%i" % i
+        for j in range(2):
+            x.rows[i][j].y = 10 * i + j
+    return x
+
+
+def without_addresses(text):
+    return re.sub("0x[0-9A-F]+", "", text)
+
+
+def roundtrip(x, data, enabled):
+    columnar.enabled = enabled
+    try:
+        stream = io.BytesIO()
+        x.write(stream, data)
+        payload = stream.getvalue()
+        assert_equals(x.get_size(data), len(payload))
+        y = X()
+        y.read(io.BytesIO(payload), data)
+        return payload, y
+    finally:
+        columnar.enabled = True
+
+
+class TestLayout(unittest.TestCase):
+
+    def setUp(self):
+        columnar.clear()
+
+    def tearDown(self):
+        columnar.clear()
+
+    def test_static(self):
+        layout = columnar.layout(Vector, Data())
+        assert_equals(layout.codes, ['f', 'f', 'f'])
+        assert_equals(layout.size, 12)
+        assert_true(columnar.layout(Vector, Data()) is layout)
+
+    def test_nested_and_versions(self):
+        assert_equals(columnar.layout(Face, Data(1)).codes, ['H', 'H', 'f', 'f', 'f'])
+        assert_equals(columnar.layout(Face, Data(2)).codes, ['H', 'H', 'f', 'f', 'f', 'I'])
+        assert_equals(columnar.layout(Face, Data(2)).size, 20)
+
+    def test_template_and_argument(self):
+        assert_equals(columnar.layout(Key, Data(), Vector, 1).size, 16)
+        assert_equals(columnar.layout(Key, Data(), Vector, 2).size, 28)
+        assert_equals(columnar.layout(Key, Data(), SimpleFormat.UShort, 1).codes, ['f', 'H'])
+
+    def test_not_static(self):
+        assert_is_none(columnar.layout(Named, Data()))
+        assert_is_none(columnar.layout(Optional, Data()))
+        assert_is_none(columnar.layout(X, Data()))
+        assert_is_none(columnar.layout(Key, Data(), Named, 1))
+        assert_is_none(columnar.layout(SimpleFormat.UInt, Data()))
+
+    def test_disabled(self):
+        columnar.enabled = False
+        try:
+            assert_is_none(columnar.layout(Vector, Data()))
+        finally:
+            columnar.enabled = True
+
+
+class TestColumnarArray(unittest.TestCase):
+
+    def setUp(self):
+        columnar.clear()
+        self.x = make_x()
+
+    def tearDown(self):
+        columnar.clear()
+
+    def test_matches_struct_instances(self):
+        for version in (1, 2):
+            for byte_order in '<>':
+                data = Data(version)
+                data._byte_order = byte_order
+                expected, z = roundtrip(self.x, data, False)
+                payload, y = roundtrip(self.x, data, True)
+                assert_equals(payload, expected)
+                assert_equals(y.get_hash(data), z.get_hash(data))
+                assert_equals(without_addresses(str(y)), without_addresses(str(z)))
+                # and written from the columns
+                assert_equals(roundtrip(y, data, True)[0], expected)
+
+    def test_views(self):
+        data = Data()
+        _, y = roundtrip(self.x, data, True)
+        assert_true(isinstance(y.vectors[1], Vector))
+        assert_true(isinstance(y.vectors[1], columnar.View))
+        assert_false(isinstance(y.named[1], columnar.View))
+        assert_equals(y.vectors[1].x, 1.5)
+        assert_equals(y.faces[1].v_2, 101)
+        assert_equals(y.faces[1].normal.y, 1.0)
+        assert_equals(y.faces[1].material, 8)
+        assert_equals(y.keys[1].value.x, 2.0)
+        assert_equals(y.keys[1].forward.z, 3.0)
+        assert_equals(y.rows[1][0].y, 10.0)
+        assert_equals([item.get_value() for item in y.vectors[1].get_detail_child_nodes()],
+                      [1.5, 0.0, -1.0])
+
+    def test_set_through_views(self):
+        data = Data()
+        _, y = roundtrip(self.x, data, True)
+        y.vectors[0].y = 4
+        y.faces[0].normal.z = 5
+        y.keys[0].value = self.x.vectors[1]
+        y.rows[0][1]._x_value_.set_value(6)
+        self.x.vectors[0].y = 4
+        self.x.faces[0].normal.z = 5
+        self.x.keys[0].value.x = 1.5
+        self.x.keys[0].value.z = -1
+        self.x.rows[0][1].x = 6
+        expected, _ = roundtrip(self.x, data, False)
+        assert_equals(roundtrip(y, data, True)[0], expected)
+
+    @raises(ValueError)
+    def test_range_checked(self):
+        _, y = roundtrip(self.x, Data(), True)
+        y.faces[0].v_1 = 0x10000
+
+    @raises(TypeError)
+    def test_struct_type_checked(self):
+        _, y = roundtrip(self.x, Data(), True)
+        y.faces[0].normal = self.x.faces[0]
+
+    def test_absent_attributes(self):
+        # the material is not read for version 1, but can be set
+        data = Data(1)
+        _, y = roundtrip(self.x, data, True)
+        assert_equals(y.faces[0].material, 0)
+        y.faces[0].material = 3
+        assert_equals(y.faces[0].material, 3)
+        assert_equals(len(y.faces[0]._items), 4)
+        # and is written for version 2
+        _, z = roundtrip(y, Data(2), True)
+        assert_equals(z.faces[0].material, 3)
+
+    def test_changed_elements(self):
+        data = Data()
+        _, y = roundtrip(self.x, data, True)
+        list.__setitem__(y.vectors, 0, self.x.vectors[0])
+        list.__setitem__(y.rows[1], 0, self.x.rows[1][0])
+        assert_is_none(y.vectors._columnar_layout(data))
+        assert_is_none(y.rows._columnar_layout(data))
+        assert_true(y.faces._columnar_layout(data) is not None)
+        expected, _ = roundtrip(self.x, data, False)
+        assert_equals(roundtrip(y, data, True)[0], expected)
+
+    def test_resized(self):
+        data = Data()
+        _, y = roundtrip(self.x, data, True)
+        y.num = 3
+        for name in ('vectors', 'faces', 'keys', 'rows', 'named'):
+            getattr(y, name).update_size()
+        y.vectors[2].x = 9
+        self.x.num = 3
+        for name in ('vectors', 'faces', 'keys', 'rows', 'named'):
+            getattr(self.x, name).update_size()
+        self.x.vectors[2].x = 9
+        expected, _ = roundtrip(self.x, data, False)
+        assert_equals(roundtrip(y, data, True)[0], expected)
+
+    def test_float_overflow(self):
+        data = Data()
+        _, y = roundtrip(self.x, data, True)
+        y.vectors[1].y = 1e300
+        y.faces[1].normal.x = 1e300
+        self.x.vectors[1].y = 1e300
+        self.x.faces[1].normal.x = 1e300
+        expected, _ = roundtrip(self.x, data, False)
+        assert_equals(roundtrip(y, data, True)[0], expected)
+
+    def test_copy_into_struct(self):
+        _, y = roundtrip(self.x, Data(), True)
+        face = Face()
+        face.normal = y.faces[1].normal
+        assert_false(isinstance(face.normal, columnar.View))
+        assert_equals(face.normal.y, 1.0)
+
+    @raises(struct.error)
+    def test_short_read(self):
+        payload, _ = roundtrip(self.x, Data(), False)
+        X().read(io.BytesIO(payload[:20]), Data())
@@ -1,3 +1,4 @@
+import pickle
 import unittest
 
 from pyffi.object_models.xml.expression import Expression
@@ -54,6 +55,62 @@ class TestExpression(unittest.TestCase):
         self.a.x = B()
         assert_equals(Expression('x * 10').eval(self.a), 70)
 
+class C(object):
+    num = 3
+    flags = 6
+    hello = "world"
+
+    def __init__(self):
+        self.a = A()
+
+
+class TestCompile(unittest.TestCase):
+
+    expressions = [
+        'x || y', 'x && y', '!x', '!(num == 3)', 'num', 'num == 3',
+        'num != 3', '(num >= 2) && (num <= 4)', 'flags & 2', 'flags | 1',
+        'num - 1', 'num * 2', 'num + 1', 'flags % 4', 'flags / 4',
+        '(flags & 4) != 0', 'num > 2', 'num < 2', 'a.y', 'a.y && y',
+        'hello == ""', '1.2.3.4 >= 16909060', '(99 & 15) == 3',
+    ]
+
+    def setUp(self):
+        self.c = C()
+        self.c.x = False
+        self.c.y = True
+
+    def test_matches_eval(self):
+        for expr_str in self.expressions:
+            expr = Expression(expr_str)
+            assert_equals((expr_str, expr.compile()(self.c)), (expr_str, expr.eval(self.c)))
+
+    def test_type_operand(self):
+        expr = Expression('C')
+        expr.map_(lambda x: C if x == 'C' else x)
+        assert_true(expr.compile()(self.c))
+        assert_false(expr.compile()(A()))
+
+    def test_map_rebuilds(self):
+        expr = Expression('num == 3')
+        assert_true(expr.compile()(self.c))
+        expr.map_(lambda x: 'flags' if x == 'num' else x)
+        assert_false(expr.compile()(self.c))
+
+    def test_compile_is_cached(self):
+        expr = Expression('(num == 3) && y')
+        assert_true(expr.compile() is expr.compile())
+
+    def test_pickle(self):
+        expr = Expression('(num == 3) && y')
+        expr.compile()
+        expr = pickle.loads(pickle.dumps(expr))
+        assert_true(expr.compile()(self.c))
+
+    @raises(AttributeError)
+    def test_attribute_error(self):
+        Expression('c || d').compile()(self.c)
+
+
 class TestPartition:
 
     def test_partition_empty(self):
@@ -0,0 +1,134 @@
+import io
+import struct
+import unittest
+
+from nose.tools import assert_equals, assert_true, assert_false, raises
+
+import pyffi.object_models.xml
+import object_models.common
+from object_models.xml import StructAttribute as Attr
+import object_models.xml.array
+from object_models.xml.array import Array, PackedArray
+from object_models.xml.struct_ import StructBase
+
+
+class SimpleFormat(object):
+    UInt = object_models.common.UInt
+    Short = object_models.common.Short
+    Float = object_models.common.Float
+    Bool = object_models.common.Bool
+
+    @staticmethod
+    def name_attribute(name):
+        return name
+
+
+class X(StructBase):
+    _is_template = False
+    _attrs = [
+        Attr(SimpleFormat, dict(name='num', type='UInt')),
+        Attr(SimpleFormat, dict(name='floats', type='Float', arr1='num')),
+        Attr(SimpleFormat, dict(name='shorts', type='Short', arr1='num')),
+        Attr(SimpleFormat, dict(name='bools', type='Bool', arr1='num')),
+        Attr(SimpleFormat, dict(name='rows', type='Short', arr1='num', arr2='num')),
+    ]
+
+
+class Data(object):
+    _byte_order = '<'
+    version = None
+    user_version = None
+
+
+class TestPackedArray(unittest.TestCase):
+
+    def setUp(self):
+        self.x = X()
+        self.x.num = 3
+        for name in ('floats', 'shorts', 'bools', 'rows'):
+            getattr(self.x, name).update_size()
+        self.x.floats[0] = 0.5
+        self.x.floats[2] = -2
+        self.x.shorts[1] = -7
+        self.x.shorts[2] = '0x10'
+
+    def test_chosen_for_numbers(self):
+        assert_true(isinstance(self.x.floats, PackedArray))
+        assert_true(isinstance(self.x.shorts, PackedArray))
+        # bools convert their values, two dimensional arrays are not packed
+        assert_false(isinstance(self.x.bools, PackedArray))
+        assert_false(isinstance(self.x.rows, PackedArray))
+        assert_true(isinstance(self.x.floats, Array))
+
+    def test_items(self):
+        assert_equals(list(self.x.floats), [0.5, 0.0, -2.0])
+        assert_equals(list(self.x.shorts), [0, -7, 16])
+        assert_equals(self.x.shorts[-1], 16)
+        assert_equals(self.x.shorts[1:], [-7, 16])
+        assert_equals(len(self.x.shorts), 3)
+        assert_true(-7 in self.x.shorts)
+        assert_equals(self.x.shorts, [0, -7, 16])
+
+    @raises(ValueError)
+    def test_range_checked(self):
+        self.x.shorts[0] = 0x8000
+
+    def test_list_methods(self):
+        shorts = self.x.shorts
+        shorts.append(5)
+        shorts.extend([6, 7])
+        shorts.insert(0, 1)
+        assert_equals(shorts.pop(), 7)
+        shorts.remove(-7)
+        del shorts[0]
+        assert_equals(list(shorts), [0, 16, 5, 6])
+        shorts.sort(reverse=True)
+        assert_equals(list(shorts), [16, 6, 5, 0])
+
+    def test_update_size(self):
+        self.x.num = 5
+        self.x.shorts.update_size()
+        assert_equals(list(self.x.shorts), [0, -7, 16, 0, 0])
+        self.x.num = 1
+        self.x.shorts.update_size()
+        assert_equals(list(self.x.shorts), [0])
+
+    def test_read_write(self):
+        for byte_order in '<>':
+            data = Data()
+            data._byte_order = byte_order
+            stream = io.BytesIO()
+            self.x.write(stream, data)
+            payload = stream.getvalue()
+            assert_equals(payload[4:20], struct.pack(byte_order + '3f2h', 0.5, 0, -2, 0, -7))
+            assert_equals(self.x.get_size(data), len(payload))
+            y = X()
+            y.read(io.BytesIO(payload), data)
+            assert_equals(list(y.floats), [0.5, 0.0, -2.0])
+            assert_equals(list(y.shorts), [0, -7, 16])
+
+    def test_float_overflow(self):
+        self.x.floats[1] = 1e300
+        stream = io.BytesIO()
+        self.x.floats.write(stream, Data())
+        assert_equals(stream.getvalue()[4:8], struct.pack('<I', 0x7fc00000))
+
+    @raises(struct.error)
+    def test_short_read(self):
+        self.x.floats.read(io.BytesIO(b'\x00' * 8), Data())
+
+    def test_element_views(self):
+        elems = list(self.x.shorts.get_detail_child_nodes())
+        assert_true(isinstance(elems[1], SimpleFormat.Short))
+        assert_equals(elems[1].get_value(), -7)
+        elems[1].set_value(3)
+        assert_equals(self.x.shorts[1], 3)
+        assert_equals(self.x.shorts.get_hash(), (0, 3, 16))
+        assert_true("1: 3" in str(self.x.shorts))
+
+    @unittest.skipIf(object_models.xml.array.numpy is None, "requires numpy")
+    def test_numpy_view(self):
+        view = self.x.floats.numpy_view()
+        assert_equals(view.tolist(), [0.5, 0.0, -2.0])
+        view[1] = 4
+        assert_equals(self.x.floats[1], 4.0)
@@ -0,0 +1,189 @@
+import os
+import io
+import shutil
+import pickle
+import tempfile
+import unittest
+
+from nose.tools import assert_equals, assert_true
+
+from pyffi.formats.kfm import KfmFormat
+import object_models.xml
+
+test_root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+kfm_file = os.path.join(test_root, 'spells', 'kfm', 'files', 'test.kfm')
+
+
+def make_format(**dct):
+    """A fresh copy of KfmFormat, created the way the import creates it."""
+    dct = dict(KfmFormat._xml_class_dict, **dict(dict(schema_file_name=None, schema_cache_dir=None), **dct))
+    dct.pop("__classcell__", None)
+    return type(KfmFormat)(KfmFormat.__name__, KfmFormat.__bases__, dct)
+
+
+def describe(fmt):
+    return [(klass.__name__,
+             [(attr.name, getattr(attr.type_, "__name__", attr.type_), attr.default, str(attr.arr1), str(attr.cond), attr.ver1, attr.ver2)
+              for attr in getattr(klass, "_attrs", [])],
+             getattr(klass, "_enumkeys", None), getattr(klass, "_enumvalues", None))
+            for klass in fmt.xml_struct + fmt.xml_enum + fmt.xml_alias + fmt.xml_bit_struct]
+
+
+def read(fmt):
+    data = fmt.Data()
+    with open(kfm_file, 'rb') as stream:
+        data.inspect(stream)
+        data.read(stream)
+    out = io.BytesIO()
+    data.write(out)
+    return data, out.getvalue()
+
+
+class TestSchema(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.schema_file = tempfile.mkstemp(suffix=".schema")
+        os.close(fd)
+        KfmFormat.write_schema(self.schema_file)
+        self.load_xml = object_models.xml.XmlParser.load_xml
+
+    def tearDown(self):
+        object_models.xml.XmlParser.load_xml = self.load_xml
+        os.remove(self.schema_file)
+
+    def test_loads_schema_without_parsing(self):
+        def fail(*args):
+            raise AssertionError("xml parsed")
+        object_models.xml.XmlParser.load_xml = fail
+        fmt = make_format(schema_file_name=self.schema_file)
+        assert_equals(fmt.versions, KfmFormat.versions)
+        assert_equals(fmt.games, KfmFormat.games)
+        assert_equals(describe(fmt), describe(KfmFormat))
+
+    def test_read_write_matches(self):
+        fmt = make_format(schema_file_name=self.schema_file)
+        data, payload = read(fmt)
+        _, expected = read(KfmFormat)
+        assert_equals(payload, expected)
+        assert_equals(data.nif_file_name, b"Test.nif")
+
+    def test_stale_schema_parses_xml(self):
+        parsed = []
+        def load_xml(parser, file):
+            parsed.append(True)
+            return self.load_xml(parser, file)
+        object_models.xml.XmlParser.load_xml = load_xml
+        fmt = make_format(schema_file_name=self.schema_file, xml_source=KfmFormat._xml_class_dict["xml_source"] + "\n")
+        assert_true(parsed)
+        assert_equals(describe(fmt), describe(KfmFormat))
+
+    def test_damaged_schema_parses_xml(self):
+        with open(self.schema_file, 'r+b') as file:
+            file.truncate(100)
+        fmt = make_format(schema_file_name=self.schema_file)
+        assert_equals(describe(fmt), describe(KfmFormat))
+
+    def test_missing_schema_parses_xml(self):
+        os.remove(self.schema_file)
+        fmt = make_format(schema_file_name=self.schema_file)
+        assert_equals(describe(fmt), describe(KfmFormat))
+        # tearDown removes it
+        open(self.schema_file, 'wb').close()
+
+
+class TestSchemaCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.load_xml = object_models.xml.XmlParser.load_xml
+        self.parsed = []
+        def load_xml(parser, file):
+            self.parsed.append(True)
+            return self.load_xml(parser, file)
+        object_models.xml.XmlParser.load_xml = load_xml
+
+    def tearDown(self):
+        object_models.xml.XmlParser.load_xml = self.load_xml
+        shutil.rmtree(self.cache_dir)
+
+    def cache_files(self):
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+
+    def test_parse_then_load_from_cache(self):
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        assert_equals(len(self.parsed), 1)
+        assert_equals(self.cache_files(), [fmt.schema_cache_path()])
+
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        assert_equals(len(self.parsed), 1)
+        assert_equals(describe(fmt), describe(KfmFormat))
+        assert_equals(read(fmt)[1], read(KfmFormat)[1])
+
+    def test_other_xml_other_key(self):
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        path = fmt.schema_cache_path()
+        fmt = make_format(schema_cache_dir=self.cache_dir, xml_source=KfmFormat._xml_class_dict["xml_source"] + "\n")
+        assert_equals(len(self.parsed), 2)
+        assert_true(fmt.schema_cache_path() != path)
+        # the entry for the old xml is gone
+        assert_equals(self.cache_files(), [fmt.schema_cache_path()])
+
+    def test_other_formats_kept(self):
+        other = os.path.join(self.cache_dir, "NifFormat-0123456789abcdef.schema")
+        open(other, 'wb').close()
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        assert_equals(sorted(self.cache_files()), sorted([other, fmt.schema_cache_path()]))
+
+    def test_foreign_pickle_not_loaded(self):
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        cache_file = fmt.schema_cache_path()
+        schema = object_models.xml._load_schema(cache_file)
+        # a pickle of the right shape, but not written by _save_schema
+        with open(cache_file, 'wb') as file:
+            pickle.dump(schema, file)
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        assert_equals(len(self.parsed), 2)
+        assert_equals(describe(fmt), describe(KfmFormat))
+
+    def test_tampered_pickle_not_loaded(self):
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        cache_file = fmt.schema_cache_path()
+        with open(cache_file, 'r+b') as file:
+            file.seek(-1, os.SEEK_END)
+            last = file.read(1)
+            file.seek(-1, os.SEEK_END)
+            file.write(bytes([last[0] ^ 1]))
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        assert_equals(len(self.parsed), 2)
+        assert_equals(describe(fmt), describe(KfmFormat))
+
+    def test_changed_module_other_key(self):
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        path = fmt.schema_cache_path()
+        module = os.path.join(self.cache_dir, "module.py")
+        with open(module, 'w') as file:
+            file.write("")
+        modules = object_models.xml.SCHEMA_MODULES
+        object_models.xml.SCHEMA_MODULES = modules + [module]
+        try:
+            changed = fmt.schema_cache_path()
+            assert_true(changed != path)
+            with open(module, 'w') as file:
+                file.write("x = 1")
+            assert_true(fmt.schema_cache_path() != changed)
+        finally:
+            object_models.xml.SCHEMA_MODULES = modules
+
+    def test_failed_replay_falls_back(self):
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        cache_file = fmt.schema_cache_path()
+        schema = object_models.xml._load_schema(cache_file)
+        # the last class can't be restored, after the others were created
+        schema["records"][-1] = (schema["records"][-1][0], b"not a pickle")
+        object_models.xml._save_schema(cache_file, schema["digest"], schema["versions"], schema["games"], schema["records"])
+
+        fmt = make_format(schema_cache_dir=self.cache_dir)
+        assert_equals(len(self.parsed), 2)
+        assert_equals(fmt.versions, KfmFormat.versions)
+        assert_equals(describe(fmt), describe(KfmFormat))
+        assert_equals(read(fmt)[1], read(KfmFormat)[1])
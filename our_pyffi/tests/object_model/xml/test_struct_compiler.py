@@ -0,0 +1,175 @@
+import io
+import os
+import unittest
+
+from nose.tools import assert_equals, assert_true, assert_false, assert_is_none, raises
+
+from pyffi.formats.kfm import KfmFormat
+import object_models.common
+from object_models.xml import StructAttribute as Attr
+from object_models.xml import struct_compiler
+from object_models.xml.struct_ import StructBase
+
+test_root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+kfm_file = os.path.join(test_root, 'spells', 'kfm', 'files', 'test.kfm')
+
+
+class SimpleFormat(object):
+    UInt = object_models.common.UInt
+    UShort = object_models.common.UShort
+    Float = object_models.common.Float
+    SizedString = object_models.common.SizedString
+
+    @staticmethod
+    def name_attribute(name):
+        return name
+
+    @staticmethod
+    def version_number(version_str):
+        return int(version_str)
+
+
+class X(StructBase):
+    _is_template = False
+    _attrs = [
+        Attr(SimpleFormat, dict(name='a', type='UInt')),
+        Attr(SimpleFormat, dict(name='b', type='Float')),
+        Attr(SimpleFormat, dict(name='old', type='UInt', ver2='1')),
+        Attr(SimpleFormat, dict(name='c', type='UShort', ver1='2')),
+        Attr(SimpleFormat, dict(name='d', type='UInt', cond='a == 1')),
+        Attr(SimpleFormat, dict(name='e', type='SizedString', vercond='version >= 3')),
+        Attr(SimpleFormat, dict(name='f', type='UInt', vercond='flags & 1')),
+        Attr(SimpleFormat, dict(name='g', type='Float', cond='a != 1')),
+        Attr(SimpleFormat, dict(name='g', type='UInt')),
+        Attr(SimpleFormat, dict(name='h', type='UInt', userver='7')),
+        Attr(SimpleFormat, dict(name='i', type='UInt', abstract='1')),
+    ]
+
+
+class Data(object):
+    _byte_order = '<'
+
+    def __init__(self, version, user_version=0, flags=0):
+        self.version = version
+        self.user_version = user_version
+        self.flags = flags
+
+
+def roundtrip(x, data, compiled):
+    struct_compiler.enabled = compiled
+    try:
+        stream = io.BytesIO()
+        x.write(stream, data)
+        payload = stream.getvalue()
+        assert_equals(x.get_size(data), len(payload))
+        y = X()
+        y.read(io.BytesIO(payload), data)
+        return payload, y
+    finally:
+        struct_compiler.enabled = True
+
+
+class TestStructCompiler(unittest.TestCase):
+
+    def setUp(self):
+        struct_compiler.clear()
+        self.x = X()
+        self.x.a = 1
+        self.x.b = 0.5
+        self.x.old = 2
+        self.x.c = 3
+        self.x.d = 4
+        self.x.e = b"abc"
+        self.x.f = 5
+        self.x.g = 6
+        self.x.h = 7
+
+    def tearDown(self):
+        struct_compiler.clear()
+
+    def test_matches_interpreted(self):
+        for version in range(5):
+            for user_version in (0, 7, None):
+                for flags in (0, 1):
+                    for a in (1, 2):
+                        self.x.a = a
+                        data = Data(version, user_version, flags)
+                        expected, _ = roundtrip(self.x, data, False)
+                        payload, y = roundtrip(self.x, data, True)
+                        assert_equals(payload, expected)
+                        _, z = roundtrip(y, data, False)
+                        assert_equals(str(y).split("\n")[1:], str(z).split("\n")[1:])
+
+    def test_folds_versions(self):
+        source = struct_compiler.compile_method(X, "read", 3, 0).source
+        assert_false("_old_value_" in source)
+        assert_false("_h_value_" in source)
+        assert_false("version" in source)
+        assert_true("data.flags" in source)
+        assert_false("_i_value_" in source)
+        source = struct_compiler.compile_method(X, "read", 1, 7).source
+        assert_true("_old_value_" in source)
+        assert_true("_h_value_" in source)
+        assert_false("_e_value_" in source)
+
+    def test_merges_fixed_size_fields(self):
+        # a, b and c in one go
+        source = struct_compiler.compile_method(X, "read", 2, 0).source
+        assert_true("self._a_value_._value, self._b_value_._value, self._c_value_._value, = " in source)
+        assert_true("stream.read(10)" in source)
+
+    def test_duplicate_names(self):
+        # the second g is only written when the first was not
+        source = struct_compiler.compile_method(X, "write", 4, 0).source
+        assert_true("not seen_g" in source)
+        for a in (1, 2):
+            self.x.a = a
+            expected, _ = roundtrip(self.x, Data(4), False)
+            payload, y = roundtrip(self.x, Data(4), True)
+            assert_equals(payload, expected)
+            assert_equals(y.g, 6)
+
+    def test_byte_order(self):
+        data = Data(4)
+        data._byte_order = '>'
+        expected, _ = roundtrip(self.x, data, False)
+        payload, _ = roundtrip(self.x, data, True)
+        assert_equals(payload, expected)
+
+    def test_float_overflow(self):
+        self.x.b = 1e300
+        data = Data(4)
+        expected, _ = roundtrip(self.x, data, False)
+        payload, _ = roundtrip(self.x, data, True)
+        assert_equals(payload, expected)
+
+    def test_fallback(self):
+        assert_is_none(struct_compiler.get(X, "read", None))
+        struct_compiler.enabled = False
+        try:
+            assert_is_none(struct_compiler.get(X, "read", Data(4)))
+        finally:
+            struct_compiler.enabled = True
+        assert_true(struct_compiler.get(X, "read", Data(4)) is struct_compiler.get(X, "read", Data(4)))
+
+    @raises(struct_compiler._Unsupported)
+    def test_unsupported(self):
+        class Y(StructBase):
+            _is_template = False
+            _attrs = [Attr(SimpleFormat, dict(name='a', type='UInt', cond='== 1'))]
+        struct_compiler.compile_method(Y, "read", 0, 0)
+
+    def test_kfm(self):
+        for compiled in (False, True):
+            struct_compiler.enabled = compiled
+            try:
+                data = KfmFormat.Data()
+                with open(kfm_file, 'rb') as stream:
+                    data.inspect(stream)
+                    data.read(stream)
+                out = io.BytesIO()
+                data.write(out)
+                with open(kfm_file, 'rb') as stream:
+                    assert_equals(out.getvalue(), stream.read())
+            finally:
+                struct_compiler.enabled = True
@@ -0,0 +1,102 @@
+"""Compare arrays of small structs (vectors, triangles, texture
+coordinates and keys) read as one struct instance per element with the
+columnar arrays that Array now reads them into: read and write time, and
+memory held by the array.
+
+Run from the repository root, with it on the path::
+
+    PYTHONPATH=. python tests/perf/columnar.py [elements]
+"""
+
+import io
+import random
+import struct
+import sys
+import time
+import tracemalloc
+
+import pyffi.object_models.xml
+import object_models.common
+from object_models.xml import StructAttribute as Attr
+from object_models.xml import columnar
+from object_models.xml.struct_ import StructBase
+
+
+class Format(object):
+    UInt = object_models.common.UInt
+    UShort = object_models.common.UShort
+    Float = object_models.common.Float
+
+    @staticmethod
+    def name_attribute(name):
+        return name
+
+
+def compound(name, *fields):
+    cls = type(StructBase)(name, (StructBase,), dict(
+        _is_template=False,
+        _attrs=[Attr(Format, dict(name=field, type=type_)) for field, type_ in fields]))
+    setattr(Format, name, cls)
+    return cls
+
+
+compound('Vector3', ('x', 'Float'), ('y', 'Float'), ('z', 'Float'))
+compound('Triangle', ('v_1', 'UShort'), ('v_2', 'UShort'), ('v_3', 'UShort'))
+compound('TexCoord', ('u', 'Float'), ('v', 'Float'))
+compound('Key', ('time', 'Float'), ('value', 'Vector3'))
+
+CODES = {'Vector3': 'fff', 'Triangle': 'HHH', 'TexCoord': 'ff', 'Key': 'ffff'}
+
+
+class Data(object):
+    _byte_order = '<'
+    version = 0
+    user_version = 0
+
+
+def block_type(element_type):
+    class Block(StructBase):
+        _is_template = False
+        _attrs = [
+            Attr(Format, dict(name='num', type='UInt')),
+            Attr(Format, dict(name='values', type=element_type, arr1='num')),
+        ]
+    return Block
+
+
+def measure(block, payload, enabled):
+    columnar.enabled = enabled
+    try:
+        start = time.perf_counter()
+        block.read(io.BytesIO(payload), Data())
+        read_time = time.perf_counter() - start
+        start = time.perf_counter()
+        out = io.BytesIO()
+        block.write(out, Data())
+        write_time = time.perf_counter() - start
+        assert out.getvalue() == payload
+        tracemalloc.start()
+        block.read(io.BytesIO(payload), Data())
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return read_time, write_time, memory
+    finally:
+        columnar.enabled = True
+
+
+def main(elements=100000):
+    print("%i elements" % elements)
+    print("%-10s %-10s %8s %8s %9s" % ("", "", "read", "write", "memory"))
+    for element_type, code in CODES.items():
+        values = [random.randrange(1000) for _ in range(elements * len(code))]
+        payload = struct.pack('<I' + code * elements, elements, *values)
+        block = block_type(element_type)()
+        for enabled in (False, True):
+            read_time, write_time, memory = measure(block, payload, enabled)
+            print("%-10s %-10s %6.1fms %6.1fms %7.1fMB"
+                  % (element_type, "columnar" if enabled else "structs",
+                     read_time * 1e3, write_time * 1e3, memory / 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,71 @@
+"""Compare Expression.eval, which walks the parsed tree on every call, with
+the functions returned by Expression.compile, on the kinds of cond, arr1
+and vercond expressions found in the xml files.
+
+Run from the repository root, with it on the path::
+
+    PYTHONPATH=. python tests/perf/expression.py [evaluations]
+"""
+
+import sys
+import time
+
+from pyffi.object_models.xml.expression import Expression
+
+
+class Block(object):
+    has_normals = True
+    num_vertices = 120
+    num_uv_sets = 4097
+    flags = 6
+    version = 0x14020007
+    user_version = 11
+
+
+EXPRESSIONS = [
+    'has_normals',
+    'num_vertices',
+    'num_uv_sets & 63',
+    'flags == 6',
+    '(flags & 4) != 0',
+    'version >= 20.2.0.7',
+    '(version >= 10.1.0.0) && (user_version == 11)',
+    '(version >= 20.2.0.7) && ((user_version == 11) || (user_version == 12))',
+    '!(num_vertices == 0)',
+]
+
+
+def best_of(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(evaluations=100000):
+    block = Block()
+    print("%i evaluations each" % evaluations)
+    print("%-75s %8s %8s %8s" % ("", "eval", "compiled", "speedup"))
+    for expr_str in EXPRESSIONS:
+        expr = Expression(expr_str)
+        function = expr.compile()
+        assert function(block) == expr.eval(block)
+
+        def interpreted():
+            for _ in range(evaluations):
+                expr.eval(block)
+
+        def compiled():
+            for _ in range(evaluations):
+                expr.compile()(block)
+
+        eval_time = best_of(interpreted)
+        compiled_time = best_of(compiled)
+        print("%-75s %6.1fms %6.1fms %7.1fx"
+              % (expr_str, eval_time * 1e3, compiled_time * 1e3, eval_time / compiled_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,76 @@
+"""Compare the fast KFM codec (pyffi.formats.kfm.codec) with the generic
+KfmFormat.Data reader and writer on a large synthetic KFM file.
+
+Run from the repository root, with it on the path::
+
+    PYTHONPATH=. python tests/perf/kfm_codec.py [animations] [transitions per animation]
+"""
+
+import io
+import sys
+import time
+
+from pyffi.formats.kfm import KfmFormat
+from pyffi.formats.kfm import codec
+
+
+def synthetic(num_animations, num_transitions):
+    kfm = codec.KfmFile(0x0202000B)
+    kfm.nif_file_name = b"Synthetic.nif"
+    for code in range(num_animations):
+        anim = codec.Animation(code, b"Synthetic_%05i.kf" % code, code)
+        for n in range(num_transitions):
+            target = (code + n + 1) % num_animations
+            if n % 4 == 3:
+                anim.transitions.append(target, 5)
+            else:
+                anim.transitions.append(target, n % 3, 0.25)
+        kfm.animations.append(anim)
+    return codec.write(kfm)
+
+
+def best_of(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def data_read(payload):
+    data = KfmFormat.Data()
+    stream = io.BytesIO(payload)
+    data.inspect(stream)
+    data.read(stream)
+    return data
+
+
+def data_write(data):
+    stream = io.BytesIO()
+    data.write(stream)
+    return stream.getvalue()
+
+
+def main(num_animations=2000, num_transitions=20):
+    payload = synthetic(num_animations, num_transitions)
+    print("%i animations, %i transitions, %i bytes"
+          % (num_animations, num_animations * num_transitions, len(payload)))
+
+    generic_read, data = best_of(lambda: data_read(payload))
+    fast_read, kfm = best_of(lambda: codec.read(payload))
+    generic_write, generic_payload = best_of(lambda: data_write(data))
+    fast_write, fast_payload = best_of(lambda: codec.write(kfm))
+    assert generic_payload == fast_payload == payload
+    from_data, _ = best_of(lambda: codec.KfmFile.from_data(data))
+    to_data, _ = best_of(lambda: kfm.to_data())
+
+    print("%-10s %10s %10s %8s" % ("", "Data", "codec", "speedup"))
+    print("%-10s %8.1fms %8.1fms %7.1fx" % ("read", generic_read * 1e3, fast_read * 1e3, generic_read / fast_read))
+    print("%-10s %8.1fms %8.1fms %7.1fx" % ("write", generic_write * 1e3, fast_write * 1e3, generic_write / fast_write))
+    print("from_data %8.1fms" % (from_data * 1e3))
+    print("to_data   %8.1fms" % (to_data * 1e3))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
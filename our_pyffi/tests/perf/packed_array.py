@@ -0,0 +1,94 @@
+"""Compare arrays of floats and unsigned shorts read as one object per
+element (Array) with the packed arrays (PackedArray) that Array now
+creates for them: read and write time, and memory held by the array.
+
+Run from the repository root, with it on the path::
+
+    PYTHONPATH=. python tests/perf/packed_array.py [elements]
+"""
+
+import io
+import struct
+import sys
+import time
+import tracemalloc
+
+import pyffi.object_models.xml
+import object_models.common
+from object_models.xml import StructAttribute as Attr
+from object_models.xml.array import Array, PackedArray
+from object_models.xml.struct_ import StructBase
+
+
+class Format(object):
+    UInt = object_models.common.UInt
+    UShort = object_models.common.UShort
+    Float = object_models.common.Float
+
+    @staticmethod
+    def name_attribute(name):
+        return name
+
+
+class Data(object):
+    _byte_order = '<'
+    version = 0
+    user_version = 0
+
+
+def struct_type(element_type):
+    class Block(StructBase):
+        _is_template = False
+        _attrs = [
+            Attr(Format, dict(name='num', type='UInt')),
+            Attr(Format, dict(name='values', type=element_type, arr1='num')),
+        ]
+    return Block
+
+
+class UnpackedArray(Array):
+    """Array as it was: never packed."""
+
+
+def read(block_type, payload, array_type):
+    block = block_type()
+    stream = io.BytesIO(payload)
+    block._num_value_.read(stream, Data())
+    values = array_type(element_type=block._values_value_._elementType,
+                        count1=block._values_value_._count1, parent=block)
+    values.read(stream, Data())
+    return block, values
+
+
+def measure(block_type, payload, array_type):
+    start = time.perf_counter()
+    block, values = read(block_type, payload, array_type)
+    read_time = time.perf_counter() - start
+    start = time.perf_counter()
+    out = io.BytesIO()
+    values.write(out, Data())
+    write_time = time.perf_counter() - start
+    assert out.getvalue() == payload[4:]
+    del block, values
+    tracemalloc.start()
+    block, values = read(block_type, payload, array_type)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return read_time, write_time, memory
+
+
+def main(elements=200000):
+    print("%i elements" % elements)
+    print("%-8s %-14s %8s %8s %9s" % ("", "", "read", "write", "memory"))
+    for element_type, code in (('Float', 'f'), ('UShort', 'H')):
+        payload = struct.pack('<I%i%s' % (elements, code), elements,
+                              *(i % 1000 for i in range(elements)))
+        block_type = struct_type(element_type)
+        for array_type in (UnpackedArray, PackedArray):
+            read_time, write_time, memory = measure(block_type, payload, array_type)
+            print("%-8s %-14s %6.1fms %6.1fms %7.1fMB"
+                  % (element_type, array_type.__name__, read_time * 1e3, write_time * 1e3, memory / 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,324 @@
+import io
+import os
+import unittest
+
+from our_pyffi.pyffi.formats.kfm import KfmFormat
+from kfm_commands import Command, CommandType, CommandManager, KfmIndex, to_plain
+
+TEST_KFM = os.path.join(os.path.dirname(__file__), os.pardir, "our_pyffi", "tests", "spells", "kfm", "files", "test.kfm")
+
+
+class Uber:
+    # what CommandManager needs from the editor
+    def __init__(self, data):
+        self.data = data
+        self.unsaved_changes = False
+
+    def refresh_ui(self, *args):
+        pass
+
+
+def read_kfm(filename):
+    data = KfmFormat.Data()
+    with open(filename, 'rb') as stream:
+        data.inspect(stream)
+        data.read(stream)
+    return data
+
+
+def payload(data):
+    stream = io.BytesIO()
+    data.write(stream)
+    return stream.getvalue()
+
+
+def make_data():
+    # test.kfm with event codes 1-4 and a transition from every animation to
+    # every other one, but for the last to the first
+    data = read_kfm(TEST_KFM)
+    codes = [i + 1 for i in range(len(data.animations))]
+    for anim, code in zip(data.animations, codes):
+        anim.event_code = code
+    for anim in data.animations:
+        targets = [code for code in codes if code != anim.event_code and (anim.event_code, code) != (4, 1)]
+        anim.num_transitions = len(targets)
+        anim.transitions.update_size()
+        for t, code in zip(anim.transitions, targets):
+            t.animation = code
+            t.type = 5
+    return data
+
+
+def make_manager(**kwargs):
+    manager = CommandManager(Uber(make_data()), **kwargs)
+    manager.clear()
+    return manager
+
+
+def index_state(index):
+    # the tables of a KfmIndex by object identity, so an index kept up to
+    # date can be compared with a fresh one; bucket order doesn't matter
+    def refs(bucket):
+        return sorted((id(anim), id(t)) for anim, t in bucket.values())
+    return {
+        "animations": {code: sorted(map(id, anims)) for code, anims in index.animations.items()},
+        "references": {code: refs(bucket) for code, bucket in index.references.items()},
+        "transition_types": {type_: refs(bucket) for type_, bucket in index.transition_types.items()},
+        "indices": {i: sorted(bucket) for i, bucket in index.indices.items()},
+        "kf_names": {key: (id(anim), name) for key, (anim, name) in index.kf_names.items()},
+        "rows": [index.animation_row(anim) for anim in index.data.animations],
+    }
+
+
+def other_kfm():
+    data = make_data()
+    data.kfm.master = b"Master.nif"
+    data.animations[0].kf_file_name = b"Test_MD_Jump.kf"
+    data.num_animations = 2
+    data.animations.update_size()
+    return to_plain(data.kfm)
+
+
+# one command per CommandType, each applicable to make_data() and to the
+# result of the ones before it
+COMMANDS = [
+    Command(CommandType.EDIT_NIF_FILENAME, "Other.nif"),
+    Command(CommandType.PASTE_TRANSITIONS, [{"animation": 1, "type": 1}], animation_index=3),
+    Command(CommandType.EDIT_NUM_ANIMATIONS, 6),
+    Command(CommandType.EDIT_ANIMATION_KF_FILENAME, "Test_MD_Jump.kf", animation_index=1),
+    Command(CommandType.EDIT_ANIMATION_EVENT_CODE, 10, animation_index=1),
+    Command(CommandType.EDIT_ANIMATION_INDEX, 3, animation_index=2),
+    Command(CommandType.REMOVE_ANIMATION, animation_index=0),
+    Command(CommandType.REMOVE_TRANSITION, animation_index=3, transition_index=1),
+    Command(CommandType.EDIT_NUM_TRANSITIONS, 1, animation_index=0),
+    Command(CommandType.EDIT_NUM_TRANSITIONS, 5, animation_index=0),
+    Command(CommandType.EDIT_TRANSITION_ANIMATION, 4, animation_index=0, transition_index=0),
+    Command(CommandType.EDIT_TRANSITION_TYPE, 2, animation_index=0, transition_index=2),
+    Command(CommandType.DUPLICATE_ANIMATIONS, [0, 2], animation_index=0),
+    Command(CommandType.PASTE_ANIMATIONS, [to_plain(anim) for anim in make_data().animations[:2]]),
+    Command(CommandType.EDIT_NUM_ANIMATIONS, 2),
+    Command(CommandType.REPLACE_KFM, other_kfm()),
+]
+
+
+class TestUndoRedo(unittest.TestCase):
+
+    def test_every_command_type(self):
+        self.assertEqual({command.type for command in COMMANDS}, set(CommandType))
+
+    def test_undo_redo(self):
+        for command in COMMANDS:
+            with self.subTest(command=command.type.value):
+                manager = make_manager()
+                before = payload(manager.uber.data)
+                self.assertTrue(manager.execute(command))
+                after = payload(manager.uber.data)
+                self.assertNotEqual(after, before)
+
+                manager.undo()
+                self.assertEqual(payload(manager.uber.data), before)
+                manager.redo()
+                self.assertEqual(payload(manager.uber.data), after)
+                manager.undo()
+                self.assertEqual(payload(manager.uber.data), before)
+
+    def test_undo_redo_all(self):
+        manager = make_manager()
+        states = [payload(manager.uber.data)]
+        for command in COMMANDS:
+            self.assertTrue(manager.execute(command), command)
+            states.append(payload(manager.uber.data))
+        self.assertEqual(manager.history_pointer, len(COMMANDS))
+
+        for state in reversed(states[:-1]):
+            manager.undo()
+            self.assertEqual(payload(manager.uber.data), state)
+        for state in states[1:]:
+            manager.redo()
+            self.assertEqual(payload(manager.uber.data), state)
+
+    def test_rejected_command(self):
+        manager = make_manager()
+        before = payload(manager.uber.data)
+        self.assertFalse(manager.execute(Command(CommandType.EDIT_ANIMATION_EVENT_CODE, 2, animation_index=0)))
+        self.assertEqual(payload(manager.uber.data), before)
+        self.assertEqual(manager.history, [])
+        self.assertFalse(manager.uber.unsaved_changes)
+
+    def test_new_command_drops_redo(self):
+        manager = make_manager()
+        manager.execute(COMMANDS[0])
+        manager.execute(COMMANDS[3])
+        manager.undo()
+        manager.execute(COMMANDS[4])
+        self.assertEqual([command for command, _ in manager.history], [COMMANDS[0], COMMANDS[4]])
+        self.assertEqual(manager.history_cost, sum(changes.cost for _, changes in manager.history))
+
+
+class IndexTestCase(unittest.TestCase):
+
+    def assert_index_fresh(self, manager):
+        self.assertEqual(index_state(manager.index), index_state(KfmIndex(manager.uber.data)))
+
+
+class TestKfmIndex(IndexTestCase):
+
+    def test_incremental(self):
+        # inserts, removes and edits, then undo and redo of all of them
+        manager = make_manager()
+        self.assert_index_fresh(manager)
+        for command in COMMANDS:
+            self.assertTrue(manager.execute(command), command)
+            self.assert_index_fresh(manager)
+        for _ in COMMANDS:
+            manager.undo()
+            self.assert_index_fresh(manager)
+        for _ in COMMANDS:
+            manager.redo()
+            self.assert_index_fresh(manager)
+
+    def test_queries(self):
+        manager = make_manager()
+        manager.execute(Command(CommandType.EDIT_ANIMATION_EVENT_CODE, 10, animation_index=1))
+        manager.execute(Command(CommandType.EDIT_TRANSITION_TYPE, 2, animation_index=0, transition_index=1))
+        manager.execute(Command(CommandType.REMOVE_ANIMATION, animation_index=3))
+        manager.undo()
+        fresh = KfmIndex(manager.uber.data)
+        for criteria in ({"to": 10}, {"to": 2}, {"type": 2}, {"type": 5}, {"kf": ["walk"]}, {"event_code": 4}, {"index": 0}):
+            self.assertEqual(manager.index.search(**criteria), fresh.search(**criteria), criteria)
+        self.assertIsNone(manager.index.animation(2))
+        self.assertEqual(manager.index.next_event_code(), 11)
+        self.assertEqual(sorted(manager.index.animation_row(a) for a, _ in manager.index.refs(10)), [0, 2, 3])
+
+
+class TestPaste(IndexTestCase):
+
+    def test_paste_animations(self):
+        manager = make_manager()
+        before = payload(manager.uber.data)
+        plains = [to_plain(anim) for anim in make_data().animations[:2]]
+        self.assertTrue(manager.execute(Command(CommandType.PASTE_ANIMATIONS, plains)))
+        # 1 and 2 come in as 5 and 6, wired like the originals both ways
+        self.assertEqual([anim.event_code for anim in manager.uber.data.animations], [1, 2, 3, 4, 5, 6])
+        self.assertEqual([t.animation for t in manager.uber.data.animations[4].transitions], [6, 3, 4])
+        self.assertEqual(sorted(manager.index.animation_row(a) for a, _ in manager.index.refs(5)), [1, 2, 5])
+        self.assertEqual(sorted(manager.index.animation_row(a) for a, _ in manager.index.refs(6)), [0, 2, 3, 4])
+        self.assert_index_fresh(manager)
+        manager.undo()
+        self.assertEqual(payload(manager.uber.data), before)
+        self.assert_index_fresh(manager)
+
+    def test_paste_nothing(self):
+        manager = make_manager()
+        before = payload(manager.uber.data)
+        self.assertTrue(manager.execute(Command(CommandType.PASTE_ANIMATIONS, [])))
+        self.assertEqual(payload(manager.uber.data), before)
+        self.assertEqual(manager.history, [])
+
+
+class TestTransaction(IndexTestCase):
+
+    def test_rollback(self):
+        manager = make_manager()
+        manager.execute(COMMANDS[0])
+        before = payload(manager.uber.data)
+        generation = manager.generation
+        history = list(manager.history)
+        manager.uber.unsaved_changes = False
+
+        # the second event code change is refused, 7 is taken by then
+        self.assertFalse(manager.execute_many([
+            Command(CommandType.EDIT_NUM_ANIMATIONS, 6),
+            Command(CommandType.REMOVE_TRANSITION, animation_index=1, transition_index=0),
+            Command(CommandType.EDIT_ANIMATION_EVENT_CODE, 7, animation_index=0),
+            Command(CommandType.EDIT_ANIMATION_EVENT_CODE, 7, animation_index=4),
+            Command(CommandType.EDIT_ANIMATION_KF_FILENAME, "Test_MD_Jump.kf", animation_index=1),
+        ]))
+        self.assertEqual(payload(manager.uber.data), before)
+        self.assertEqual(manager.generation, generation)
+        self.assertEqual(manager.history, history)
+        self.assertIsNone(manager.transaction)
+        self.assertFalse(manager.uber.unsaved_changes)
+        self.assert_index_fresh(manager)
+
+        # and the manager carries on as if it hadn't happened
+        manager.undo()
+        self.assertEqual(manager.generation, generation + 1)
+        self.assert_index_fresh(manager)
+        manager.redo()
+        self.assertEqual(payload(manager.uber.data), before)
+        self.assert_index_fresh(manager)
+
+    def test_nested_rollback(self):
+        manager = make_manager()
+        before = payload(manager.uber.data)
+        manager.begin_transaction()
+        manager.execute(Command(CommandType.EDIT_NUM_ANIMATIONS, 6))
+        manager.begin_transaction()
+        manager.execute(Command(CommandType.REMOVE_ANIMATION, animation_index=0))
+        self.assertFalse(manager.rollback())
+        # later commands of a failed transaction are not applied
+        self.assertFalse(manager.execute(Command(CommandType.EDIT_NIF_FILENAME, "Other.nif")))
+        self.assertFalse(manager.commit())
+        self.assertEqual(payload(manager.uber.data), before)
+        self.assertEqual(manager.generation, 0)
+        self.assertEqual(manager.history, [])
+        self.assert_index_fresh(manager)
+
+    def test_commit(self):
+        manager = make_manager()
+        before = payload(manager.uber.data)
+        commands = COMMANDS[:3]
+        self.assertTrue(manager.execute_many(commands))
+        after = payload(manager.uber.data)
+        self.assertEqual(manager.history[0][0], commands)
+        self.assertEqual(manager.generation, 1)
+        self.assert_index_fresh(manager)
+        manager.undo()
+        self.assertEqual(payload(manager.uber.data), before)
+        self.assert_index_fresh(manager)
+        manager.redo()
+        self.assertEqual(payload(manager.uber.data), after)
+        self.assert_index_fresh(manager)
+
+
+class TestHistoryBudget(unittest.TestCase):
+
+    def test_eviction(self):
+        manager = make_manager(history_budget=1000)
+        states = [payload(manager.uber.data)]
+        for code in range(10, 20):
+            self.assertTrue(manager.execute(Command(CommandType.EDIT_ANIMATION_EVENT_CODE, code, animation_index=0)))
+            states.append(payload(manager.uber.data))
+
+        # the oldest entries went, what is left fits the budget
+        self.assertLess(len(manager.history), 10)
+        self.assertEqual(manager.history_pointer, len(manager.history))
+        self.assertEqual(manager.history_cost, sum(changes.cost for _, changes in manager.history))
+        self.assertLessEqual(manager.history_cost, manager.history_budget)
+
+        # undo goes back as far as the history reaches and no further
+        kept = len(manager.history)
+        for state in reversed(states[-kept - 1:-1]):
+            manager.undo()
+            self.assertEqual(payload(manager.uber.data), state)
+        manager.undo()
+        self.assertEqual(payload(manager.uber.data), states[-kept - 1])
+        for state in states[-kept:]:
+            manager.redo()
+            self.assertEqual(payload(manager.uber.data), state)
+
+    def test_latest_entry_kept(self):
+        manager = make_manager(history_budget=1)
+        self.assertTrue(manager.execute(COMMANDS[1]))
+        self.assertTrue(manager.execute(COMMANDS[12]))
+        self.assertEqual(len(manager.history), 1)
+        self.assertEqual(manager.history_pointer, 1)
+        before = payload(manager.uber.data)
+        manager.undo()
+        manager.redo()
+        self.assertEqual(payload(manager.uber.data), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+import kfm_diff
+from tests.test_kfm_commands import make_data
+
+
+class TestLocate(unittest.TestCase):
+
+    def setUp(self):
+        self.data = make_data()
+
+    def test_found(self):
+        self.assertEqual(kfm_diff.locate(self.data, kfm_diff.FILE, "nif_file_name"), (True, (None, None)))
+        self.assertEqual(kfm_diff.locate(self.data, kfm_diff.ANIMATION, 3), (True, (2, None)))
+        # animation 2 has transitions to 1, 3 and 4
+        self.assertEqual(kfm_diff.locate(self.data, kfm_diff.TRANSITION, (2, 3)), (True, (1, 1)))
+
+    def test_missing(self):
+        missing = (False, (None, None))
+        self.assertEqual(kfm_diff.locate(self.data, kfm_diff.ANIMATION, 9), missing)
+        self.assertEqual(kfm_diff.locate(self.data, kfm_diff.ANIMATION, (3, 1)), missing)
+        self.assertEqual(kfm_diff.locate(self.data, kfm_diff.TRANSITION, (4, 1)), missing)
+        self.assertEqual(kfm_diff.locate(self.data, kfm_diff.TRANSITION, (9, 1)), missing)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+import os
+import sys
+import shutil
+import tempfile
+import logging
+import unittest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+try:
+    from PyQt5.QtWidgets import QApplication, QPlainTextEdit
+except ImportError:
+    QApplication = None
+
+if QApplication is not None:
+    import kfm_editor
+    import kfm_diff
+    import kfm_io
+    from kfm_commands import CommandType
+    from tests.test_kfm_commands import TEST_KFM, make_data, payload
+
+
+def setUpModule():
+    global app
+    if QApplication is not None:
+        app = QApplication.instance() or QApplication([])
+
+
+@unittest.skipIf(QApplication is None, "needs PyQt5")
+class TestConsoleSink(unittest.TestCase):
+
+    def setUp(self):
+        self.text_box = QPlainTextEdit()
+        self.sink = kfm_editor.ConsoleSink(self.text_box, max_lines=10)
+        self.wakes = []
+        self.sink.wake.connect(lambda: self.wakes.append(True))
+
+    def test_coalesced(self):
+        for i in range(5):
+            self.sink.write(f"line {i}\n")
+        # nothing reaches the widget until the timer fires, and a burst
+        # schedules it once
+        self.assertEqual(self.text_box.toPlainText(), "")
+        self.assertEqual(len(self.wakes), 1)
+        self.sink.flush_to_widget()
+        self.assertEqual(self.text_box.toPlainText(), "".join(f"line {i}\n" for i in range(5)))
+        self.sink.write("more\n")
+        self.assertEqual(len(self.wakes), 2)
+
+    def test_last_lines_kept(self):
+        for i in range(25):
+            self.sink.write(f"line {i}\n")
+        self.assertLessEqual(self.sink.pending_lines, 10)
+        self.sink.flush_to_widget()
+        lines = self.text_box.toPlainText().splitlines()
+        self.assertLessEqual(len(lines), 11)
+        self.assertEqual(lines[-1], "line 24")
+
+    def test_level(self):
+        self.sink.write("debug\n", logging.DEBUG)
+        self.sink.log(logging.WARNING, "careful")
+        self.sink.flush_to_widget()
+        self.assertEqual(self.text_box.toPlainText(), "WARNING: careful\n")
+
+
+@unittest.skipIf(QApplication is None, "needs PyQt5")
+class EditorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # the editor takes over stdout and the root logger for its console
+        self.stdout = sys.stdout
+        self.uber = kfm_editor.UberKFM()
+        self.uber.loaded(TEST_KFM, make_data())
+        self.model = self.uber.model
+        self.manager = self.uber.command_manager
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        logging.getLogger().removeHandler(self.uber.console.handler)
+        # nothing to save, so closing doesn't prompt
+        self.uber.unsaved_changes = False
+        self.uber.close()
+
+    def animation_rows(self, rows):
+        animations = self.model.index(kfm_editor.KfmTreeModel.ANIMATIONS_ROW, 0)
+        self.model.fetchMore(animations)
+        return [self.model.index(row, 0, animations) for row in rows]
+
+
+class TestBulkEdit(EditorTestCase):
+
+    def field_rows(self, animation_rows, name):
+        row = next(i for i, field in enumerate(kfm_editor.KfmTreeModel.ANIMATION_FIELDS) if field[0] == name)
+        return [self.model.index(row, 0, index) for index in animation_rows]
+
+    def select(self, indexes):
+        selection = self.uber.tree.selectionModel()
+        selection.clearSelection()
+        for index in indexes:
+            selection.select(index, selection.Select | selection.Rows)
+
+    def test_selection_field(self):
+        anims = self.animation_rows([0, 2])
+        kf_rows = self.field_rows(anims, "KF File Name")
+        self.assertEqual(self.model.selection_field(anims), (None, kfm_editor.TreeNode.ANIMATIONS))
+        self.assertEqual(self.model.selection_field(kf_rows), ("kf_file_name", kfm_editor.TreeNode.ANIMATION))
+        self.assertIsNone(self.model.selection_field(anims[:1] + kf_rows[:1]))
+
+    def test_edit_batch(self):
+        kf_rows = self.field_rows(self.animation_rows([1, 3]), "KF File Name")
+        commands = [self.model.edit_command(index, "kf_file_name", "Bulk.kf") for index in kf_rows]
+        self.assertEqual([(c.type, c.animation_index) for c in commands], [(CommandType.EDIT_ANIMATION_KF_FILENAME, 1), (CommandType.EDIT_ANIMATION_KF_FILENAME, 3)])
+
+        before = payload(self.uber.data)
+        self.assertTrue(self.manager.execute_many(commands))
+        self.assertEqual([anim.kf_file_name for anim in self.uber.data.animations][1::2], [b"Bulk.kf"] * 2)
+        # the whole batch is one undo step
+        self.manager.undo()
+        self.assertEqual(payload(self.uber.data), before)
+
+    def test_remove_selected(self):
+        codes = [anim.event_code for anim in self.uber.data.animations]
+        self.select(self.animation_rows([0, 2]))
+        self.uber.remove_selected()
+        self.assertEqual([anim.event_code for anim in self.uber.data.animations], [codes[1], codes[3]])
+        self.assertEqual(len(self.manager.history), 1)
+
+
+class TestTreeModel(EditorTestCase):
+
+    def fetch_all(self):
+        for anim in self.animation_rows(range(len(self.uber.data.animations))):
+            transitions = self.model.index(kfm_editor.KfmTreeModel.TRANSITIONS_ROW, 0, anim)
+            self.model.fetchMore(transitions)
+            for row in range(self.model.rowCount(transitions)):
+                self.model.hasChildren(self.model.index(row, 0, transitions))
+
+    def node_ids(self):
+        return {key[1] for key in self.model.nodes}
+
+    def test_removed_nodes_dropped(self):
+        self.fetch_all()
+        anim = self.uber.data.animations[1]
+        removed = {id(anim)} | {id(t) for t in anim.transitions}
+        self.assertTrue(removed <= self.node_ids())
+        self.uber.remove_animation(1)
+        self.assertFalse(removed & self.node_ids())
+
+        # undo puts it back with new nodes
+        self.manager.undo()
+        self.fetch_all()
+        self.assertTrue(removed <= self.node_ids())
+        anims = self.animation_rows([1])
+        self.assertEqual(self.model.node_of(anims[0]).obj, anim)
+
+    def test_reset_drops_nodes(self):
+        self.fetch_all()
+        self.model.reset_data(None)
+        self.assertEqual(self.model.nodes, {})
+
+
+class TestTransitionMatrix(EditorTestCase):
+
+    def grid(self):
+        model = self.uber.matrix_model
+        model.refresh(self.uber.data)
+        return [[model.data(model.index(row, column)) for column in range(model.columnCount())] for row in range(model.rowCount())]
+
+    def fresh_grid(self):
+        model = kfm_editor.TransitionMatrixModel(self.uber)
+        model.rebuild(self.uber.data)
+        return [[model.data(model.index(row, column)) for column in range(model.columnCount())] for row in range(model.rowCount())]
+
+    def test_grid(self):
+        # make_data() has type 5 transitions between all event codes 1-4
+        # but 4 -> 1
+        self.assertEqual(self.grid(), [
+            ["", "5", "5", "5"],
+            ["5", "", "5", "5"],
+            ["5", "5", "", "5"],
+            ["", "5", "5", ""],
+        ])
+        model = self.uber.matrix_model
+        self.assertEqual([model.headerData(column, kfm_editor.Qt.Horizontal) for column in range(4)], ["1", "2", "3", "4"])
+
+    def test_edits(self):
+        model = self.uber.matrix_model
+        self.grid()
+        # edit, add and remove a cell, then change an event code, which
+        # changes the columns
+        self.assertTrue(model.setData(model.index(0, 1), "2"))
+        self.assertTrue(model.setData(model.index(3, 0), "3"))
+        self.assertTrue(model.setData(model.index(1, 2), ""))
+        self.assertEqual(self.grid(), self.fresh_grid())
+        self.assertEqual(self.grid()[:2], [["", "2", "5", "5"], ["5", "", "", "5"]])
+        self.assertTrue(self.uber.command_manager.execute(kfm_editor.Command(
+            type=CommandType.EDIT_ANIMATION_EVENT_CODE, new_value=9, animation_index=3)))
+        self.assertEqual(self.grid(), self.fresh_grid())
+        self.assertIn("9", [model.headerData(column, kfm_editor.Qt.Horizontal) for column in range(model.columnCount())])
+        for _ in range(4):
+            self.uber.command_manager.undo()
+        self.assertEqual(self.grid()[0], ["", "5", "5", "5"])
+        self.assertEqual(self.grid(), self.fresh_grid())
+
+
+class TestSave(EditorTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "a.kfm")
+        shutil.copyfile(TEST_KFM, self.filename)
+        super().setUp()
+        self.uber.loaded(self.filename, kfm_io.read_kfm(self.filename))
+        self.manager = self.uber.command_manager
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_save(self):
+        self.assertTrue(self.manager.execute(kfm_editor.Command(type=CommandType.EDIT_NIF_FILENAME, new_value="Other.nif")))
+        self.assertTrue(self.uber.save_mission(ask=False, wait=True))
+        self.assertFalse(self.uber.unsaved_changes)
+        self.assertEqual(kfm_io.serialize(kfm_io.read_kfm(self.filename)), kfm_io.serialize(self.uber.data))
+        self.assertEqual(kfm_io.read_kfm(self.filename).nif_file_name, b"Other.nif")
+
+
+class TestConflicts(EditorTestCase):
+
+    def conflict_tabs(self):
+        tabs = self.uber.tabs
+        return [tabs.tabText(i) for i in range(tabs.count()) if tabs.tabText(i).startswith("Conflicts")]
+
+    def test_second_merge_replaces_tab(self):
+        file_conflict = kfm_diff.Conflict(kfm_diff.FILE, "nif_file_name", "Test.nif", "Test.nif", "Theirs.nif")
+        animation_conflict = kfm_diff.Conflict(kfm_diff.ANIMATION, 9, {}, None, {"index": 1})
+        self.uber.show_conflicts([animation_conflict, file_conflict])
+        self.uber.show_conflicts([file_conflict])
+        self.assertEqual(self.conflict_tabs(), ["Conflicts (1)"])
+        self.assertEqual(self.uber.conflict_list.count(), 1)
+
+        self.uber.conflict_list.setCurrentRow(0)
+        self.uber.use_theirs()
+        self.assertEqual(self.uber.data.nif_file_name, b"Theirs.nif")
+        self.assertEqual(self.conflict_tabs(), [])
+
+        # and a merge without conflicts closes the tab of the one before
+        self.uber.show_conflicts([animation_conflict])
+        self.uber.show_conflicts([])
+        self.assertEqual(self.conflict_tabs(), [])
+
+    def test_missing_record_kept(self):
+        conflict = kfm_diff.Conflict(kfm_diff.ANIMATION, 9, {"index": 0}, {"index": 1}, {"index": 2}, fields=["index"])
+        self.uber.show_conflicts([conflict])
+        self.uber.conflict_list.setCurrentRow(0)
+        self.uber.use_theirs()
+        self.assertEqual(self.conflict_tabs(), ["Conflicts (1)"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import kfm_io
+from kfm_index import KfmFileIndex
+
+TEST_KFM = os.path.join(os.path.dirname(__file__), os.pardir, "our_pyffi", "tests", "spells", "kfm", "files", "test.kfm")
+
+
+def write_kfm(filename, nif, codes):
+    # test.kfm with the given NIF, event codes for its animations and a
+    # transition of type 5 from each animation to the next
+    data = kfm_io.read_kfm(TEST_KFM)
+    data.nif_file_name = nif
+    data.num_animations = len(codes)
+    data.animations.update_size()
+    for anim, code, target in zip(data.animations, codes, codes[1:] + codes[:1]):
+        anim.event_code = code
+        anim.num_transitions = 1
+        anim.transitions.update_size()
+        anim.transitions[0].animation = target
+        anim.transitions[0].type = 5
+    kfm_io.write_kfm(data, filename)
+
+
+class TestKfmIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, "sub"))
+        self.a = os.path.join(self.root, "a.kfm")
+        self.b = os.path.join(self.root, "sub", "b.kfm")
+        self.bad = os.path.join(self.root, "bad.kfm")
+        write_kfm(self.a, "Meshes\\A.nif", [1, 2, 3])
+        write_kfm(self.b, "B.nif", [2, 4])
+        with open(self.bad, "wb") as file:
+            file.write(b";Gamebryo KFM File Version 2.2.0.0b\n")
+        with open(os.path.join(self.root, "notes.txt"), "w") as file:
+            file.write("not a kfm")
+        self.index = KfmFileIndex()
+        self.assertEqual(self.index.update([self.root]), {"scanned": 3, "unchanged": 0, "removed": 0, "errors": 1})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_queries(self):
+        index = self.index
+        self.assertEqual(index.files_using_nif("a.NIF"), [self.a])
+        self.assertEqual(index.files_using_nif("meshes/a.nif"), [self.a])
+        self.assertEqual(index.files_using_nif("other/a.nif"), [])
+        self.assertEqual(sorted(index.files_using_kf("test_md_run.kf")), [(self.a, 2), (self.b, 4)])
+        self.assertEqual(index.files_using_kf("Test_MD_Walk.kf"), [(self.a, 3)])
+        self.assertEqual(sorted(path for path, _ in index.files_with_event(2)), [self.a, self.b])
+        self.assertEqual(sorted(index.transitions_to(2)), sorted([(self.a, 1, 5), (self.b, 4, 5)]))
+        self.assertEqual(list(index.errors()), [self.bad])
+
+    def test_incremental(self):
+        index = self.index
+        # errors counts the files read this time
+        self.assertEqual(index.update(), {"scanned": 0, "unchanged": 3, "removed": 0, "errors": 0})
+
+        write_kfm(self.b, "C.nif", [2, 4, 5])
+        os.remove(self.a)
+        self.assertEqual(index.update(), {"scanned": 1, "unchanged": 1, "removed": 1, "errors": 0})
+        self.assertEqual(index.files_using_nif("a.nif"), [])
+        self.assertEqual(index.files_using_nif("b.nif"), [])
+        self.assertEqual(index.files_using_nif("c.nif"), [self.b])
+        self.assertEqual(index.transitions_to(2), [(self.b, 5, 5)])
+
+    def test_other_root_kept(self):
+        other = tempfile.mkdtemp()
+        try:
+            c = os.path.join(other, "c.kfm")
+            write_kfm(c, "A.nif", [7])
+            self.index.update([other])
+            self.assertEqual(sorted(self.index.files_using_nif("a.nif")), sorted([self.a, c]))
+            # updating one root leaves the files of the others alone
+            os.remove(self.a)
+            self.index.update([self.root])
+            self.assertEqual(self.index.files_using_nif("a.nif"), [c])
+        finally:
+            shutil.rmtree(other)
+
+    def test_save_load(self):
+        filename = os.path.join(self.root, "index.json")
+        self.index.save(filename)
+        loaded = KfmFileIndex(filename)
+        self.assertEqual(loaded.files, self.index.files)
+        self.assertEqual(loaded.roots, [self.root])
+        self.assertEqual(loaded.update(), {"scanned": 0, "unchanged": 3, "removed": 0, "errors": 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
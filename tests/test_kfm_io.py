@@ -0,0 +1,135 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import kfm_io
+
+TEST_KFM = os.path.join(os.path.dirname(__file__), os.pardir, "our_pyffi", "tests", "spells", "kfm", "files", "test.kfm")
+
+
+class TestAtomicWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.target = os.path.join(self.dir, "a.kfm")
+        with open(self.target, "wb") as file:
+            file.write(b"old")
+        os.chmod(self.target, 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def contents(self):
+        with open(self.target, "rb") as file:
+            return file.read()
+
+    def test_replaced(self):
+        kfm_io.write_bytes_atomic(b"new" * 10, self.target, chunk_size=4)
+        self.assertEqual(self.contents(), b"new" * 10)
+        self.assertEqual(stat.S_IMODE(os.stat(self.target).st_mode), 0o640)
+        self.assertEqual(os.listdir(self.dir), ["a.kfm"])
+
+    def test_cancelled(self):
+        def progress(done, total):
+            if done > 4:
+                raise kfm_io.Cancelled()
+        with self.assertRaises(kfm_io.Cancelled):
+            kfm_io.write_bytes_atomic(b"new" * 10, self.target, progress, chunk_size=4)
+        # the target is untouched and the partial file gone
+        self.assertEqual(self.contents(), b"old")
+        self.assertEqual(os.listdir(self.dir), ["a.kfm"])
+
+    def test_failed_write(self):
+        # not bytes, fails on the first write
+        with self.assertRaises(TypeError):
+            kfm_io.write_bytes_atomic(["new"], self.target)
+        self.assertEqual(self.contents(), b"old")
+        self.assertEqual(os.listdir(self.dir), ["a.kfm"])
+
+    def test_open_atomic_text(self):
+        with kfm_io.open_atomic(self.target, "w", encoding="utf-8") as file:
+            file.write("new")
+        self.assertEqual(self.contents(), b"new")
+        self.assertEqual(os.listdir(self.dir), ["a.kfm"])
+
+    def test_open_atomic_failed(self):
+        # half written, then an error: the target keeps its old contents
+        with self.assertRaises(RuntimeError):
+            with kfm_io.open_atomic(self.target, "w") as file:
+                file.write("half")
+                raise RuntimeError
+        self.assertEqual(self.contents(), b"old")
+        self.assertEqual(os.listdir(self.dir), ["a.kfm"])
+
+    def test_read_write_kfm(self):
+        reported = []
+        data = kfm_io.read_kfm(TEST_KFM, lambda done, total: reported.append((done, total)))
+        self.assertEqual(reported[-1], (os.path.getsize(TEST_KFM), os.path.getsize(TEST_KFM)))
+        kfm_io.write_kfm(data, self.target)
+        with open(TEST_KFM, "rb") as file:
+            self.assertEqual(self.contents(), file.read())
+
+    def test_write_snapshot(self):
+        data = kfm_io.read_kfm(TEST_KFM)
+        snapshot = kfm_io.snapshot(data)
+        # edits after the snapshot was taken don't reach the file
+        data.kfm.nif_file_name = b"Other.nif"
+        payload = kfm_io.write_snapshot(snapshot, self.target)
+        with open(TEST_KFM, "rb") as file:
+            expected = file.read()
+        self.assertEqual(payload, expected)
+        self.assertEqual(self.contents(), expected)
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "a.kfm")
+        shutil.copyfile(TEST_KFM, self.filename)
+        self.cache = kfm_io.ParseCache(capacity=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_hit(self):
+        data = self.cache.take(self.filename)
+        self.cache.put(self.filename, data)
+        self.assertIs(self.cache.take(self.filename), data)
+        # taken means gone, the next take parses again
+        self.assertIsNot(self.cache.take(self.filename), data)
+
+    def test_mtime_changed(self):
+        data = self.cache.take(self.filename)
+        self.cache.put(self.filename, data)
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        self.assertIsNot(self.cache.take(self.filename), data)
+
+    def test_size_changed(self):
+        data = self.cache.take(self.filename)
+        stat = os.stat(self.filename)
+        self.cache.put(self.filename, data)
+        with open(self.filename, "ab") as file:
+            file.write(b"\0")
+        # same mtime, different size: the file is parsed again, and the
+        # trailing byte is refused
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertRaises(ValueError, self.cache.take, self.filename)
+
+    def test_capacity(self):
+        names = [os.path.join(self.dir, f"{i}.kfm") for i in range(3)]
+        parked = []
+        for name in names:
+            shutil.copyfile(TEST_KFM, name)
+            parked.append(self.cache.take(name))
+            self.cache.put(name, parked[-1])
+        # the least recently parked went first
+        self.assertEqual(list(self.cache.entries), [os.path.abspath(name) for name in names[1:]])
+        self.assertIs(self.cache.take(names[2]), parked[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import kfm_io
+import kfm_journal
+from kfm_commands import Command, CommandType, CommandManager
+from tests.test_kfm_commands import Uber, make_data
+
+
+class TestRecovery(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "a.kfm")
+        kfm_io.write_kfm(make_data(), self.filename)
+        self.manager = self.open_manager()
+        self.journal = kfm_journal.Journal(self.filename)
+        self.journal.start(kfm_journal.file_digest(self.filename))
+        self.manager.journal = self.journal
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.dir)
+
+    def open_manager(self):
+        manager = CommandManager(Uber(kfm_io.read_kfm(self.filename)))
+        manager.clear()
+        return manager
+
+    def edit(self, code):
+        self.assertTrue(self.manager.execute(Command(CommandType.EDIT_ANIMATION_EVENT_CODE, code, animation_index=0)))
+
+    def save(self, edits_while_writing=()):
+        generation = self.manager.generation
+        payload = kfm_io.serialize(self.manager.uber.data)
+        self.journal.begin_save()
+        for code in edits_while_writing:
+            self.edit(code)
+        kfm_io.write_bytes_atomic(payload, self.filename)
+        self.journal.restart(kfm_journal.digest(payload), generation, self.manager.snapshot)
+
+    def recover(self):
+        # what a crash now and reopening the file would give
+        self.journal.flush()
+        header, entries = kfm_journal.read_journal(self.filename)
+        self.assertEqual(header["sha1"], kfm_journal.file_digest(self.filename))
+        manager = self.open_manager()
+        self.assertEqual(kfm_journal.replay(manager, entries), len(entries))
+        return kfm_io.serialize(manager.uber.data)
+
+    def assert_recovers(self):
+        self.assertEqual(self.recover(), kfm_io.serialize(self.manager.uber.data))
+
+    def test_edits(self):
+        self.edit(10)
+        self.edit(11)
+        self.manager.undo()
+        self.assert_recovers()
+        self.manager.redo()
+        self.assert_recovers()
+
+    def test_undo_after_save(self):
+        self.edit(10)
+        self.save()
+        self.manager.undo()
+        self.assert_recovers()
+        self.manager.redo()
+        self.assert_recovers()
+        self.manager.undo()
+        self.edit(12)
+        self.manager.undo()
+        self.assert_recovers()
+
+    def test_edits_while_saving(self):
+        self.edit(10)
+        self.save(edits_while_writing=[11])
+        self.assert_recovers()
+        self.assertEqual(len(kfm_journal.read_journal(self.filename)[1]), 1)
+
+    def test_undo_while_saving(self):
+        self.edit(10)
+        self.edit(11)
+        generation = self.manager.generation
+        payload = kfm_io.serialize(self.manager.uber.data)
+        self.journal.begin_save()
+        # both undos go back past the data being written
+        self.manager.undo()
+        self.manager.undo()
+        kfm_io.write_bytes_atomic(payload, self.filename)
+        self.journal.restart(kfm_journal.digest(payload), generation, self.manager.snapshot)
+        self.assert_recovers()
+
+    def test_entries_only_kept_while_saving(self):
+        self.edit(10)
+        self.assertIsNone(self.journal.entries)
+        self.journal.begin_save()
+        self.edit(11)
+        self.assertEqual(len(self.journal.entries), 1)
+        self.journal.abort_save()
+        self.assertIsNone(self.journal.entries)
+
+    def test_replay_stops_at_undo_past_start(self):
+        manager = self.open_manager()
+        entries = [{"undo": 1}, {"do": kfm_journal.command_to_dict(Command(CommandType.EDIT_NIF_FILENAME, "Other.nif"))}]
+        self.assertEqual(kfm_journal.replay(manager, entries), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import kfm_preview
+from kfm_preview import PreviewCache, SequenceInfo
+
+KF_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "our_pyffi", "tests", "spells", "kf")
+
+
+class TestReadSequence(unittest.TestCase):
+
+    def test_controller_sequence(self):
+        for name in ("test_controllersequence.kf", "test_controllersequence_fo3.kf"):
+            with self.subTest(name=name):
+                info = kfm_preview.read_sequence(os.path.join(KF_DIR, name))
+                self.assertIsNone(info.error)
+                self.assertEqual(info.name, "TestAction")
+                self.assertEqual(info.start_time, 0.0)
+                self.assertAlmostEqual(info.duration, 0.7667, places=4)
+                self.assertEqual(info.text_keys, [])
+
+    def test_matches_full_read(self):
+        # the header-only path gives what reading every block gives
+        filename = os.path.join(KF_DIR, "test_controllersequence.kf")
+        with open(filename, "rb") as stream:
+            full = kfm_preview._read_full(stream)
+        self.assertEqual(kfm_preview.read_sequence(filename), full)
+
+    def test_errors(self):
+        self.assertEqual(kfm_preview.read_sequence(os.path.join(KF_DIR, "missing.kf")).error, "No such file or directory")
+        info = kfm_preview.read_sequence(os.path.join(KF_DIR, "__init__.py"))
+        self.assertTrue(info.error.startswith("unreadable"))
+
+
+class TestPreviewCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "a.kf")
+        with open(self.path, "wb") as file:
+            file.write(b"1")
+        self.read = []
+        self.loaded = threading.Semaphore(0)
+        self.cache = PreviewCache(on_loaded=lambda path: self.loaded.release(), reader=self.reader, recheck=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reader(self, path):
+        self.read.append(path)
+        return SequenceInfo(name=os.path.basename(path))
+
+    def wait(self):
+        self.assertTrue(self.loaded.acquire(timeout=5))
+
+    def test_read_once(self):
+        self.assertIsNone(self.cache.get(self.path))
+        self.wait()
+        self.cache.recheck = 60
+        # no disk access on the calling thread once it is in
+        with mock.patch.object(kfm_preview.os, "stat", side_effect=AssertionError):
+            self.assertEqual(self.cache.get(self.path).name, "a.kf")
+        self.assertEqual(self.read, [self.path])
+
+    def test_changed_file_read_again(self):
+        self.cache.get(self.path)
+        self.wait()
+        with open(self.path, "wb") as file:
+            file.write(b"12")
+        # the old info until the worker has seen the change
+        self.assertEqual(self.cache.get(self.path).name, "a.kf")
+        self.wait()
+        self.assertEqual(self.read, [self.path, self.path])
+
+    def test_missing_file(self):
+        self.cache.get(os.path.join(self.dir, "b.kf"))
+        self.wait()
+        self.assertEqual(self.cache.get(os.path.join(self.dir, "b.kf")).error, "not found")
+        self.assertEqual(self.read, [])
+
+    def test_latest_first(self):
+        # queued without a worker running, as it would be while it is busy
+        self.cache.thread = True
+        for name in "abcb":
+            self.cache.get(os.path.join(self.dir, name + ".kf"))
+        self.assertEqual([os.path.basename(path) for path in self.cache.queue], ["b.kf", "c.kf", "a.kf"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from kfm_resolve import AssetIndex, RESOLVED, MISSING, AMBIGUOUS, check_file
+
+TEST_KFM = os.path.join(os.path.dirname(__file__), os.pardir, "our_pyffi", "tests", "spells", "kfm", "files", "test.kfm")
+
+
+class TestAssetIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in ("Meshes/Actor/Test.nif",
+                     "Meshes/Actor/Test_MD_Run.kf",
+                     "Meshes/Other/Test_MD_Run.kf",
+                     "Meshes/Other/Test_MD_Idle.KF"):
+            path = os.path.join(self.root, *name.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb"):
+                pass
+        self.assets = AssetIndex([self.root])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split("/"))
+
+    def test_case_folded(self):
+        self.assertEqual(len(self.assets), 4)
+        resolution = self.assets.resolve("TEST.NIF")
+        self.assertEqual(resolution.status, RESOLVED)
+        self.assertEqual(resolution.paths, [self.path("Meshes/Actor/Test.nif")])
+        self.assertEqual(self.assets.resolve("test_md_idle.kf").paths, [self.path("Meshes/Other/Test_MD_Idle.KF")])
+
+    def test_directories(self):
+        for name in ("actor\\test_md_run.kf", "Meshes\\Actor\\Test_MD_Run.kf", "/meshes/actor/test_md_run.kf"):
+            resolution = self.assets.resolve(name)
+            self.assertEqual(resolution.status, RESOLVED, name)
+            self.assertEqual(resolution.paths, [self.path("Meshes/Actor/Test_MD_Run.kf")])
+        self.assertEqual(self.assets.resolve("Other\\Test.nif").status, MISSING)
+        self.assertEqual(self.assets.resolve("Test_MD_Walk.kf").status, MISSING)
+
+    def test_ambiguous(self):
+        resolution = self.assets.resolve("Test_MD_Run.kf")
+        self.assertEqual(resolution.status, AMBIGUOUS)
+        self.assertEqual(sorted(resolution.paths), sorted([self.path("Meshes/Actor/Test_MD_Run.kf"),
+                                                           self.path("Meshes/Other/Test_MD_Run.kf")]))
+
+    def test_beside_kfm_wins(self):
+        # the directory of the KFM is compared case folded as well
+        for kfm_dir, found in (("Meshes/Actor", "Meshes/Actor/Test_MD_Run.kf"), ("meshes/OTHER", "Meshes/Other/Test_MD_Run.kf")):
+            resolution = self.assets.resolve("test_md_run.KF", self.path(kfm_dir))
+            self.assertEqual(resolution.status, RESOLVED, kfm_dir)
+            self.assertEqual(resolution.paths, [self.path(found)])
+        # from anywhere else it stays ambiguous
+        self.assertEqual(self.assets.resolve("Test_MD_Run.kf", self.root).status, AMBIGUOUS)
+
+    def test_check_file(self):
+        kfm = self.path("Meshes/Actor/Test.kfm")
+        shutil.copy(TEST_KFM, kfm)
+        report = check_file(kfm, self.assets)
+        # test.kfm references Test.nif and the Idle, Run, Walk and Die KFs
+        self.assertEqual(sorted((ref.name, ref.resolution.status) for ref in report["references"]),
+                         [("Test_MD_Die.kf", MISSING), ("Test_MD_Walk.kf", MISSING)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import kfm_io
+import kfm_text
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+TEST_KFM = os.path.join(os.path.dirname(__file__), os.pardir, "our_pyffi", "tests", "spells", "kfm", "files", "test.kfm")
+
+
+def edited_kfm():
+    # test.kfm with transitions, some with details, and fields that are
+    # easy to get wrong as text
+    data = kfm_io.read_kfm(TEST_KFM)
+    data.kfm.master = "Ma\xeetre".encode("latin-1")
+    data.kfm.unknown_float_1 = 0.1
+    data.kfm.unknown_float_2 = -1e-30
+    for code, anim in enumerate(data.animations):
+        anim.event_code = code
+        anim.num_transitions = 2
+        anim.transitions.update_size()
+        for t, (target, type_) in zip(anim.transitions, [((code + 1) % 4, 5), ((code + 2) % 4, 1)]):
+            t.animation = target
+            t.type = type_
+        anim.transitions[1].duration = 1 / 3
+    return kfm_io.serialize(data)
+
+
+class TestRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def roundtrip(self, payload, format):
+        kfm = os.path.join(self.dir, "test.kfm")
+        with open(kfm, "wb") as file:
+            file.write(payload)
+        text = kfm + "." + format
+        kfm_text.export_file(kfm, text, format)
+        os.remove(kfm)
+        kfm_text.import_file(text, kfm)
+        with open(kfm, "rb") as file:
+            return file.read()
+
+    def check(self, format):
+        with open(TEST_KFM, "rb") as file:
+            original = file.read()
+        for payload in (original, edited_kfm()):
+            self.assertEqual(self.roundtrip(payload, format), payload)
+
+    def test_json(self):
+        self.check(kfm_text.JSON)
+
+    @unittest.skipIf(yaml is None, "needs PyYAML")
+    def test_yaml(self):
+        self.check(kfm_text.YAML)
+
+    def test_nans(self):
+        # NaNs with a sign or a payload keep their bits, in both formats
+        data = kfm_io.read_kfm(TEST_KFM)
+        nan = kfm_text._FLOAT32.unpack(bytes.fromhex("0100c07f"))[0]
+        data.kfm.unknown_float_1 = nan
+        data.kfm.unknown_float_2 = -float("nan")
+        payload = kfm_io.serialize(data)
+        self.assertIn(bytes.fromhex("0100c07f"), payload)
+        self.assertEqual(self.roundtrip(payload, kfm_text.JSON), payload)
+        if yaml is not None:
+            self.assertEqual(self.roundtrip(payload, kfm_text.YAML), payload)
+
+    def test_streams(self):
+        kfm = kfm_io.kfm_codec().read(edited_kfm())
+        text = io.StringIO()
+        kfm_text.dump(kfm, text)
+        data = kfm_text.load_data(io.StringIO(text.getvalue()))
+        self.assertEqual(kfm_io.serialize(data), edited_kfm())
+
+    def test_command_line(self):
+        shutil.copy(TEST_KFM, self.dir)
+        out = os.path.join(self.dir, "out")
+        self.assertEqual(kfm_text.main(["export", self.dir, "-o", out, "-j", "1"]), 0)
+        os.remove(os.path.join(self.dir, "test.kfm"))
+        self.assertEqual(kfm_text.main(["import", out, "-o", self.dir, "-j", "1"]), 0)
+        with open(os.path.join(self.dir, "test.kfm"), "rb") as file, open(TEST_KFM, "rb") as expected:
+            self.assertEqual(file.read(), expected.read())
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            kfm_text.load(io.StringIO('{"kfm_text": 1, "version": "2.2.0.0b", "animations": [{"event_code": "x"}]}'))
+
+
+if __name__ == '__main__':
+    unittest.main()